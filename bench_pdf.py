@@ -0,0 +1,68 @@
+# Benchmark generate_pdf_portrait untuk satu bulan berisi N baris pemakaian (data sintetis, tanpa database).
+# Membandingkan jalur cepat tabel PDF (sel_pdf: teks biasa bila muat, ringkas_gaya_tabel: gaya per baris digabung)
+# dengan jalur lama (semua sel teks = Paragraph, TableStyle per baris apa adanya).
+# Pakai: python bench_pdf.py [jumlah_baris ...] [--ulang N]
+import sys
+import copy
+import time
+import random
+import datetime
+import argparse
+import warnings
+
+import pandas as pd
+from reportlab.platypus import Paragraph
+
+warnings.filterwarnings("ignore")
+import main
+
+ALAT = [("EXCAVATOR PC200", "EX 01"), ("EXCAVATOR PC200", "EX 02"), ("BULLDOZER D6", "BD 01"), ("GENSET", "G1"), ("VIBRO ROLLER", "VR 01"),
+        ("DUMP TRUCK", "DT 01"), ("DUMP TRUCK", "DT 02"), ("TRITON", "TR 01"), ("HILUX", "HL 01")]
+KETERANGAN = ["kerja", "kerja harian timbunan", None, "isi ulang & cek <oli>", "Pinjam dari EX 02 untuk lembur"]
+
+def data_sintetis(n_baris, awal, seed=1):
+    acak = random.Random(seed); akhir = awal + pd.offsets.MonthEnd(0)
+    hari = pd.date_range(awal, akhir, freq='D')
+    keluar = [(i + 1, acak.choice(hari), *acak.choice(ALAT), float(acak.randint(5, 300)), acak.choice(KETERANGAN)) for i in range(n_baris)]
+    masuk = [(i + 1, acak.choice(hari), "SPBU", "SOLAR", float(acak.randint(2000, 8000)), "beli") for i in range(max(1, n_baris // 50))]
+    df_keluar = pd.DataFrame(sorted(keluar, key=lambda r: (r[1], r[0])), columns=['id', 'tanggal', 'nama_alat', 'no_unit', 'jumlah_liter', 'keterangan'])
+    df_masuk = pd.DataFrame(sorted(masuk, key=lambda r: (r[1], r[0])), columns=['id', 'tanggal', 'sumber', 'jenis_bbm', 'jumlah_liter', 'keterangan'])
+    return df_masuk, df_keluar, akhir.date()
+
+def buat_model(n_baris, awal=datetime.date(2025, 1, 1)):
+    df_masuk, df_keluar, akhir = data_sintetis(n_baris, pd.Timestamp(awal))
+    tm = df_masuk['jumlah_liter'].sum(); tk = df_keluar['jumlah_liter'].sum()
+    rekap = [{'bln': f"{main.get_bulan_indonesia(awal.month)} {awal.year}", 'awal': 0.0, 'masuk': tm, 'keluar': tk, 'sisa': tm - tk, 'bulan_nama': main.get_bulan_indonesia(awal.month)[:3]}]
+    return main.susun_model_laporan(df_masuk, df_keluar, 0.0, rekap, awal, akhir, []), awal, akhir
+
+def ukur(model, awal, akhir, ulang):
+    terbaik = None
+    for _ in range(ulang):
+        m = copy.deepcopy(model); t = time.perf_counter()
+        with main.generate_pdf_portrait(None, 1, "BENCH", awal, akhir, [], model=m) as buf: ukuran = len(buf.read())
+        dt = time.perf_counter() - t; terbaik = dt if terbaik is None else min(terbaik, dt)
+    return terbaik, ukuran
+
+def jalur_lama():
+    # Sama dengan sebelum jalur cepat: Paragraph untuk setiap sel teks, tanpa penggabungan perintah gaya
+    asli = main.sel_pdf, main.ringkas_gaya_tabel
+    main.sel_pdf = lambda teks, style, lebar_kolom, padding=12: Paragraph(teks, style)
+    main.ringkas_gaya_tabel = lambda perintah: list(perintah)
+    return asli
+
+def main_bench(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument('baris', nargs='*', type=int, default=[500, 2000, 5000])
+    ap.add_argument('--ulang', type=int, default=3, help="jumlah pengulangan, diambil waktu terbaik")
+    arg = ap.parse_args(argv)
+    print(f"{'baris':>7} {'cepat (s)':>10} {'lama (s)':>10} {'rasio':>7} {'ukuran cepat/lama (byte)':>26}")
+    for n in arg.baris:
+        model, awal, akhir = buat_model(n)
+        t_cepat, b_cepat = ukur(model, awal, akhir, arg.ulang)
+        asli = jalur_lama()
+        try: t_lama, b_lama = ukur(model, awal, akhir, arg.ulang)
+        finally: main.sel_pdf, main.ringkas_gaya_tabel = asli
+        print(f"{n:>7} {t_cepat:>10.3f} {t_lama:>10.3f} {t_lama / t_cepat:>6.2f}x {f'{b_cepat}/{b_lama}':>26}")
+
+if __name__ == '__main__':
+    main_bench(sys.argv[1:])
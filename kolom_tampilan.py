@@ -0,0 +1,21 @@
+# Kolom tampilan (HARI, label riwayat) dibentuk per kolom, bukan apply per baris.
+# Modul ini hanya butuh pandas/numpy supaya bisa di-import & dites tanpa Streamlit.
+import numpy as np
+import pandas as pd
+
+# Index = dt.dayofweek (Senin=0); index 7 untuk tanggal kosong (NaT)
+NAMA_HARI = np.array(['Senin', 'Selasa', 'Rabu', 'Kamis', 'Jumat', 'Sabtu', 'Minggu', '-'], dtype=object)
+
+def kolom_hari_indonesia(tanggal):
+    # Lookup array per dayofweek, tanpa strftime + dict per baris
+    dow = pd.to_datetime(tanggal, errors='coerce').dt.dayofweek
+    return pd.Series(NAMA_HARI[dow.fillna(7).astype(int).to_numpy()], index=tanggal.index)
+
+LABEL_HISTORY = ["📥 BBM MASUK (Beli)", "🛠️ ADMIN/KOREKSI", "🔄 TRANSFER KELUAR (Donor)", "🔄 TRANSFER MASUK (Terima)"]
+
+def kolom_label_history(df):
+    # Urutan kondisi = urutan prioritas np.select (sama dengan cek if/elif lama per baris)
+    tipe = df['Tipe']; ket = df['keterangan'].astype(str).str.lower()
+    kondisi = [tipe == 'MASUK', tipe == 'LOG', pd.to_numeric(df['jumlah_liter'], errors='coerce') < 0,
+               ket.str.contains('pinjam', regex=False) | ket.str.contains('transfer', regex=False)]
+    return pd.Series(np.select(kondisi, LABEL_HISTORY, default="📤 PENGGUNAAN (Pakai)"), index=df.index)
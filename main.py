@@ -1,13 +1,33 @@
 import streamlit as st
 import pymysql
 import pandas as pd
+import numpy as np
 import certifi
 import io
+import os
+import sys
 import datetime
+import time
 import math
 import re
+import threading
+import multiprocessing
+import queue
+import pickle
+import zipfile
+import hashlib
+import tempfile
+import shutil
+import copy
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dateutil.relativedelta import relativedelta
 from sqlalchemy import create_engine
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from kolom_tampilan import kolom_hari_indonesia, kolom_label_history
 
 # --- SETUP MATPLOTLIB ---
 import matplotlib
@@ -24,6 +44,10 @@ from reportlab.platypus import BaseDocTemplate, Frame, PageTemplate, NextPageTem
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 from reportlab.lib.units import cm, mm
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.graphics.shapes import Drawing, String
+from reportlab.graphics.charts.barcharts import HorizontalBarChart, VerticalBarChart
+from reportlab.graphics.charts.legends import Legend
 
 from docx import Document
 from docx.shared import Pt, Cm, Inches, RGBColor
@@ -32,8 +56,13 @@ from docx.oxml.ns import nsdecls
 from docx.oxml import parse_xml
 
 from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
-from openpyxl.drawing.image import Image as XLImage
+from openpyxl.styles import Font, PatternFill, Border, Side, Alignment, NamedStyle
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+from openpyxl.chart import BarChart, Reference
+from openpyxl.chart.label import DataLabelList
+from openpyxl.chart.data_source import AxDataSource, StrRef
 
 # --- GLOBAL COLORS ---
 COLOR_HEADER_BLUE = colors.HexColor("#2F5496")
@@ -65,22 +94,169 @@ def init_engine():
         pool_recycle=3600,
         pool_pre_ping=True  # Otomatis mengecek koneksi mati/hidup tanpa perlu conn.ping()
     )
+    # Migrasi skema cukup sekali per proses (ikut cache_resource), bukan setiap rerun
+    jalankan_migrasi(engine)
     return engine
 
+# --- DATA LOKASI (CACHE) ---
+# Frame per lokasi disimpan di memori proses, ditandai data_versi lokasi tsb. Saat versi berubah,
+# hanya baris baru (id > watermark) dan baris yang tercatat di log_perubahan (edit/hapus) yang diambil ulang.
+TABEL_DELTA = ['bbm_masuk', 'bbm_keluar', 'log_aktivitas']
+JENDELA_DELTA = 50 # id terakhir yang selalu diambil ulang, jaga-jaga commit yang urutannya tidak sesuai id
+MAKS_LOKASI_CACHE = 32
+# log_perubahan dipangkas (migrasi & rebuild snapshot): entri lebih tua dari RETENSI_LOG_PERUBAHAN hari dibuang.
+# Cache yang terakhir sinkron lebih dari separuh masa retensi dimuat penuh, karena entri yang dibutuhkan delta-nya bisa sudah terbuang
+RETENSI_LOG_PERUBAHAN = 7 # hari
+
+@st.cache_resource
+def _cache_data_lokasi():
+    return {'lock': threading.Lock(), 'data': OrderedDict()}
+
+def _siapkan_frame(tabel, df):
+    # OPTIMASI
+    if tabel != 'log_aktivitas' and not df.empty:
+        df['tanggal'] = pd.to_datetime(df['tanggal'])
+        df['HARI'] = kolom_hari_indonesia(df['tanggal'])
+    return df
+
+def _muat_exclude(conn, lokasi_id):
+    df_ex = pd.read_sql(f"SELECT nama_unit_full FROM rekap_exclude WHERE lokasi_id={lokasi_id}", conn)
+    return df_ex['nama_unit_full'].tolist() if not df_ex.empty else []
+
+def _muat_penuh(conn, lokasi_id):
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM log_perubahan WHERE lokasi_id=%s", (lokasi_id,))
+    entry = {'jurnal': int(cursor.fetchone()[0]), 'frames': {}, 'watermark': {}, 'sinkron': time.time()}
+    for tabel in TABEL_DELTA:
+        df = _siapkan_frame(tabel, pd.read_sql(f"SELECT * FROM {tabel} WHERE lokasi_id={lokasi_id}", conn))
+        entry['frames'][tabel] = df; entry['watermark'][tabel] = int(df['id'].max()) if not df.empty else 0
+    entry['excluded'] = _muat_exclude(conn, lokasi_id)
+    return entry
+
+def _muat_delta(conn, lokasi_id, entry):
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, tabel, row_id FROM log_perubahan WHERE lokasi_id=%s AND id > %s", (lokasi_id, max(0, entry['jurnal'] - JENDELA_DELTA)))
+    jurnal = cursor.fetchall()
+    if len(jurnal) > 5000: return _muat_penuh(conn, lokasi_id)
+    baru = {'jurnal': max([entry['jurnal']] + [int(r[0]) for r in jurnal]), 'frames': {}, 'watermark': {}, 'sinkron': time.time()}
+    for tabel in TABEL_DELTA:
+        ids_ubah = {int(r[2]) for r in jurnal if r[1] == tabel}
+        q = f"SELECT * FROM {tabel} WHERE lokasi_id=%s AND (id > %s"
+        if ids_ubah: q += f" OR id IN ({','.join(str(i) for i in sorted(ids_ubah))})"
+        df_baru = _siapkan_frame(tabel, pd.read_sql(q + ")", conn, params=(lokasi_id, max(0, entry['watermark'][tabel] - JENDELA_DELTA))))
+        df_lama = entry['frames'][tabel]
+        df_lama = df_lama[~df_lama['id'].isin(ids_ubah | set(df_baru['id'].tolist()))] if not df_lama.empty else df_lama
+        if df_baru.empty: df = df_lama.reset_index(drop=True)
+        elif df_lama.empty: df = df_baru
+        else: df = pd.concat([df_lama, df_baru]).sort_values('id').reset_index(drop=True)
+        baru['frames'][tabel] = df
+        baru['watermark'][tabel] = max(entry['watermark'][tabel], int(df_baru['id'].max()) if not df_baru.empty else 0)
+    baru['excluded'] = _muat_exclude(conn, lokasi_id)
+    return baru
+
+def load_data_lokasi(conn, lokasi_id, versi_data):
+    cache = _cache_data_lokasi()
+    with cache['lock']: entry = cache['data'].get(lokasi_id)
+    if entry is None: entry = _muat_penuh(conn, lokasi_id)
+    elif entry['versi'] != versi_data:
+        basi = time.time() - entry['sinkron'] > RETENSI_LOG_PERUBAHAN * 86400 / 2
+        entry = _muat_penuh(conn, lokasi_id) if basi else _muat_delta(conn, lokasi_id, entry)
+    entry['versi'] = versi_data
+    with cache['lock']:
+        cache['data'][lokasi_id] = entry; cache['data'].move_to_end(lokasi_id)
+        while len(cache['data']) > MAKS_LOKASI_CACHE: cache['data'].popitem(last=False)
+    f = entry['frames']
+    return f['bbm_masuk'].copy(), f['bbm_keluar'].copy(), f['log_aktivitas'].copy(), list(entry['excluded'])
+
+def naikkan_versi_data(cursor, lokasi_id, perubahan=()):
+    # perubahan: list (tabel, id) untuk baris yang di-UPDATE/DELETE; INSERT cukup lewat watermark id
+    if perubahan: cursor.executemany("INSERT INTO log_perubahan (lokasi_id, tabel, row_id) VALUES (%s,%s,%s)", [(lokasi_id, tabel, int(row_id)) for tabel, row_id in perubahan])
+    cursor.execute("UPDATE lokasi_proyek SET data_versi = data_versi + 1 WHERE id=%s", (lokasi_id,))
+
+def pangkas_log_perubahan(cursor):
+    cursor.execute("DELETE FROM log_perubahan WHERE waktu < NOW() - INTERVAL %s DAY", (RETENSI_LOG_PERUBAHAN,))
+
+# --- MIGRASI SKEMA ---
+def _kolom_ada(cursor, tabel, kolom):
+    cursor.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s", (tabel, kolom))
+    return cursor.fetchone()[0] > 0
+
+def _index_ada(cursor, tabel, nama_index):
+    cursor.execute("SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s", (tabel, nama_index))
+    return cursor.fetchone()[0] > 0
+
+def _migrasi_kolom_lokasi(conn, cursor):
+    if not _kolom_ada(cursor, 'lokasi_proyek', 'stok_awal'): cursor.execute("ALTER TABLE lokasi_proyek ADD COLUMN stok_awal FLOAT DEFAULT 0")
+    if not _kolom_ada(cursor, 'lokasi_proyek', 'kunci_lokasi'): cursor.execute("ALTER TABLE lokasi_proyek ADD COLUMN kunci_lokasi VARCHAR(255) DEFAULT '123'")
+
+def _migrasi_log_aktivitas(conn, cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS log_aktivitas (id INT AUTO_INCREMENT PRIMARY KEY, lokasi_id INT, tanggal DATETIME DEFAULT CURRENT_TIMESTAMP, kategori VARCHAR(50), deskripsi TEXT, affected_ids TEXT)""")
+    if not _kolom_ada(cursor, 'log_aktivitas', 'affected_ids'): cursor.execute("ALTER TABLE log_aktivitas ADD COLUMN affected_ids TEXT")
+
+def _migrasi_rekap_exclude(conn, cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS rekap_exclude (id INT AUTO_INCREMENT PRIMARY KEY, lokasi_id INT, nama_unit_full VARCHAR(255))""")
+
+def _migrasi_stok_bulanan(conn, cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS stok_bulanan (lokasi_id INT NOT NULL, bulan DATE NOT NULL, saldo_akhir DOUBLE DEFAULT 0, PRIMARY KEY (lokasi_id, bulan))""")
+    rebuild_stok_bulanan(conn, naikkan_versi=False)
+
+def _migrasi_index(conn, cursor):
+    for tabel, nama_index, kolom in [
+        ('bbm_masuk', 'idx_masuk_lokasi_tanggal', 'lokasi_id, tanggal'),
+        ('bbm_keluar', 'idx_keluar_lokasi_tanggal', 'lokasi_id, tanggal'),
+        ('log_aktivitas', 'idx_log_lokasi', 'lokasi_id'),
+        ('rekap_exclude', 'idx_exclude_lokasi', 'lokasi_id'),
+    ]:
+        if not _index_ada(cursor, tabel, nama_index): cursor.execute(f"CREATE INDEX {nama_index} ON {tabel} ({kolom})")
+
+def _migrasi_versi_data(conn, cursor):
+    if not _kolom_ada(cursor, 'lokasi_proyek', 'data_versi'): cursor.execute("ALTER TABLE lokasi_proyek ADD COLUMN data_versi INT NOT NULL DEFAULT 0")
+
+def _migrasi_log_perubahan(conn, cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS log_perubahan (id BIGINT AUTO_INCREMENT PRIMARY KEY, lokasi_id INT NOT NULL, tabel VARCHAR(30) NOT NULL, row_id INT NOT NULL, waktu DATETIME DEFAULT CURRENT_TIMESTAMP, INDEX idx_perubahan_lokasi (lokasi_id, id))""")
+
+# Urutan tetap; tambahkan langkah baru di akhir dengan nomor versi berikutnya
+MIGRASI = [
+    (1, "kolom stok_awal & kunci_lokasi pada lokasi_proyek", _migrasi_kolom_lokasi),
+    (2, "tabel log_aktivitas + kolom affected_ids", _migrasi_log_aktivitas),
+    (3, "tabel rekap_exclude", _migrasi_rekap_exclude),
+    (4, "tabel snapshot stok_bulanan", _migrasi_stok_bulanan),
+    (5, "index lokasi_id/tanggal", _migrasi_index),
+    (6, "kolom data_versi pada lokasi_proyek", _migrasi_versi_data),
+    (7, "tabel log_perubahan untuk delta loading", _migrasi_log_perubahan),
+]
+
+PERCOBAAN_LOCK_MIGRASI = 3 # x 60 detik
+
+def jalankan_migrasi(engine):
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        # Lock bernama agar dua proses server tidak menjalankan migrasi bersamaan. GET_LOCK: 1 = dapat, 0 = timeout, NULL = error.
+        # Tanpa lock migrasi tidak dijalankan (dan lock tidak di-release); init_engine gagal, rerun berikutnya mencoba lagi
+        for _ in range(PERCOBAAN_LOCK_MIGRASI):
+            cursor.execute("SELECT GET_LOCK('lembu_migrasi', 60)"); dapat = cursor.fetchone()[0]
+            if dapat == 1: break
+        else: raise RuntimeError("Migrasi skema: lock 'lembu_migrasi' tidak didapat (masih dipegang proses lain), coba muat ulang halaman.")
+        try:
+            cursor.execute("""CREATE TABLE IF NOT EXISTS schema_version (versi INT PRIMARY KEY, keterangan VARCHAR(255), diterapkan DATETIME DEFAULT CURRENT_TIMESTAMP)""")
+            cursor.execute("SELECT COALESCE(MAX(versi), 0) FROM schema_version"); versi_db = cursor.fetchone()[0]
+            for versi, keterangan, langkah in MIGRASI:
+                if versi <= versi_db: continue
+                langkah(conn, cursor)
+                cursor.execute("INSERT INTO schema_version (versi, keterangan) VALUES (%s, %s)", (versi, keterangan)); conn.commit()
+            pangkas_log_perubahan(cursor); conn.commit()
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK('lembu_migrasi')"); cursor.fetchall()
+    finally:
+        conn.close()
+
 # --- HELPER FUNCTIONS ---
 def get_bulan_indonesia(bulan_int):
     nama_bulan = ["", "JANUARI", "FEBRUARI", "MARET", "APRIL", "MEI", "JUNI", 
                   "JULI", "AGUSTUS", "SEPTEMBER", "OKTOBER", "NOVEMBER", "DESEMBER"]
     return nama_bulan[bulan_int]
 
-def get_hari_indonesia(tanggal):
-    try:
-        if pd.isnull(tanggal): return "-"
-        kamus = {'Monday': 'Senin', 'Tuesday': 'Selasa', 'Wednesday': 'Rabu', 
-                 'Thursday': 'Kamis', 'Friday': 'Jumat', 'Saturday': 'Sabtu', 'Sunday': 'Minggu'}
-        return kamus[tanggal.strftime('%A')]
-    except: return "-"
-
 def cek_kategori(nama_alat):
     nama = str(nama_alat).upper()
     kata_kunci_mobil = ["TRUCK", "MOBIL", "TRITON", "DT", "FAW", "SANNY", "R6", "R10", "PICK UP", "HILUX", "STRADA", "GRAND MAX"]
@@ -88,9 +264,24 @@ def cek_kategori(nama_alat):
         return "MOBIL_TRUCK"
     return "ALAT_BERAT"
 
+_SHADING_DOCX = {}
 def set_cell_bg(cell, color_hex):
-    shading_elm = parse_xml(r'<w:shd {} w:fill="{}"/>'.format(nsdecls('w'), color_hex))
-    cell._tc.get_or_add_tcPr().append(shading_elm)
+    # Fragmen w:shd di-parse sekali per warna, selanjutnya cukup deepcopy
+    if color_hex not in _SHADING_DOCX: _SHADING_DOCX[color_hex] = parse_xml(r'<w:shd {} w:fill="{}"/>'.format(nsdecls('w'), color_hex))
+    cell._tc.get_or_add_tcPr().append(copy.deepcopy(_SHADING_DOCX[color_hex]))
+
+# --- TABEL DOCX MASSAL ---
+# tbl.add_row()/row.cells menelusuri seluruh tabel tiap baris (kuadratik). Untuk tabel besar, satu baris contoh per gaya
+# dibuat lewat API python-docx lalu dilepas; baris data berikutnya = deepcopy w:tr contoh (tcW, shading, pPr, rPr) + ganti teks.
+def templat_baris_docx(tabel, isi_gaya):
+    cells = tabel.add_row().cells; isi_gaya(cells); tr = cells[0]._tc.getparent(); tabel._tbl.remove(tr)
+    return tr
+
+def tambah_baris_docx(tabel, templat, teks):
+    tr = copy.deepcopy(templat)
+    for tc, t in zip(tr.tc_lst, teks):
+        if t is not None: tc.p_lst[0].r_lst[0].text = t
+    tabel._tbl.append(tr)
 
 def segregate_data(df, excluded_list):
     if df.empty:
@@ -120,49 +311,134 @@ def process_transfers_for_table(df):
     else:
         df_proc = df_proc.sort_values(['tanggal']).reset_index(drop=True)
 
-    indices_to_drop = []
-
-    for idx, row in df_proc.iterrows():
-        ket = str(row['keterangan'])
-        if "Pinjam dari" in ket or "Transfer dari" in ket:
-            indices_to_drop.append(idx)
-            continue 
-
-        if row['jumlah_liter'] < 0:
-            transfer_amt = row['jumlah_liter'] 
-            unit_name = row['nama_alat']
-            unit_code = row['no_unit']
-
-            prev_rows = df_proc[
-                (df_proc.index < idx) & 
-                (df_proc['nama_alat'] == unit_name) & 
-                (df_proc['no_unit'] == unit_code) & 
-                (df_proc['jumlah_liter'] > 0)
-            ]
-
-            if not prev_rows.empty:
-                target_idx = prev_rows.index[-1]
-                current_val = df_proc.at[target_idx, 'jumlah_liter']
-                df_proc.at[target_idx, 'jumlah_liter'] = current_val + transfer_amt
-                indices_to_drop.append(idx)
+    ket = df_proc['keterangan'].astype(str)
+    is_pinjam = (ket.str.contains("Pinjam dari", regex=False) | ket.str.contains("Transfer dari", regex=False)).to_numpy()
+    liter = df_proc['jumlah_liter'].to_numpy(copy=True)
+    is_neg = (liter < 0) & ~is_pinjam
+
+    if is_neg.any():
+        # Posisi isi positif terakhir per (alat, unit) sebelum tiap baris transfer keluar
+        posisi = pd.Series(np.where(liter > 0, np.arange(len(df_proc)), np.nan))
+        target = posisi.groupby([df_proc['nama_alat'], df_proc['no_unit']]).ffill().to_numpy()
+        neg_pos = np.flatnonzero(is_neg & ~np.isnan(target))
+        if len(neg_pos):
+            tgt = target[neg_pos].astype(int)
+            if _netting_bertingkat(liter, tgt, neg_pos):
+                liter = _netting_sequential(df_proc, df_proc['jumlah_liter'].to_numpy(copy=True), is_neg)
             else:
-                indices_to_drop.append(idx)
-
-    df_clean = df_proc.drop(indices_to_drop)
-    return df_clean
+                np.add.at(liter, tgt, liter[neg_pos])
+            df_proc['jumlah_liter'] = liter
+
+    return df_proc[~(is_pinjam | is_neg)]
+
+def _netting_bertingkat(liter, tgt, neg_pos):
+    # True jika ada isi yang sudah habis (<= 0) lalu masih menerima transfer berikutnya,
+    # sehingga transfer itu seharusnya jatuh ke isi positif yang lebih awal
+    unik = np.unique(tgt)
+    urut = pd.DataFrame({
+        'tgt': np.concatenate([unik, tgt]),
+        'pos': np.concatenate([np.full(len(unik), -1), neg_pos]),
+        'val': np.concatenate([liter[unik], liter[neg_pos]]).astype(float),
+    }).sort_values(['tgt', 'pos'], kind='stable')
+    sebelum = urut.groupby('tgt')['val'].cumsum().groupby(urut['tgt']).shift(1)
+    return bool((sebelum[urut['pos'] >= 0] <= 1e-6).any())
+
+def _netting_sequential(df_proc, liter, is_neg):
+    # Jalur eksak O(n) untuk transfer berantai, memakai stack isi positif per (alat, unit)
+    stacks = {}
+    for pos, key in enumerate(zip(df_proc['nama_alat'], df_proc['no_unit'])):
+        if pd.isnull(key[0]) or pd.isnull(key[1]): continue
+        stack = stacks.setdefault(key, [])
+        if liter[pos] > 0: stack.append(pos)
+        elif is_neg[pos] and stack:
+            t = stack[-1]; liter[t] = liter[t] + liter[pos]
+            if not liter[t] > 0: stack.pop()
+    return liter
 
 def hitung_stok_awal_periode(conn, lokasi_id, start_date):
     cursor = conn.cursor()
     cursor.execute("SELECT stok_awal FROM lokasi_proyek WHERE id = %s", (lokasi_id,))
     res = cursor.fetchone()
     modal_awal = float(res[0]) if res and res[0] is not None else 0.0
-    cursor.execute("SELECT COALESCE(SUM(jumlah_liter), 0) FROM bbm_masuk WHERE lokasi_id = %s AND tanggal < %s", (lokasi_id, start_date))
-    res_m = cursor.fetchone()
-    masuk_prev = float(res_m[0])
-    cursor.execute("SELECT COALESCE(SUM(jumlah_liter), 0) FROM bbm_keluar WHERE lokasi_id = %s AND tanggal < %s", (lokasi_id, start_date))
-    res_k = cursor.fetchone()
-    keluar_prev = float(res_k[0])
-    return modal_awal + masuk_prev - keluar_prev
+    # Saldo penutup bulan sebelumnya dari snapshot + transaksi bulan berjalan sebelum start_date
+    bulan = start_date.replace(day=1)
+    cursor.execute("""SELECT
+        (SELECT saldo_akhir FROM stok_bulanan WHERE lokasi_id = %s AND bulan < %s ORDER BY bulan DESC LIMIT 1),
+        (SELECT COALESCE(SUM(jumlah_liter), 0) FROM bbm_masuk WHERE lokasi_id = %s AND tanggal >= %s AND tanggal < %s),
+        (SELECT COALESCE(SUM(jumlah_liter), 0) FROM bbm_keluar WHERE lokasi_id = %s AND tanggal >= %s AND tanggal < %s)""",
+        (lokasi_id, bulan, lokasi_id, bulan, start_date, lokasi_id, bulan, start_date))
+    res_s = cursor.fetchone()
+    saldo_snapshot = float(res_s[0]) if res_s[0] is not None else 0.0
+    masuk_prev = float(res_s[1])
+    keluar_prev = float(res_s[2])
+    return modal_awal + saldo_snapshot + masuk_prev - keluar_prev
+
+# --- SNAPSHOT STOK BULANAN ---
+# stok_bulanan.saldo_akhir = kumulatif (masuk - keluar) s/d akhir bulan tsb, belum termasuk modal stok_awal
+def update_stok_bulanan(cursor, lokasi_id, tanggal, delta):
+    if not delta: return
+    bulan = pd.Timestamp(tanggal).date().replace(day=1)
+    cursor.execute("SELECT saldo_akhir FROM stok_bulanan WHERE lokasi_id=%s AND bulan<%s ORDER BY bulan DESC LIMIT 1", (lokasi_id, bulan))
+    res = cursor.fetchone(); saldo_prev = float(res[0]) if res else 0.0
+    cursor.execute("INSERT IGNORE INTO stok_bulanan (lokasi_id, bulan, saldo_akhir) VALUES (%s,%s,%s)", (lokasi_id, bulan, saldo_prev))
+    cursor.execute("UPDATE stok_bulanan SET saldo_akhir = saldo_akhir + %s WHERE lokasi_id=%s AND bulan>=%s", (float(delta), lokasi_id, bulan))
+
+def tambah_mutasi_stok(cursor, lokasi_id, tabel, tanggal, liter):
+    update_stok_bulanan(cursor, lokasi_id, tanggal, liter if tabel == "bbm_masuk" else -liter)
+
+def batalkan_mutasi_stok(cursor, tabel, row_id):
+    # Dipanggil sebelum DELETE/UPDATE agar kontribusi baris lama dikeluarkan dari snapshot
+    cursor.execute(f"SELECT lokasi_id, tanggal, jumlah_liter FROM {tabel} WHERE id=%s", (row_id,))
+    res = cursor.fetchone()
+    if res and res[2] is not None: tambah_mutasi_stok(cursor, res[0], tabel, res[1], -float(res[2]))
+
+def hitung_saldo_bulanan(conn, lokasi_id=None):
+    where = "WHERE lokasi_id = %s" if lokasi_id is not None else ""
+    params = (lokasi_id, lokasi_id) if lokasi_id is not None else None
+    q = f"""SELECT lokasi_id, YEAR(tanggal) AS y, MONTH(tanggal) AS m, SUM(jumlah_liter) AS net FROM bbm_masuk {where} GROUP BY lokasi_id, YEAR(tanggal), MONTH(tanggal)
+            UNION ALL
+            SELECT lokasi_id, YEAR(tanggal), MONTH(tanggal), -SUM(jumlah_liter) FROM bbm_keluar {where} GROUP BY lokasi_id, YEAR(tanggal), MONTH(tanggal)"""
+    cursor = conn.cursor(); cursor.execute(q, params)
+    df = pd.DataFrame(cursor.fetchall(), columns=['lokasi_id', 'y', 'm', 'net'])
+    if df.empty: return pd.DataFrame(columns=['lokasi_id', 'bulan', 'saldo_akhir'])
+    df = df.dropna(subset=['y', 'm'])
+    df['net'] = pd.to_numeric(df['net'], errors='coerce').fillna(0.0).astype(float)
+    df['bulan'] = [datetime.date(int(y), int(m), 1) for y, m in zip(df['y'], df['m'])]
+    df = df.groupby(['lokasi_id', 'bulan'], as_index=False)['net'].sum().sort_values(['lokasi_id', 'bulan'])
+    df['saldo_akhir'] = df.groupby('lokasi_id')['net'].cumsum()
+    return df[['lokasi_id', 'bulan', 'saldo_akhir']].reset_index(drop=True)
+
+def rebuild_stok_bulanan(conn, lokasi_id=None, naikkan_versi=True):
+    # naikkan_versi=False hanya untuk migrasi awal (kolom data_versi belum ada, belum ada cache yang perlu dibatalkan)
+    df = hitung_saldo_bulanan(conn, lokasi_id)
+    cursor = conn.cursor()
+    if lokasi_id is not None:
+        terdampak = {int(lokasi_id)}; cursor.execute("DELETE FROM stok_bulanan WHERE lokasi_id=%s", (lokasi_id,))
+    else:
+        cursor.execute("SELECT DISTINCT lokasi_id FROM stok_bulanan"); terdampak = {int(r[0]) for r in cursor.fetchall()} | {int(x) for x in df['lokasi_id']}
+        cursor.execute("DELETE FROM stok_bulanan")
+    if not df.empty:
+        cursor.executemany("INSERT INTO stok_bulanan (lokasi_id, bulan, saldo_akhir) VALUES (%s,%s,%s)", [(int(r.lokasi_id), r.bulan, float(r.saldo_akhir)) for r in df.itertuples()])
+    # Saldo snapshot ikut dipakai laporan/cache: versi data lokasi yang tersentuh naik dalam transaksi yang sama
+    if naikkan_versi:
+        for lid in sorted(terdampak): naikkan_versi_data(cursor, lid)
+        pangkas_log_perubahan(cursor)
+    conn.commit()
+    return len(df)
+
+def verifikasi_stok_bulanan(conn, lokasi_id=None):
+    # Membandingkan snapshot dengan tabel transaksi mentah, return baris yang selisih
+    expected = hitung_saldo_bulanan(conn, lokasi_id).rename(columns={'saldo_akhir': 'seharusnya'})
+    q = "SELECT lokasi_id, bulan, saldo_akhir FROM stok_bulanan" + (" WHERE lokasi_id = %s" if lokasi_id is not None else "")
+    cursor = conn.cursor(); cursor.execute(q, (lokasi_id,) if lokasi_id is not None else None)
+    actual = pd.DataFrame(cursor.fetchall(), columns=['lokasi_id', 'bulan', 'snapshot'])
+    actual['bulan'] = pd.to_datetime(actual['bulan']).dt.date
+    actual['snapshot'] = actual['snapshot'].astype(float)
+    df = expected.merge(actual, on=['lokasi_id', 'bulan'], how='outer').sort_values(['lokasi_id', 'bulan'])
+    # Bulan tanpa baris berarti saldonya sama dengan bulan sebelumnya
+    df[['seharusnya', 'snapshot']] = df.groupby('lokasi_id')[['seharusnya', 'snapshot']].ffill().fillna(0.0)
+    df['selisih'] = df['snapshot'] - df['seharusnya']
+    return df[df['selisih'].abs() > 0.01].reset_index(drop=True)
 
 def split_date_range_by_month(start_date, end_date):
     result = []
@@ -176,6 +452,27 @@ def split_date_range_by_month(start_date, end_date):
         current = next_month
     return result
 
+def hitung_rekap_bulanan(conn, lokasi_id, start_date, end_date):
+    # Satu query GROUP BY untuk seluruh rentang (range tanggal sargable, bisa pakai index)
+    awal = start_date.replace(day=1); batas = end_date.replace(day=1) + relativedelta(months=1)
+    q = """SELECT 'M', YEAR(tanggal), MONTH(tanggal), SUM(jumlah_liter) FROM bbm_masuk WHERE lokasi_id = %s AND tanggal >= %s AND tanggal < %s GROUP BY YEAR(tanggal), MONTH(tanggal)
+           UNION ALL
+           SELECT 'K', YEAR(tanggal), MONTH(tanggal), SUM(jumlah_liter) FROM bbm_keluar WHERE lokasi_id = %s AND tanggal >= %s AND tanggal < %s GROUP BY YEAR(tanggal), MONTH(tanggal)"""
+    cursor = conn.cursor()
+    cursor.execute(q, (lokasi_id, awal, batas, lokasi_id, awal, batas))
+    sums = {(jenis, int(y), int(m)): float(total) if total else 0.0 for jenis, y, m, total in cursor.fetchall()}
+
+    m_data = []
+    stok_run = hitung_stok_awal_periode(conn, lokasi_id, start_date)
+    curr = awal
+    while curr < batas:
+        m = curr.month; y = curr.year
+        mi = sums.get(('M', y, m), 0.0); mo = sums.get(('K', y, m), 0.0)
+        prev = stok_run; stok_run = prev + mi - mo
+        m_data.append({'bln': f"{get_bulan_indonesia(m)} {y}", 'awal': prev, 'masuk': mi, 'keluar': mo, 'sisa': stok_run, 'bulan_nama': get_bulan_indonesia(m)[:3]})
+        curr = curr + relativedelta(months=1)
+    return m_data
+
 def safe_text(text, max_chars=35):
     s = str(text) if text else "-"
     if len(s) > max_chars:
@@ -212,74 +509,468 @@ def prepare_data_global_subtotals(df):
         
     return processed
 
+# --- RIWAYAT INPUT (PAGINATION) ---
+# Kunci urutan per opsi sort: (kolom, DESC?). urut_tipe memecah id kembar antar tabel.
+URUTAN_HISTORY = {
+    "Waktu Input Terbaru (ID)": (['id', 'urut_tipe'], True),
+    "Waktu Input Terlama (ID)": (['id', 'urut_tipe'], False),
+    "Tanggal Laporan Terbaru": (['tanggal', 'id', 'urut_tipe'], True),
+    "Tanggal Laporan Terlama": (['tanggal', 'id', 'urut_tipe'], False),
+}
+KATEGORI_KELUAR_SQL = "CASE WHEN jumlah_liter < 0 OR LOWER(keterangan) LIKE '%%pinjam%%' OR LOWER(keterangan) LIKE '%%transfer%%' THEN 'TRANSFER' ELSE 'PAKAI' END"
+
+def _kondisi_keyset(kolom, kunci, desc, urut_tipe):
+    # (a,b,c) < (x,y,z) dijabarkan manual: a<x OR (a=x AND (b<y OR (b=y AND c<z)))
+    op = "<" if desc else ">"
+    def ekspr(k): return str(urut_tipe) if k == 'urut_tipe' else k
+    sql = f"{ekspr(kolom[-1])} {op} %s"; params = [kunci[-1]]
+    for k, v in zip(reversed(kolom[:-1]), reversed(kunci[:-1])):
+        sql = f"{ekspr(k)} {op} %s OR ({ekspr(k)} = %s AND ({sql}))"; params = [v, v] + params
+    return f"({sql})", params
+
+def ambil_halaman_history(conn, lokasi_id, filter_tipe, tanggal_filter, urutan, kunci_cursor, limit):
+    # Hanya satu halaman yang diambil dari MySQL; kunci_cursor = kunci baris terakhir halaman sebelumnya
+    kolom, desc = URUTAN_HISTORY[urutan]; arah = "DESC" if desc else "ASC"
+    order_by = ", ".join(f"{k} {arah}" for k in kolom)
+    tipe = set(filter_tipe) if filter_tipe else {"MASUK", "PAKAI", "TRANSFER", "KOREKSI"}
+    cabang = []
+    if "MASUK" in tipe: cabang.append(("bbm_masuk", 1, "id, tanggal, 'MASUK' AS Tipe, CONCAT(sumber, ' (', jenis_bbm, ')') AS Detail, jumlah_liter, keterangan, 'MASUK' AS Kategori_Filter, NULL AS affected_ids_val, 1 AS urut_tipe", None))
+    kat_keluar = [k for k in ("PAKAI", "TRANSFER") if k in tipe]
+    if kat_keluar: cabang.append(("bbm_keluar", 2, f"id, tanggal, 'KELUAR' AS Tipe, CONCAT(nama_alat, ' ', no_unit) AS Detail, jumlah_liter, keterangan, {KATEGORI_KELUAR_SQL} AS Kategori_Filter, NULL AS affected_ids_val, 2 AS urut_tipe", kat_keluar if len(kat_keluar) == 1 else None))
+    if "KOREKSI" in tipe: cabang.append(("log_aktivitas", 3, "id, tanggal, 'LOG' AS Tipe, kategori AS Detail, 0 AS jumlah_liter, deskripsi AS keterangan, 'KOREKSI' AS Kategori_Filter, affected_ids AS affected_ids_val, 3 AS urut_tipe", None))
+
+    bagian = []; params = []
+    for i, (tabel, urut_tipe, kolom_select, kat) in enumerate(cabang):
+        where = ["lokasi_id = %s"]; params.append(lokasi_id)
+        if tanggal_filter is not None:
+            where.append("tanggal >= %s AND tanggal < %s"); params += [tanggal_filter, tanggal_filter + datetime.timedelta(days=1)]
+        if kat: where.append(f"{KATEGORI_KELUAR_SQL} = %s"); params.append(kat[0])
+        if kunci_cursor is not None:
+            sql_k, p_k = _kondisi_keyset(kolom, kunci_cursor, desc, urut_tipe); where.append(sql_k); params += p_k
+        bagian.append(f"SELECT * FROM (SELECT {kolom_select} FROM {tabel} WHERE {' AND '.join(where)} ORDER BY {order_by} LIMIT {int(limit) + 1}) AS h{i}")
+    if not bagian: return pd.DataFrame(), None
+
+    cursor = conn.cursor()
+    cursor.execute(" UNION ALL ".join(bagian) + f" ORDER BY {order_by} LIMIT {int(limit) + 1}", params)
+    df = pd.DataFrame(cursor.fetchall(), columns=[c[0] for c in cursor.description])
+    if df.empty: return df, None
+    # Baris ekstra (limit+1) hanya penanda ada halaman berikutnya
+    ada_berikutnya = len(df) > limit; df = df.head(limit).copy()
+    df['tanggal'] = pd.to_datetime(df['tanggal'])
+    terakhir = df.iloc[-1]
+    kunci_berikutnya = tuple(terakhir[k].to_pydatetime() if k == 'tanggal' else int(terakhir[k]) for k in kolom) if ada_berikutnya else None
+    return df, kunci_berikutnya
+
+def simpan_perubahan_history(conn, lokasi_id, df_asli, df_edit):
+    # Semua edit/hapus/undo dari grid riwayat dijalankan dalam satu transaksi
+    asli = df_asli.set_index(['Tipe', 'id']); edit = df_edit.set_index(['Tipe', 'id'])
+    ket_asli = asli['keterangan'].fillna('').astype(str); ket_edit = edit['keterangan'].fillna('').astype(str)
+    tgl_asli = pd.to_datetime(asli['tanggal']).dt.date; tgl_edit = pd.to_datetime(edit['tanggal']).dt.date
+    berubah = edit['Hapus'] | (tgl_edit != tgl_asli) | (ket_edit != ket_asli) | (edit['jumlah_liter'].astype(float) != asli['jumlah_liter'].astype(float))
+    edit = edit[berubah]
+    # Baris LOG hanya bisa di-undo; edit tanggal/keterangan/liter-nya tidak disimpan dan dihitung sebagai ditolak
+    log_diubah = (edit.index.get_level_values('Tipe') == 'LOG') & ~edit['Hapus']
+    ditolak = int(log_diubah.sum()); edit = edit[~log_diubah]
+    if edit.empty: return 0, 0, 0, ditolak
+
+    cursor = conn.cursor(); perubahan = []; mutasi = {}; n_update = n_hapus = n_undo = 0
+    try:
+        for tipe, tabel in [('MASUK', 'bbm_masuk'), ('KELUAR', 'bbm_keluar')]:
+            bagian = edit[edit.index.get_level_values('Tipe') == tipe]
+            if bagian.empty: continue
+            ids = [int(i) for i in bagian.index.get_level_values('id')]
+            cursor.execute(f"SELECT id, tanggal, jumlah_liter, keterangan FROM {tabel} WHERE lokasi_id=%s AND id IN ({','.join(['%s'] * len(ids))})", [lokasi_id] + ids)
+            lama = {r[0]: r for r in cursor.fetchall()}
+            arah = 1 if tabel == 'bbm_masuk' else -1; baris_update = []; baris_hapus = []
+            for (_, rid), row in bagian.iterrows():
+                if rid not in lama: continue
+                _, tg_lama, jl_lama, ket_lama = lama[rid]; jl_lama = float(jl_lama or 0)
+                bln_lama = pd.Timestamp(tg_lama).date().replace(day=1); mutasi[bln_lama] = mutasi.get(bln_lama, 0.0) - arah * jl_lama
+                if row['Hapus']:
+                    baris_hapus.append((rid,)); n_hapus += 1
+                else:
+                    tg_baru = pd.Timestamp(row['tanggal']).date(); jl_baru = float(row['jumlah_liter'])
+                    # Liter transfer dikunci sama seperti form edit, agar saldo pemberi & penerima tetap seimbang
+                    if tabel == 'bbm_keluar' and ("Transfer ke" in str(ket_lama) or "Pinjam dari" in str(ket_lama)) and jl_baru != jl_lama: jl_baru = jl_lama; ditolak += 1
+                    bln_baru = tg_baru.replace(day=1); mutasi[bln_baru] = mutasi.get(bln_baru, 0.0) + arah * jl_baru
+                    baris_update.append((tg_baru, jl_baru, row['keterangan'], rid)); n_update += 1
+                perubahan.append((tabel, rid))
+            if baris_update: cursor.executemany(f"UPDATE {tabel} SET tanggal=%s, jumlah_liter=%s, keterangan=%s WHERE id=%s", baris_update)
+            if baris_hapus: cursor.executemany(f"DELETE FROM {tabel} WHERE id=%s", baris_hapus)
+
+        log_undo = edit[(edit.index.get_level_values('Tipe') == 'LOG') & edit['Hapus']]
+        for (_, rid), row in log_undo.iterrows():
+            matches = re.findall(r"'(.*?)'", str(asli.loc[('LOG', rid), 'keterangan'])); affected_ids = asli.loc[('LOG', rid), 'affected_ids_val']
+            if len(matches) >= 2 and affected_ids:
+                field = "nama_alat" if "NAMA ALAT" in str(row['Detail']) else "no_unit"
+                cursor.execute(f"UPDATE bbm_keluar SET {field}=%s WHERE id IN ({affected_ids})", (matches[0],))
+                perubahan += [('bbm_keluar', int(i)) for i in str(affected_ids).split(',') if i.strip()]
+            perubahan.append(('log_aktivitas', rid)); n_undo += 1
+        if n_undo: cursor.executemany("DELETE FROM log_aktivitas WHERE id=%s", [(int(i),) for i in log_undo.index.get_level_values('id')])
+
+        # Snapshot cukup disesuaikan sekali per bulan terdampak
+        for bln, delta in sorted(mutasi.items()): update_stok_bulanan(cursor, lokasi_id, bln, round(delta, 6))
+        naikkan_versi_data(cursor, lokasi_id, perubahan); conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    return n_update, n_hapus, n_undo, ditolak
+
 # --- CHART GENERATOR ---
+# PNG grafik disimpan per proses dengan kunci hash seri hasil agregasi (label + nilai), ukuran, warna dan dpi.
+# Grafik identik (rerun dashboard, tiga format export) cukup dirender sekali.
+MAKS_CACHE_GRAFIK = 64 * 1024 * 1024 # byte
+
+@st.cache_resource
+def _cache_grafik():
+    return {'lock': threading.Lock(), 'data': OrderedDict(), 'ukuran': 0}
+
+def _grafik_tercache(kunci, gambar):
+    cache = _cache_grafik(); h = hashlib.sha256(repr(kunci).encode()).hexdigest()
+    with cache['lock']:
+        data = cache['data'].get(h)
+        if data is not None: cache['data'].move_to_end(h); return io.BytesIO(data)
+    data = gambar()
+    with cache['lock']:
+        if h not in cache['data']:
+            cache['data'][h] = data; cache['ukuran'] += len(data)
+            while cache['ukuran'] > MAKS_CACHE_GRAFIK and len(cache['data']) > 1:
+                _, lama = cache['data'].popitem(last=False); cache['ukuran'] -= len(lama)
+    return io.BytesIO(data)
+
+def _png_figure(fig):
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight')
+    return buf.getvalue()
+
+def _seri_pemakaian(df):
+    rekap = df.groupby(['nama_alat', 'no_unit'])['jumlah_liter'].sum().reset_index()
+    data = rekap.sort_values('jumlah_liter', ascending=True)
+    labels = data.apply(lambda x: f"{x['nama_alat']} {x['no_unit']}", axis=1)
+    return tuple(labels.tolist()), tuple(data['jumlah_liter'].tolist())
+
+def _gambar_pemakaian(active_charts, width_inch, height_inch):
+    num_charts = len(active_charts)
+    fig = Figure(figsize=(width_inch, height_inch * num_charts), dpi=150)
+    canvas = FigureCanvasAgg(fig)
+    axs = fig.subplots(num_charts, 1)
+    if num_charts == 1: axs = [axs]
+    for ax, (title, labels, values, color) in zip(axs, active_charts):
+        bars = ax.barh(list(labels), list(values), color=color, edgecolor='#555555', height=0.7)
+        ax.set_title(title, fontsize=10, fontweight='bold')
+        ax.tick_params(labelsize=8)
+        ax.xaxis.set_major_formatter(ticker.FuncFormatter(lambda x, p: format(int(x), ',')))
+        for bar in bars:
+            width = bar.get_width()
+            ax.text(width, bar.get_y() + bar.get_height()/2, f' {width:,.0f}', va='center', fontsize=8)
+    return _png_figure(fig)
+
+def _panel_pemakaian(df_alat, df_truck):
+    active_charts = []
+    if not df_alat.empty: active_charts.append(("PEMAKAIAN ALAT BERAT", *_seri_pemakaian(df_alat), '#F4B084'))
+    if not df_truck.empty: active_charts.append(("PEMAKAIAN MOBIL & TRUCK", *_seri_pemakaian(df_truck), '#9BC2E6'))
+    return active_charts
+
 def generate_chart_for_report(df_alat, df_truck, width_inch=6, height_inch=3):
     try:
-        active_charts = []
-        if not df_alat.empty: active_charts.append(("PEMAKAIAN ALAT BERAT", df_alat, '#F4B084'))
-        if not df_truck.empty: active_charts.append(("PEMAKAIAN MOBIL & TRUCK", df_truck, '#9BC2E6'))
-        
-        num_charts = len(active_charts)
-        if num_charts == 0: return None
-        
-        total_height = height_inch * num_charts
-        fig = Figure(figsize=(width_inch, total_height), dpi=150)
-        canvas = FigureCanvasAgg(fig)
-        axs = fig.subplots(num_charts, 1)
-        if num_charts == 1: axs = [axs]
-        
-        for i, (title, df, color) in enumerate(active_charts):
-            ax = axs[i]
-            rekap = df.groupby(['nama_alat', 'no_unit'])['jumlah_liter'].sum().reset_index()
-            data = rekap.sort_values('jumlah_liter', ascending=True)
-            labels = data.apply(lambda x: f"{x['nama_alat']} {x['no_unit']}", axis=1)
-            bars = ax.barh(labels, data['jumlah_liter'], color=color, edgecolor='#555555', height=0.7)
-            ax.set_title(title, fontsize=10, fontweight='bold')
-            ax.tick_params(labelsize=8)
-            ax.xaxis.set_major_formatter(ticker.FuncFormatter(lambda x, p: format(int(x), ',')))
-            for bar in bars:
-                width = bar.get_width()
-                ax.text(width, bar.get_y() + bar.get_height()/2, f' {width:,.0f}', va='center', fontsize=8)
-
-        fig.tight_layout()
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', bbox_inches='tight')
-        buf.seek(0)
-        return buf
+        active_charts = _panel_pemakaian(df_alat, df_truck)
+        if not active_charts: return None
+        return _grafik_tercache(('pemakaian', width_inch, height_inch, 150, tuple(active_charts)), lambda: _gambar_pemakaian(active_charts, width_inch, height_inch))
     except: return None
 
+def _seri_bulanan(df_monthly):
+    masuk_vals = tuple(pd.to_numeric(df_monthly['masuk'], errors='coerce').fillna(0).tolist())
+    keluar_vals = tuple(pd.to_numeric(df_monthly['keluar'], errors='coerce').fillna(0).tolist())
+    return tuple(df_monthly['bulan_nama'].astype(str).tolist()), masuk_vals, keluar_vals
+
+def _gambar_bulanan(labels, masuk_vals, keluar_vals):
+    fig = Figure(figsize=(8, 4), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    x = range(len(labels))
+    width = 0.35
+    ax.bar([i - width/2 for i in x], list(masuk_vals), width, label='Masuk', color='#90EE90', edgecolor='black')
+    ax.bar([i + width/2 for i in x], list(keluar_vals), width, label='Keluar', color='#F08080', edgecolor='black')
+    ax.set_title('GRAFIK MASUK & PENGGUNAAN BBM PER BULAN', fontsize=10, fontweight='bold')
+    ax.set_xticks(x)
+    ax.set_xticklabels(list(labels), fontsize=8)
+    ax.legend(fontsize=8)
+    ax.yaxis.set_major_formatter(ticker.FuncFormatter(lambda x, p: format(int(x), ',')))
+    ax.tick_params(labelsize=8)
+    return _png_figure(fig)
+
 def generate_monthly_chart(df_monthly):
     try:
         if df_monthly.empty: return None
-        masuk_vals = pd.to_numeric(df_monthly['masuk'], errors='coerce').fillna(0)
-        keluar_vals = pd.to_numeric(df_monthly['keluar'], errors='coerce').fillna(0)
-        labels = df_monthly['bulan_nama'].astype(str).tolist()
-
-        fig = Figure(figsize=(8, 4), dpi=100)
-        canvas = FigureCanvasAgg(fig)
-        ax = fig.add_subplot(111)
-        x = range(len(labels))
-        width = 0.35
-        ax.bar([i - width/2 for i in x], masuk_vals, width, label='Masuk', color='#90EE90', edgecolor='black')
-        ax.bar([i + width/2 for i in x], keluar_vals, width, label='Keluar', color='#F08080', edgecolor='black')
-        ax.set_title('GRAFIK MASUK & PENGGUNAAN BBM PER BULAN', fontsize=10, fontweight='bold')
-        ax.set_xticks(x)
-        ax.set_xticklabels(labels, fontsize=8)
-        ax.legend(fontsize=8)
-        ax.yaxis.set_major_formatter(ticker.FuncFormatter(lambda x, p: format(int(x), ',')))
-        ax.tick_params(labelsize=8)
-        fig.tight_layout()
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', bbox_inches='tight')
-        buf.seek(0)
-        return buf
+        labels, masuk_vals, keluar_vals = _seri_bulanan(df_monthly)
+        return _grafik_tercache(('bulanan', 8, 4, 100, labels, masuk_vals, keluar_vals), lambda: _gambar_bulanan(labels, masuk_vals, keluar_vals))
+    except: return None
+
+# --- MODEL LAPORAN ---
+# Data laporan dihitung sekali per (lokasi, rentang, excluded_list); generator PDF/Excel/DOCX tinggal render
+KOLOM_MASUK_LAPORAN = "id, tanggal, sumber, jenis_bbm, jumlah_liter, keterangan"
+KOLOM_KELUAR_LAPORAN = "id, tanggal, nama_alat, no_unit, jumlah_liter, keterangan"
+
+def _potong_per_bulan(df, batas):
+    # df sudah urut tanggal; batas = awal tiap periode + (akhir periode terakhir + 1 hari)
+    tgl = pd.to_datetime(df['tanggal']).to_numpy()
+    pos = np.searchsorted(tgl, pd.to_datetime(pd.Series(batas)).to_numpy(), side='left')
+    return [df.iloc[a:b].reset_index(drop=True) for a, b in zip(pos[:-1], pos[1:])]
+
+def bangun_model_laporan(conn, lokasi_id, start_date_global, end_date_global, excluded_list):
+    # Satu query per tabel untuk seluruh rentang, lalu dipotong per bulan di memori
+    df_masuk_all = pd.read_sql(f"SELECT {KOLOM_MASUK_LAPORAN} FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date_global}' AND '{end_date_global}' ORDER BY tanggal, id", conn)
+    df_keluar_all = pd.read_sql(f"SELECT {KOLOM_KELUAR_LAPORAN} FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date_global}' AND '{end_date_global}' ORDER BY tanggal, id", conn)
+    return susun_model_laporan(df_masuk_all, df_keluar_all, hitung_stok_awal_periode(conn, lokasi_id, start_date_global), hitung_rekap_bulanan(conn, lokasi_id, start_date_global, end_date_global),
+                               start_date_global, end_date_global, excluded_list)
+
+def susun_model_laporan(df_masuk_all, df_keluar_all, stok_awal, rekap, start_date_global, end_date_global, excluded_list):
+    # Bagian tanpa database (dipakai juga oleh bench_pdf.py dengan data sintetis)
+    periode = split_date_range_by_month(start_date_global, end_date_global)
+    batas = [s for s, _ in periode] + [end_date_global + datetime.timedelta(days=1)]
+    if not df_keluar_all.empty: df_keluar_all['kategori'] = df_keluar_all['nama_alat'].apply(cek_kategori)
+
+    bulan = []
+    for (start_date, end_date), df_masuk, df_keluar in zip(periode, _potong_per_bulan(df_masuk_all, batas), _potong_per_bulan(df_keluar_all, batas)):
+        df_keluar_raw = filter_non_consumption(df_keluar)
+        df_keluar_table = process_transfers_for_table(df_keluar_raw)
+        df_alat_g, df_truck_g, df_lain_g = segregate_data(df_keluar_table, excluded_list)
+        df_alat_chart, df_truck_chart, _ = segregate_data(df_keluar_raw, excluded_list)
+
+        tm = float(df_masuk['jumlah_liter'].sum()) if not df_masuk.empty else 0.0
+        tk_real = float(df_keluar['jumlah_liter'].sum()) if not df_keluar.empty else 0.0
+        tk_rpt = float(df_keluar_table['jumlah_liter'].sum()) if not df_keluar_table.empty else 0.0
+        bulan.append({
+            'start': start_date, 'end': end_date, 'stok_awal': stok_awal, 'df_masuk': df_masuk, 'df_keluar': df_keluar, 'df_keluar_table': df_keluar_table,
+            'alat_g': df_alat_g, 'truck_g': df_truck_g, 'lain_g': df_lain_g, 'alat_chart': df_alat_chart, 'truck_chart': df_truck_chart,
+            'tm': tm, 'tk_real': tk_real, 'tk_rpt': tk_rpt, 'sisa_akhir': stok_awal + tm - tk_real,
+            'items': prepare_data_global_subtotals(df_keluar_table), 'grafik': {},
+        })
+        # Sisa akhir bulan ini = stok awal bulan berikutnya (sama seperti stok_run di hitung_rekap_bulanan)
+        stok_awal = stok_awal + tm - tk_real
+
+    df_alat_t, df_truck_t, _ = segregate_data(filter_non_consumption(df_keluar_all), excluded_list)
+    return {'bulan': bulan, 'rekap': rekap, 'alat_total': df_alat_t, 'truck_total': df_truck_t, 'grafik': {}}
+
+def _grafik_memo(wadah, kunci, buat):
+    # PNG disimpan sebagai bytes; tiap pemanggil dapat BytesIO baru (RLImage/add_picture membaca stream sendiri)
+    if kunci not in wadah['grafik']:
+        buf = buat(); wadah['grafik'][kunci] = buf.getvalue() if buf else None
+    data = wadah['grafik'][kunci]
+    return io.BytesIO(data) if data else None
+
+def grafik_bulan(sec, width_inch, height_inch):
+    return _grafik_memo(sec, (width_inch, height_inch), lambda: generate_chart_for_report(sec['alat_chart'], sec['truck_chart'], width_inch=width_inch, height_inch=height_inch))
+
+def grafik_pemakaian_total(model, width_inch, height_inch):
+    return _grafik_memo(model, (width_inch, height_inch), lambda: generate_chart_for_report(model['alat_total'], model['truck_total'], width_inch=width_inch, height_inch=height_inch))
+
+def grafik_rekap_bulanan(model):
+    return _grafik_memo(model, 'rekap', lambda: generate_monthly_chart(pd.DataFrame(model['rekap'])))
+
+# --- GRAFIK VEKTOR (PDF) ---
+# PDF menggambar grafik langsung dengan reportlab.graphics (tanpa matplotlib/PNG): render jauh lebih cepat, file kecil, tajam saat di-zoom.
+# Drawing dibuat seukuran kotak tujuan di halaman. Set False untuk kembali ke PNG matplotlib.
+GRAFIK_PDF_VEKTOR = True
+
+def _format_ribuan(v): return format(int(v), ',')
+
+def _vektor_pemakaian(active_charts, width, height):
+    d = Drawing(width, height); tinggi_panel = height / len(active_charts)
+    for i, (title, labels, values, color) in enumerate(active_charts):
+        y0 = height - (i + 1) * tinggi_panel
+        d.add(String(width / 2, y0 + tinggi_panel - 9, title, fontName='Helvetica-Bold', fontSize=7, textAnchor='middle'))
+        bc = HorizontalBarChart(); bc.x = width * 0.32; bc.y = y0 + 12; bc.width = width * 0.56; bc.height = tinggi_panel - 26
+        fs = max(3, min(6, bc.height / max(len(labels), 1) * 0.8))
+        bc.data = [list(values)]; bc.categoryAxis.categoryNames = list(labels)
+        bc.categoryAxis.labels.fontSize = fs; bc.categoryAxis.labels.boxAnchor = 'e'; bc.categoryAxis.labels.dx = -2
+        bc.valueAxis.forceZero = 1; bc.valueAxis.labels.fontSize = 5; bc.valueAxis.labelTextFormat = _format_ribuan
+        bc.bars[0].fillColor = colors.HexColor(color); bc.bars[0].strokeColor = colors.HexColor('#555555'); bc.bars[0].strokeWidth = 0.3
+        bc.barLabelFormat = lambda v: f' {v:,.0f}'; bc.barLabels.fontSize = fs; bc.barLabels.boxAnchor = 'w'; bc.barLabels.dx = 1
+        d.add(bc)
+    return d
+
+def _vektor_bulanan(labels, masuk_vals, keluar_vals, width, height):
+    d = Drawing(width, height)
+    d.add(String(width / 2, height - 10, 'GRAFIK MASUK & PENGGUNAAN BBM PER BULAN', fontName='Helvetica-Bold', fontSize=8, textAnchor='middle'))
+    bc = VerticalBarChart(); bc.x = 45; bc.y = 30; bc.width = width - 60; bc.height = height - 62
+    bc.data = [list(masuk_vals), list(keluar_vals)]; bc.categoryAxis.categoryNames = list(labels)
+    bc.categoryAxis.labels.fontSize = 6; bc.categoryAxis.labels.angle = 30; bc.categoryAxis.labels.boxAnchor = 'ne'
+    bc.valueAxis.forceZero = 1; bc.valueAxis.labels.fontSize = 6; bc.valueAxis.labelTextFormat = _format_ribuan
+    for i, warna in enumerate(['#90EE90', '#F08080']): bc.bars[i].fillColor = colors.HexColor(warna); bc.bars[i].strokeColor = colors.black; bc.bars[i].strokeWidth = 0.3
+    d.add(bc)
+    lg = Legend(); lg.x = width - 110; lg.y = height - 20; lg.alignment = 'right'; lg.columnMaximum = 1; lg.fontSize = 6; lg.dx = 6; lg.dy = 6; lg.dxTextSpace = 3; lg.deltax = 45
+    lg.colorNamePairs = [(colors.HexColor('#90EE90'), 'Masuk'), (colors.HexColor('#F08080'), 'Keluar')]
+    d.add(lg)
+    return d
+
+def _flowable_grafik(vektor, png, width, height):
+    try:
+        if GRAFIK_PDF_VEKTOR: return vektor(width, height)
+        buf = png()
+        return RLImage(buf, width=width, height=height) if buf else None
     except: return None
 
+def grafik_pdf_bulan(sec, width, height):
+    charts = _panel_pemakaian(sec['alat_chart'], sec['truck_chart'])
+    if not charts: return None
+    return _flowable_grafik(lambda w, h: _vektor_pemakaian(charts, w, h), lambda: grafik_bulan(sec, 3.5, 2.5), width, height)
+
+def grafik_pdf_total(model, width, height):
+    charts = _panel_pemakaian(model['alat_total'], model['truck_total'])
+    if not charts: return None
+    return _flowable_grafik(lambda w, h: _vektor_pemakaian(charts, w, h), lambda: grafik_pemakaian_total(model, 7, 3.5), width, height)
+
+def grafik_pdf_rekap(model, width, height):
+    df = pd.DataFrame(model['rekap'])
+    if df.empty: return None
+    return _flowable_grafik(lambda w, h: _vektor_bulanan(*_seri_bulanan(df), w, h), lambda: grafik_rekap_bulanan(model), width, height)
+
+# --- TABEL PDF CEPAT ---
+# Sel pendek (muat satu baris, tanpa markup/spasi ganda) ditulis sebagai string biasa dengan FONT ukuran & leading yang
+# sama dengan Paragraph-nya -> baseline identik, tanpa parse & wrap Paragraph. Yang perlu wrap tetap Paragraph.
+def sel_pdf(teks, style, lebar_kolom, padding=12):
+    if re.search(r'[<>&\t\r\n]|\s\s|^\s|\s$', teks) or stringWidth(teks, style.fontName, style.fontSize) > lebar_kolom - padding: return Paragraph(teks, style)
+    return teks
+
+def font_sel_pdf(style, c0, c1, r): return ('FONT', (c0, r), (c1, r), style.fontName, style.fontSize, style.leading)
+
+# Perintah TableStyle per baris yang identik dan bersambung digabung jadi satu perintah rentang (SPAN tetap per baris)
+def ringkas_gaya_tabel(perintah):
+    hasil = []; terakhir = {}
+    for cmd in perintah:
+        nama, (c0, r0), (c1, r1), *arg = cmd
+        if nama == 'SPAN' or r0 != r1 or r0 < 0: hasil.append(cmd); continue
+        kunci = (nama, c0, c1, tuple(map(str, arg))); i = terakhir.get(kunci)
+        if i is not None and hasil[i][2][1] == r0 - 1: hasil[i] = (nama, hasil[i][1], (c1, r0), *arg)
+        else: terakhir[kunci] = len(hasil); hasil.append(cmd)
+    return hasil
+
+# --- EXCEL STREAMING ---
+# Workbook write-only: tiap sheet disusun di buffer baris {baris: {kolom: (nilai, style)}} lalu ditulis berurutan,
+# jadi memori cukup untuk satu sheet. Format sel memakai NamedStyle yang didaftarkan sekali per workbook.
+GARIS_TIPIS = Border(left=Side('thin'), right=Side('thin'), top=Side('thin'), bottom=Side('thin'))
+GAYA_EXCEL = {
+    'tebal': dict(font=Font(bold=True)),
+    'tebal_grid': dict(font=Font(bold=True), border=GARIS_TIPIS),
+    'judul': dict(font=Font(bold=True, size=14), alignment=Alignment(horizontal='center')),
+    'judul_kiri': dict(font=Font(bold=True, size=14)),
+    'periode': dict(font=Font(size=12), alignment=Alignment(horizontal='center')),
+    'periode_tebal': dict(font=Font(size=12, bold=True), alignment=Alignment(horizontal='center')),
+    'grid': dict(border=GARIS_TIPIS),
+    'header_abu': dict(border=GARIS_TIPIS, fill=PatternFill("solid", fgColor="D3D3D3"), alignment=Alignment(horizontal='center')),
+    'header_abu_kiri': dict(border=GARIS_TIPIS, fill=PatternFill("solid", fgColor="D3D3D3")),
+    'header_biru': dict(fill=PatternFill("solid", fgColor="2F5496"), font=Font(color="FFFFFF", bold=True), alignment=Alignment(horizontal='center')),
+    'header_biru_grid': dict(fill=PatternFill("solid", fgColor="2F5496"), font=Font(color="FFFFFF", bold=True), border=GARIS_TIPIS),
+    'data': dict(border=GARIS_TIPIS, alignment=Alignment(wrap_text=True, vertical='center')),
+    'data_zebra': dict(border=GARIS_TIPIS, alignment=Alignment(wrap_text=True, vertical='center'), fill=PatternFill("solid", fgColor="F2F2F2")),
+    'data_wrap': dict(border=GARIS_TIPIS, alignment=Alignment(wrap_text=True)),
+    'total_harian': dict(font=Font(bold=True), fill=PatternFill("solid", fgColor="F8CBAD"), border=GARIS_TIPIS),
+    'total_kuning': dict(font=Font(bold=True), fill=PatternFill("solid", fgColor="FFFF00"), border=GARIS_TIPIS),
+    'hijau': dict(fill=PatternFill("solid", fgColor="00FF00"), border=GARIS_TIPIS),
+    'total_rekap': dict(fill=PatternFill("solid", fgColor="FFD966"), border=GARIS_TIPIS),
+    'total_rekap_tebal': dict(font=Font(bold=True), fill=PatternFill("solid", fgColor="FFD966"), border=GARIS_TIPIS),
+}
+WARNA_RINCIAN = ['F4B084', '9BC2E6', 'FFB6C1']
+GAYA_EXCEL.update({f'rinci_{w}': dict(font=Font(bold=True), fill=PatternFill("solid", fgColor=w), border=GARIS_TIPIS, alignment=Alignment(horizontal='center')) for w in WARNA_RINCIAN})
+GAYA_EXCEL.update({f'panel_{w}': dict(font=Font(bold=True), fill=PatternFill("solid", fgColor=w), border=GARIS_TIPIS) for w in WARNA_RINCIAN})
+
+def workbook_stream():
+    wb = Workbook(write_only=True)
+    for nama, g in GAYA_EXCEL.items(): wb.add_named_style(NamedStyle(name=nama, **{'font': DEFAULT_FONT, **g}))
+    return wb
+
+def lembar_baru(): return {'sel': {}, 'merge': []}
+
+def tulis(L, r, c, v=None, gaya=None): L['sel'].setdefault(r, {})[c] = (v, gaya)
+
+def gaya_sel(L, r, c, gaya): tulis(L, r, c, L['sel'].get(r, {}).get(c, (None, None))[0], gaya)
+
+def gabung(L, r1, c1, r2, c2): L['merge'].append(f"{get_column_letter(c1)}{r1}:{get_column_letter(c2)}{r2}")
+
+def tulis_sheet(ws, L, lebar):
+    # Lebar kolom & merge harus diset sebelum baris pertama ditulis (write-only)
+    for kol, w in lebar.items(): ws.column_dimensions[kol].width = w
+    for rng in L['merge']: ws.merged_cells.add(rng)
+    for r in range(1, max(L['sel'], default=0) + 1):
+        baris = L['sel'].pop(r, {}); row = [None] * max(baris, default=0)
+        for c, (v, gaya) in baris.items():
+            if gaya is None: row[c-1] = v
+            else: cell = WriteOnlyCell(ws, v); cell.style = gaya; row[c-1] = cell
+        ws.append(row)
+
+# --- GRAFIK NATIVE EXCEL ---
+# Grafik di export Excel adalah BarChart openpyxl yang merujuk sel rekap di sheet (bukan PNG matplotlib):
+# tidak ada render gambar, file lebih kecil, dan penerima bisa memfilter / mengubah grafiknya.
+def _rapikan_chart_excel(ch):
+    # Label kategori berupa teks (strRef, bukan numRef bawaan openpyxl); sumbu ditampilkan eksplisit
+    for sr in ch.series: sr.cat = AxDataSource(strRef=StrRef(f=sr.cat.numRef.f))
+    ch.x_axis.delete = False; ch.y_axis.delete = False; ch.y_axis.numFmt = '#,##0'
+    return ch
+
+def bar_chart_excel(ws, judul, kolom_label, kolom_nilai, baris_awal, baris_akhir, warna, horizontal=True, lebar=12, tinggi=7):
+    ch = BarChart(); ch.type = 'bar' if horizontal else 'col'; ch.title = judul; ch.legend = None; ch.width = lebar; ch.height = tinggi
+    ch.add_data(Reference(ws, min_col=kolom_nilai, min_row=baris_awal, max_row=baris_akhir))
+    ch.set_categories(Reference(ws, min_col=kolom_label, min_row=baris_awal, max_row=baris_akhir))
+    ch.series[0].graphicalProperties.solidFill = warna; ch.series[0].graphicalProperties.line.solidFill = '555555'
+    ch.dataLabels = DataLabelList(); ch.dataLabels.showVal = True; ch.y_axis.majorGridlines = None
+    return _rapikan_chart_excel(ch)
+
+def tinggi_chart_excel(n_baris): return max(5, 2.5 + 0.55 * n_baris) # cm
+
+def tambah_chart_pemakaian(ws, seri, baris, kolom='I'):
+    # seri = [(judul, baris_awal, baris_akhir, warna)] dari tabel rincian pemakaian; label di kolom I, liter di kolom L
+    for judul, a, b, warna in seri:
+        tinggi = tinggi_chart_excel(b - a + 1)
+        ws.add_chart(bar_chart_excel(ws, judul, 9, 12, a, b, warna, tinggi=tinggi), f'{kolom}{baris}')
+        baris += int(tinggi / 0.53) + 2
+    return baris
+
+def sheet_rekap_excel(wb, model):
+    ws2 = wb.create_sheet("Rekap Tahunan"); L = lembar_baru()
+    tulis(L, 1, 1, "LAPORAN BBM PERBULAN", 'judul_kiri')
+    m_data = model['rekap']
+    r2 = 18; headers = ['BULAN', 'SISA BULAN LALU', 'MASUK', 'KELUAR', 'SISA']
+    for i, h in enumerate(headers): tulis(L, r2, i+1, h, 'header_abu_kiri')
+    r2+=1
+    for r in m_data:
+        vals = [r['bln'], r['awal'], r['masuk'], r['keluar'], r['sisa']]
+        for i, v in enumerate(vals): tulis(L, r2, i+1, v, 'grid')
+        r2+=1
+    if m_data:
+        ch = BarChart(); ch.type = 'col'; ch.title = 'GRAFIK MASUK & PENGGUNAAN BBM PER BULAN'; ch.width = 13; ch.height = 7
+        ch.add_data(Reference(ws2, min_col=3, max_col=4, min_row=18, max_row=r2-1), titles_from_data=True)
+        ch.set_categories(Reference(ws2, min_col=1, min_row=19, max_row=r2-1))
+        for sr, warna in zip(ch.series, ['90EE90', 'F08080']): sr.graphicalProperties.solidFill = warna; sr.graphicalProperties.line.solidFill = '000000'
+        ws2.add_chart(_rapikan_chart_excel(ch), 'A3')
+        t_masuk = sum(x['masuk'] for x in m_data); t_keluar = sum(x['keluar'] for x in m_data); akhir = m_data[-1]['sisa']
+        tulis(L, r2, 1, "TOTAL", 'total_rekap_tebal'); tulis(L, r2, 2, None, 'total_rekap'); tulis(L, r2, 3, t_masuk, 'total_rekap_tebal'); tulis(L, r2, 4, t_keluar, 'total_rekap_tebal'); tulis(L, r2, 5, akhir, 'total_rekap_tebal')
+
+    # Sumber data grafik pemakaian total (per unit, seluruh periode) ditulis di kolom H:I, grafiknya di atas tabel
+    r3 = 18; kolom_chart = ['H', 'P']
+    for (judul, labels, values, warna) in _panel_pemakaian(model['alat_total'], model['truck_total']):
+        tulis(L, r3, 8, judul, f'panel_{warna[1:]}'); tulis(L, r3, 9, 'LTR', f'panel_{warna[1:]}')
+        for i, (lbl, val) in enumerate(zip(labels, values)): tulis(L, r3+1+i, 8, lbl, 'grid'); tulis(L, r3+1+i, 9, float(val), 'grid')
+        ws2.add_chart(bar_chart_excel(ws2, judul, 8, 9, r3+1, r3+len(labels), warna[1:], tinggi=7), f'{kolom_chart.pop(0)}3')
+        r3 += len(labels) + 2
+    tulis_sheet(ws2, L, {'A': 25, 'B': 20, 'C': 20, 'D': 20, 'E': 20, 'H': 30, 'I': 15})
+
+# --- BUFFER OUTPUT EXPORT ---
+# Dokumen ditulis ke SpooledTemporaryFile: di memori sampai BATAS_SPOOL_EXPORT, di atasnya pindah ke file temp tanpa nama
+# (hilang sendiri saat ditutup). Pemanggil menutup buffer setelah isinya disalin (salin_ke_file / with).
+BATAS_SPOOL_EXPORT = 16 * 1024 * 1024 # byte
+
+def buffer_export(): return tempfile.SpooledTemporaryFile(max_size=BATAS_SPOOL_EXPORT, mode='w+b')
+
+def salin_ke_file(sumber, path):
+    with sumber, open(path, 'wb') as f: shutil.copyfileobj(sumber, f)
+
 # ==========================================
 # EXPORT GENERATORS
 # ==========================================
-def generate_pdf_portrait(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list):
-    buffer = io.BytesIO()
+def generate_pdf_portrait(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, model=None, progres=None):
+    if model is None: model = bangun_model_laporan(conn, lokasi_id, start_date_global, end_date_global, excluded_list)
+    buffer = buffer_export()
     doc = SimpleDocTemplate(buffer, pagesize=portrait(A4), rightMargin=15, leftMargin=15, topMargin=20, bottomMargin=20)
     elements = []
     styles = getSampleStyleSheet()
@@ -290,31 +981,19 @@ def generate_pdf_portrait(conn, lokasi_id, nama_lokasi, start_date_global, end_d
     header_black_style = ParagraphStyle(name='HeaderTxtBlk', parent=styles['Normal'], fontSize=7, leading=8, fontName='Helvetica-Bold', textColor=colors.black, alignment=TA_CENTER)
     section_title_style = ParagraphStyle(name='SectionTitle', parent=styles['Normal'], fontSize=8, leading=9, fontName='Helvetica-Bold', textColor=colors.HexColor("#2F5496"))
     
-    date_ranges = split_date_range_by_month(start_date_global, end_date_global)
-    for idx, (start_date, end_date) in enumerate(date_ranges):
+    for idx, sec in enumerate(model['bulan']):
+        if progres: progres()
         if idx > 0: elements.append(PageBreak())
-        stok_awal = hitung_stok_awal_periode(conn, lokasi_id, start_date)
-        df_masuk = pd.read_sql(f"SELECT * FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
-        df_keluar = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
-        if not df_keluar.empty and 'kategori' not in df_keluar.columns: df_keluar['kategori'] = df_keluar['nama_alat'].apply(cek_kategori)
-        
-        df_keluar_raw = filter_non_consumption(df_keluar)
-        df_keluar_table = process_transfers_for_table(df_keluar_raw)
-        df_alat_g, df_truck_g, df_lain_g = segregate_data(df_keluar_table, excluded_list)
-        df_alat_chart, df_truck_chart, _ = segregate_data(df_keluar_raw, excluded_list)
-
-        tm = float(df_masuk['jumlah_liter'].sum()) if not df_masuk.empty else 0.0
-        tk_real = float(df_keluar['jumlah_liter'].sum()) if not df_keluar.empty else 0.0
-        tk_rpt = float(df_keluar_table['jumlah_liter'].sum()) if not df_keluar_table.empty else 0.0
-        sisa_akhir = stok_awal + tm - tk_real
+        start_date = sec['start']; stok_awal = sec['stok_awal']; df_masuk = sec['df_masuk']
+        df_alat_g, df_truck_g, df_lain_g = sec['alat_g'], sec['truck_g'], sec['lain_g']
+        tm, tk_real, tk_rpt, sisa_akhir = sec['tm'], sec['tk_real'], sec['tk_rpt'], sec['sisa_akhir']
 
         elements.append(Paragraph("LAPORAN BBM", title_style))
         elements.append(Paragraph(nama_lokasi, title_style))
         elements.append(Paragraph(f"PERIODE {get_bulan_indonesia(start_date.month)} {start_date.year}", periode_style))
-        
-        left_queue = []; left_queue.append({'type': 'title_section', 'val': 'PENGGUNAAN BBM (KELUAR)'}); left_queue.append({'type': 'header_col'}) 
-        processed_data = prepare_data_global_subtotals(df_keluar_table)
-        for item in processed_data:
+
+        left_queue = []; left_queue.append({'type': 'title_section', 'val': 'PENGGUNAAN BBM (KELUAR)'}); left_queue.append({'type': 'header_col'})
+        for item in sec['items']:
             if item['type'] == 'data': left_queue.append({'type': 'row', 'data': [item['no'], item['tanggal'].strftime('%d/%m'), item['nama_alat'], item['no_unit'], f"{item['jumlah_liter']:.0f}", item['keterangan']], 'date_val': item['tanggal']})
             elif item['type'] == 'daily_total': left_queue.append({'type': 'daily_total', 'date_str': item['tanggal'].strftime('%d/%m/%Y'), 'val': f"{item['total_liter']:.0f}"})
         left_queue.append({'type': 'total_left', 'val': f"{tk_rpt:.0f}"})
@@ -341,10 +1020,8 @@ def generate_pdf_portrait(conn, lokasi_id, nama_lokasi, start_date_global, end_d
         right_queue.append({'type': 'row_stok', 'label': 'SISA BULAN LALU', 'val': f"{stok_awal:.0f}"}); right_queue.append({'type': 'row_stok', 'label': 'TOTAL MASUK', 'val': f"{tm:.0f}"})
         right_queue.append({'type': 'row_stok', 'label': 'TOTAL KELUAR', 'val': f"{tk_real:.0f}"}); right_queue.append({'type': 'total_stok', 'label': 'SISA AKHIR', 'val': f"{sisa_akhir:.0f}"})
         
-        img_buf = generate_chart_for_report(df_alat_chart, df_truck_chart, width_inch=3.5, height_inch=2.5)
-        if img_buf: 
-            num_charts = (1 if not df_alat_chart.empty else 0) + (1 if not df_truck_chart.empty else 0)
-            right_queue.append({'type': 'chart', 'img': img_buf, 'span': 15 * num_charts})
+        num_charts = (1 if not sec['alat_chart'].empty else 0) + (1 if not sec['truck_chart'].empty else 0)
+        if num_charts: right_queue.append({'type': 'chart', 'sec': sec, 'span': 15 * num_charts})
 
         ROWS_PER_PAGE = 40; ROW_HEIGHT = 15; l_ptr = 0; r_ptr = 0; right_occupied_until = -1
         last_date_zebra = None; is_zebra_grey = False 
@@ -361,7 +1038,8 @@ def generate_pdf_portrait(conn, lokasi_id, nama_lokasi, start_date_global, end_d
                         for c, txt in enumerate(cols): row_content[c] = Paragraph(txt, header_style)
                         page_style.append(('BACKGROUND', (0, row_idx), (5, row_idx), COLOR_HEADER_BLUE)); page_style.append(('GRID', (0, row_idx), (5, row_idx), 0.5, COLOR_BORDER))
                     elif itype == 'row':
-                        d = item['data']; row_content[0] = d[0]; row_content[1] = d[1]; row_content[2] = Paragraph(safe_text(d[2], 25), cell_style); row_content[3] = Paragraph(safe_text(d[3], 15), cell_style); row_content[4] = d[4]; row_content[5] = Paragraph(safe_text(d[5], 25), cell_style)
+                        d = item['data']; row_content[0] = d[0]; row_content[1] = d[1]; row_content[2] = sel_pdf(safe_text(d[2], 25), cell_style, 80); row_content[3] = sel_pdf(safe_text(d[3], 15), cell_style, 40); row_content[4] = d[4]; row_content[5] = sel_pdf(safe_text(d[5], 25), cell_style, 80)
+                        page_style.append(font_sel_pdf(cell_style, 2, 3, row_idx)); page_style.append(font_sel_pdf(cell_style, 5, 5, row_idx))
                         curr_date = item.get('date_val')
                         if last_date_zebra is not None and curr_date != last_date_zebra: is_zebra_grey = not is_zebra_grey
                         last_date_zebra = curr_date; bg = COLOR_ROW_EVEN if is_zebra_grey else COLOR_ROW_ODD
@@ -380,10 +1058,10 @@ def generate_pdf_portrait(conn, lokasi_id, nama_lokasi, start_date_global, end_d
                         cols = ['NO', 'TGL', 'SUMBER', 'JNS', 'LTR']
                         for c, txt in enumerate(cols): row_content[7+c] = Paragraph(txt, header_style)
                         page_style.append(('BACKGROUND', (7, row_idx), (11, row_idx), COLOR_HEADER_BLUE)); page_style.append(('GRID', (7, row_idx), (11, row_idx), 0.5, COLOR_BORDER))
-                    elif itype == 'row_masuk': d = item['data']; row_content[7] = d[0]; row_content[8] = d[1]; row_content[9] = Paragraph(safe_text(d[2]), cell_style); row_content[10] = d[3]; row_content[11] = d[4]; page_style.append(('GRID', (7, row_idx), (11, row_idx), 0.5, COLOR_BORDER))
+                    elif itype == 'row_masuk': d = item['data']; row_content[7] = d[0]; row_content[8] = d[1]; row_content[9] = sel_pdf(safe_text(d[2]), cell_style, 80); row_content[10] = d[3]; row_content[11] = d[4]; page_style.append(font_sel_pdf(cell_style, 9, 9, row_idx)); page_style.append(('GRID', (7, row_idx), (11, row_idx), 0.5, COLOR_BORDER))
                     elif itype == 'total_masuk': row_content[7] = 'TOTAL MASUK'; row_content[11] = item['val']; page_style.append(('SPAN', (7, row_idx), (10, row_idx))); page_style.append(('BACKGROUND', (7, row_idx), (11, row_idx), COLOR_TOTAL_YELLOW)); page_style.append(('FONTNAME', (7, row_idx), (11, row_idx), 'Helvetica-Bold')); page_style.append(('GRID', (7, row_idx), (11, row_idx), 0.5, COLOR_BORDER))
                     elif itype == 'sub_rekap': style_to_use = header_black_style if item.get('txt_black') else header_style; row_content[7] = Paragraph(item['title'], style_to_use); bg = colors.HexColor(item['bg']); page_style.append(('SPAN', (7, row_idx), (11, row_idx))); page_style.append(('BACKGROUND', (7, row_idx), (11, row_idx), bg)); page_style.append(('GRID', (7, row_idx), (11, row_idx), 0.5, COLOR_BORDER))
-                    elif itype == 'row_rekap': row_content[7] = Paragraph(safe_text(item['label'], 35), cell_style); row_content[11] = item['val']; page_style.append(('SPAN', (7, row_idx), (10, row_idx))); page_style.append(('GRID', (7, row_idx), (11, row_idx), 0.5, COLOR_BORDER))
+                    elif itype == 'row_rekap': row_content[7] = sel_pdf(safe_text(item['label'], 35), cell_style, 170); row_content[11] = item['val']; page_style.append(font_sel_pdf(cell_style, 7, 7, row_idx)); page_style.append(('SPAN', (7, row_idx), (10, row_idx))); page_style.append(('GRID', (7, row_idx), (11, row_idx), 0.5, COLOR_BORDER))
                     elif itype == 'total_rekap': row_content[7] = 'TOTAL'; row_content[11] = item['val']; page_style.append(('SPAN', (7, row_idx), (10, row_idx))); page_style.append(('BACKGROUND', (7, row_idx), (10, row_idx), COLOR_TOTAL_YELLOW)); page_style.append(('FONTNAME', (7, row_idx), (11, row_idx), 'Helvetica-Bold')); page_style.append(('GRID', (7, row_idx), (11, row_idx), 0.5, COLOR_BORDER))
                     elif itype == 'header_stok': row_content[7] = Paragraph(item['label'], header_style); page_style.append(('SPAN', (7, row_idx), (11, row_idx))); page_style.append(('BACKGROUND', (7, row_idx), (11, row_idx), colors.HexColor("#70AD47"))); page_style.append(('GRID', (7, row_idx), (11, row_idx), 0.5, COLOR_BORDER))
                     elif itype == 'row_stok': row_content[7] = item['label']; row_content[11] = item['val']; page_style.append(('SPAN', (7, row_idx), (10, row_idx))); page_style.append(('GRID', (7, row_idx), (11, row_idx), 0.5, COLOR_BORDER))
@@ -393,37 +1071,23 @@ def generate_pdf_portrait(conn, lokasi_id, nama_lokasi, start_date_global, end_d
                         if rows_left < 5: pass
                         else:
                             real_span = min(span_needed, rows_left); img_height = real_span * 14
-                            row_content[7] = RLImage(item['img'], width=200, height=img_height)
+                            row_content[7] = grafik_pdf_bulan(item['sec'], 200, img_height) or ''
                             span_end_idx = row_idx + real_span - 1; page_style.append(('SPAN', (7, row_idx), (11, span_end_idx)))
                             right_occupied_until = span_end_idx; r_ptr += 1 
                     r_ptr += 1
                 page_data.append(row_content); row_idx += 1
             if not page_data: break 
             col_widths = [20, 30, 80, 40, 30, 80,  20,  20, 30, 80, 40, 50]
-            t = Table(page_data, colWidths=col_widths, rowHeights=[ROW_HEIGHT]*len(page_data)); t.setStyle(TableStyle(page_style)); elements.append(t)
+            t = Table(page_data, colWidths=col_widths, rowHeights=[ROW_HEIGHT]*len(page_data)); t.setStyle(TableStyle(ringkas_gaya_tabel(page_style))); elements.append(t)
             if l_ptr >= len(left_queue) and r_ptr >= len(right_queue): break
             elements.append(PageBreak())
 
     elements.append(PageBreak()); elements.append(Paragraph("LAPORAN BBM PERBULAN", title_style))
-    m_data = []
-    stok_run = hitung_stok_awal_periode(conn, lokasi_id, start_date_global)
-    curr = start_date_global.replace(day=1); end_limit = end_date_global.replace(day=1)
-    while curr <= end_limit:
-        m = curr.month; y = curr.year
-        q_in = f"SELECT SUM(jumlah_liter) FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        q_out = f"SELECT SUM(jumlah_liter) FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        cursor = conn.cursor()
-        cursor.execute(q_in); res_in = cursor.fetchone(); mi = float(res_in[0]) if res_in and res_in[0] else 0.0
-        cursor.execute(q_out); res_out = cursor.fetchone(); mo = float(res_out[0]) if res_out and res_out[0] else 0.0
-        prev = stok_run; stok_run = prev + mi - mo
-        m_data.append({'bln': f"{get_bulan_indonesia(curr.month)} {curr.year}", 'awal': prev, 'masuk': mi, 'keluar': mo, 'sisa': stok_run, 'bulan_nama': get_bulan_indonesia(m)[:3]})
-        curr = curr + relativedelta(months=1)
-    
-    df_m = pd.DataFrame(m_data)
-    if not df_m.empty:
-        img_m_buf = generate_monthly_chart(df_m)
-        if img_m_buf: elements.append(RLImage(img_m_buf, width=480, height=220)); elements.append(Spacer(1, 15))
-    
+    m_data = model['rekap']
+
+    img_m = grafik_pdf_rekap(model, 480, 220)
+    if img_m: elements.append(img_m); elements.append(Spacer(1, 15))
+
     d_m = [['BULAN', 'SISA BULAN LALU', 'MASUK', 'KELUAR', 'SISA']]
     for r in m_data: d_m.append([r['bln'], f"{r['awal']:,.0f}", f"{r['masuk']:,.0f}", f"{r['keluar']:,.0f}", f"{r['sisa']:,.0f}"])
     if m_data:
@@ -436,52 +1100,30 @@ def generate_pdf_portrait(conn, lokasi_id, nama_lokasi, start_date_global, end_d
     if m_data: rekap_style.append(('BACKGROUND', (0, -1), (-1, -1), COLOR_TOTAL_YELLOW)); rekap_style.append(('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'))
     t_m.setStyle(TableStyle(rekap_style)); elements.append(t_m)
 
-    df_keluar_all = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date_global}' AND '{end_date_global}'", conn)
-    if not df_keluar_all.empty:
-        if 'kategori' not in df_keluar_all.columns: df_keluar_all['kategori'] = df_keluar_all['nama_alat'].apply(cek_kategori)
-        df_keluar_rpt = filter_non_consumption(df_keluar_all)
-        df_alat_t, df_truck_t, _ = segregate_data(df_keluar_rpt, excluded_list)
-        img_usage = generate_chart_for_report(df_alat_t, df_truck_t, width_inch=7, height_inch=3.5)
-        if img_usage:
-            elements.append(Spacer(1, 15))
-            elements.append(RLImage(img_usage, width=480, height=240))
+    img_usage = grafik_pdf_total(model, 480, 240)
+    if img_usage:
+        elements.append(Spacer(1, 15))
+        elements.append(img_usage)
 
     doc.build(elements)
     buffer.seek(0)
     return buffer
 
-def generate_pdf_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list):
-    buffer = io.BytesIO()
-    date_ranges = split_date_range_by_month(start_date_global, end_date_global)
+# Tinggi halaman one-sheet diukur dari wrap() flowable asli (padding frame 6+6, margin 20+20)
+def tinggi_halaman(flowables, lebar_frame, minimum=842):
+    lebar = lebar_frame - 12; total = 0
+    for f in flowables:
+        _, h = f.wrap(lebar, 10**6)
+        total += h + f.getSpaceBefore() + f.getSpaceAfter()
+    return max(minimum, total + 12 + 40 + 4)
+
+def generate_pdf_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, model=None, progres=None):
+    if model is None: model = bangun_model_laporan(conn, lokasi_id, start_date_global, end_date_global, excluded_list)
+    buffer = buffer_export()
     SPLIT_IDX = 128
-    ROW_HEIGHT_EST = 30 
-    
-    page_heights = []
-    for idx, (s, e) in enumerate(date_ranges):
-        df_keluar_temp = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{s}' AND '{e}'", conn)
-        df_rpt = filter_non_consumption(df_keluar_temp)
-        df_rpt_table = process_transfers_for_table(df_rpt)
-        full_data = prepare_data_global_subtotals(df_rpt_table) 
-        total_items = len(full_data)
-        items_left = min(total_items, SPLIT_IDX)
-        h_left = (items_left * ROW_HEIGHT_EST) + 300 
-        items_right = max(0, total_items - SPLIT_IDX)
-        h_right = (items_right * ROW_HEIGHT_EST) + 750
-        page_h = max(h_left, h_right) + 100 
-        page_h = max(842, page_h) 
-        page_heights.append(page_h)
-
     page_width = 35 * cm 
     doc = BaseDocTemplate(buffer, pagesize=(page_width, A4[1]), rightMargin=20, leftMargin=20, topMargin=20, bottomMargin=20)
     
-    templates = []
-    for i, h in enumerate(page_heights):
-        frame = Frame(20, 20, page_width-40, h-40, id=f'F_{i}')
-        pt = PageTemplate(id=f'T_{i}', frames=[frame], pagesize=(page_width, h))
-        templates.append(pt)
-    
-    doc.addPageTemplates(templates)
-    
     elements = []
     styles = getSampleStyleSheet()
     title_style = ParagraphStyle(name='Title', parent=styles['Heading1'], alignment=TA_CENTER, fontSize=16, fontName='Helvetica-Bold', spaceAfter=2)
@@ -490,28 +1132,19 @@ def generate_pdf_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end_
     cell_style = ParagraphStyle(name='Cell', parent=styles['Normal'], fontSize=8, fontName='Helvetica')
     h3_style = ParagraphStyle(name='H3', parent=styles['Heading3'], fontSize=10, fontName='Helvetica-Bold', spaceAfter=4)
 
-    for idx, (start_date, end_date) in enumerate(date_ranges):
+    page_heights = []
+    for idx, sec in enumerate(model['bulan']):
+        if progres: progres()
         if idx > 0:
             elements.append(NextPageTemplate(f'T_{idx}'))
-            elements.append(PageBreak()) 
+            elements.append(PageBreak())
+        awal_bulan = len(elements)
 
-        stok_awal = hitung_stok_awal_periode(conn, lokasi_id, start_date)
-        df_masuk = pd.read_sql(f"SELECT * FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
-        df_keluar = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
-        
-        if not df_keluar.empty and 'kategori' not in df_keluar.columns: df_keluar['kategori'] = df_keluar['nama_alat'].apply(cek_kategori)
-        
-        df_keluar_raw = filter_non_consumption(df_keluar)
-        df_keluar_table = process_transfers_for_table(df_keluar_raw)
-        df_alat_g, df_truck_g, df_lain_g = segregate_data(df_keluar_table, excluded_list)
-        df_alat_chart, df_truck_chart, _ = segregate_data(df_keluar_raw, excluded_list)
-        
-        tm = float(df_masuk['jumlah_liter'].sum()) if not df_masuk.empty else 0.0
-        tk_real = float(df_keluar['jumlah_liter'].sum()) if not df_keluar.empty else 0.0
-        tk_rpt = float(df_keluar_table['jumlah_liter'].sum()) if not df_keluar_table.empty else 0.0
-        sisa_akhir = stok_awal + tm - tk_real
-        
-        full_data_list = prepare_data_global_subtotals(df_keluar_table)
+        start_date = sec['start']; stok_awal = sec['stok_awal']; df_masuk = sec['df_masuk']
+        df_alat_g, df_truck_g, df_lain_g = sec['alat_g'], sec['truck_g'], sec['lain_g']
+        tm, tk_real, tk_rpt, sisa_akhir = sec['tm'], sec['tk_real'], sec['tk_rpt'], sec['sisa_akhir']
+
+        full_data_list = sec['items']
         data_left = full_data_list[:SPLIT_IDX]
         data_right = full_data_list[SPLIT_IDX:]
         
@@ -658,15 +1291,23 @@ def generate_pdf_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end_
         t_stok.setStyle(TableStyle([('GRID', (0,0), (-1,-1), 0.5, COLOR_BORDER),('BACKGROUND', (0,0), (-1,0), colors.HexColor("#70AD47")),('BACKGROUND', (0,4), (-1,4), colors.HexColor("#00FF00")),('FONTSIZE', (0,0), (-1,-1), 8)]))
         right_stack.append(t_stok)
         
-        img_buf = generate_chart_for_report(df_alat_chart, df_truck_chart, width_inch=3.5, height_inch=2.5)
-        if img_buf: 
+        img = grafik_pdf_bulan(sec, 200, 200)
+        if img:
             right_stack.append(Spacer(1, 5))
-            right_stack.append(RLImage(img_buf, width=200, height=200))
+            right_stack.append(img)
         
         main_table_data = [[left_stack, right_stack]]
         t_main = Table(main_table_data, colWidths=[380, 400], vAlign='TOP')
         t_main.setStyle(TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP'), ('LEFTPADDING', (0,0), (-1,-1), 0), ('RIGHTPADDING', (0,0), (-1,-1), 0)]))
         elements.append(t_main)
+        page_heights.append(tinggi_halaman(elements[awal_bulan:], page_width - 40))
+    
+    templates = []
+    for i, h in enumerate(page_heights):
+        frame = Frame(20, 20, page_width-40, h-40, id=f'F_{i}')
+        pt = PageTemplate(id=f'T_{i}', frames=[frame], pagesize=(page_width, h))
+        templates.append(pt)
+    doc.addPageTemplates(templates)
     
     pt_last = PageTemplate(id='LastPage', frames=[Frame(20, 20, 802, 555, id='F_Last')], pagesize=(842, 595)) # A4 Landscape
     doc.addPageTemplates([pt_last])
@@ -674,38 +1315,14 @@ def generate_pdf_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end_
     elements.append(PageBreak())
     
     elements.append(Paragraph("LAPORAN BBM PERBULAN", title_style))
-    m_data = []; stok_run = hitung_stok_awal_periode(conn, lokasi_id, start_date_global)
-    curr = start_date_global.replace(day=1); end_limit = end_date_global.replace(day=1)
-    while curr <= end_limit:
-        m = curr.month; y = curr.year
-        q_in = f"SELECT SUM(jumlah_liter) FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        q_out = f"SELECT SUM(jumlah_liter) FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        cursor = conn.cursor()
-        cursor.execute(q_in); res_in = cursor.fetchone(); mi = float(res_in[0]) if res_in and res_in[0] else 0.0
-        cursor.execute(q_out); res_out = cursor.fetchone(); mo = float(res_out[0]) if res_out and res_out[0] else 0.0
-        prev = stok_run; stok_run = prev + mi - mo
-        m_data.append({'bln': f"{get_bulan_indonesia(curr.month)} {curr.year}", 'awal': prev, 'masuk': mi, 'keluar': mo, 'sisa': stok_run, 'bulan_nama': get_bulan_indonesia(m)[:3]})
-        curr = curr + relativedelta(months=1)
+    m_data = model['rekap']
 
-    df_m = pd.DataFrame(m_data)
-    img_m_buf = None
-    if not df_m.empty: img_m_buf = generate_monthly_chart(df_m)
-    
-    df_keluar_all = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date_global}' AND '{end_date_global}'", conn)
-    img_usage_buf = None
-    if not df_keluar_all.empty:
-        if 'kategori' not in df_keluar_all.columns: df_keluar_all['kategori'] = df_keluar_all['nama_alat'].apply(cek_kategori)
-        df_keluar_rpt = filter_non_consumption(df_keluar_all)
-        df_alat_t, df_truck_t, _ = segregate_data(df_keluar_rpt, excluded_list)
-        img_usage_buf = generate_chart_for_report(df_alat_t, df_truck_t, width_inch=7, height_inch=3.5)
-
-    chart_row = []
-    if img_m_buf: chart_row.append(RLImage(img_m_buf, width=400, height=200))
-    else: chart_row.append("")
-    if img_usage_buf: chart_row.append(RLImage(img_usage_buf, width=400, height=200))
-    else: chart_row.append("")
+    img_m = grafik_pdf_rekap(model, 400, 200)
+    img_usage = grafik_pdf_total(model, 400, 200)
+
+    chart_row = [img_m or "", img_usage or ""]
     
-    if img_m_buf or img_usage_buf:
+    if img_m or img_usage:
         t_charts = Table([chart_row], colWidths=[420, 420])
         t_charts.setStyle(TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP')]))
         elements.append(t_charts)
@@ -726,375 +1343,228 @@ def generate_pdf_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end_
     buffer.seek(0)
     return buffer
 
-def generate_excel_styled(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list):
-    output = io.BytesIO(); wb = Workbook(); wb.remove(wb.active)
-    thin = Border(left=Side('thin'), right=Side('thin'), top=Side('thin'), bottom=Side('thin'))
-    date_ranges = split_date_range_by_month(start_date_global, end_date_global)
-    for idx, (start_date, end_date) in enumerate(date_ranges):
+def generate_excel_styled(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, model=None, progres=None):
+    if model is None: model = bangun_model_laporan(conn, lokasi_id, start_date_global, end_date_global, excluded_list)
+    output = buffer_export(); wb = workbook_stream()
+    for sec in model['bulan']:
+        if progres: progres()
+        start_date = sec['start']
         sheet_name = get_bulan_indonesia(start_date.month)[:3] + f" {start_date.year}"
-        ws = wb.create_sheet(sheet_name)
-        ws.column_dimensions['A'].width = 5; ws.column_dimensions['B'].width = 15; ws.column_dimensions['C'].width = 30; ws.column_dimensions['D'].width = 15
-        ws.column_dimensions['E'].width = 15; ws.column_dimensions['F'].width = 35
-        ws.column_dimensions['I'].width = 5; ws.column_dimensions['J'].width = 15; ws.column_dimensions['K'].width = 30; ws.column_dimensions['L'].width = 15
-        
-        stok_awal = hitung_stok_awal_periode(conn, lokasi_id, start_date)
-        df_masuk = pd.read_sql(f"SELECT * FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
-        df_keluar = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
-        
-        if not df_keluar.empty and 'kategori' not in df_keluar.columns: df_keluar['kategori'] = df_keluar['nama_alat'].apply(cek_kategori)
-        
-        df_keluar_raw = filter_non_consumption(df_keluar)
-        df_keluar_table = process_transfers_for_table(df_keluar_raw)
-        df_alat_g, df_truck_g, df_lain_g = segregate_data(df_keluar_table, excluded_list)
-        df_alat_chart, df_truck_chart, _ = segregate_data(df_keluar_raw, excluded_list)
-        
-        tm = float(df_masuk['jumlah_liter'].sum()) if not df_masuk.empty else 0.0
-        tk_real = float(df_keluar['jumlah_liter'].sum()) if not df_keluar.empty else 0.0
-        tk_rpt = float(df_keluar_table['jumlah_liter'].sum()) if not df_keluar_table.empty else 0.0
-        sisa_akhir = stok_awal + tm - tk_real
-        
-        ws.merge_cells('A1:L1'); ws['A1'] = "LAPORAN BBM"; ws['A1'].font = Font(bold=True, size=14); ws['A1'].alignment = Alignment(horizontal='center')
-        ws.merge_cells('A2:L2'); ws['A2'] = nama_lokasi; ws['A2'].font = Font(bold=True, size=14); ws['A2'].alignment = Alignment(horizontal='center')
-        ws.merge_cells('A3:L3'); ws['A3'] = f"PERIODE {get_bulan_indonesia(start_date.month)} {start_date.year}"; ws['A3'].font = Font(size=12); ws['A3'].alignment = Alignment(horizontal='center')
+        ws = wb.create_sheet(sheet_name); L = lembar_baru()
+
+        stok_awal = sec['stok_awal']; df_masuk = sec['df_masuk']
+        df_alat_g, df_truck_g, df_lain_g = sec['alat_g'], sec['truck_g'], sec['lain_g']
+        tm, tk_real, tk_rpt, sisa_akhir = sec['tm'], sec['tk_real'], sec['tk_rpt'], sec['sisa_akhir']
+
+        gabung(L, 1, 1, 1, 12); tulis(L, 1, 1, "LAPORAN BBM", 'judul')
+        gabung(L, 2, 1, 2, 12); tulis(L, 2, 1, nama_lokasi, 'judul')
+        gabung(L, 3, 1, 3, 12); tulis(L, 3, 1, f"PERIODE {get_bulan_indonesia(start_date.month)} {start_date.year}", 'periode')
         
-        r = 5; ws.cell(r, 1, "PENGGUNAAN BBM (KELUAR)").font = Font(bold=True)
+        r = 5; tulis(L, r, 1, "PENGGUNAAN BBM (KELUAR)", 'tebal')
         headers = ['NO', 'TGL', 'ALAT', 'UNIT', 'LTR', 'KET']
-        for i, h in enumerate(headers): c=ws.cell(r+1, i+1, h); c.border=thin; c.fill=PatternFill("solid", fgColor="D3D3D3"); c.alignment=Alignment(horizontal='center')
+        for i, h in enumerate(headers): tulis(L, r+1, i+1, h, 'header_abu')
         r += 2
-        
-        processed_data = prepare_data_global_subtotals(df_keluar_table)
+
+        processed_data = sec['items']
         if processed_data:
             last_date = None; is_grey = False
             for item in processed_data:
                 if item['type'] == 'data':
                     curr_date = item['tanggal']; is_grey = not is_grey if last_date is not None and curr_date != last_date else is_grey; last_date = curr_date
-                    fill = PatternFill("solid", fgColor="F2F2F2") if is_grey else None
                     vals = [item['no'], item['tanggal'].strftime('%d/%m/%Y'), item['nama_alat'], item['no_unit'], float(item['jumlah_liter']), item['keterangan']]
-                    for j, v in enumerate(vals): 
-                        c=ws.cell(r, j+1, v); c.border=thin; c.alignment=Alignment(wrap_text=True, vertical='center'); 
-                        if fill: c.fill = fill
+                    for j, v in enumerate(vals): tulis(L, r, j+1, v, 'data_zebra' if is_grey else 'data')
                     r += 1
                 elif item['type'] == 'daily_total':
-                    c_lbl = ws.cell(r, 3, f"TOTAL {item['tanggal'].strftime('%d/%m')}"); c_lbl.font = Font(bold=True); c_lbl.fill = PatternFill("solid", fgColor="F8CBAD"); c_lbl.border = thin
-                    c_val = ws.cell(r, 5, item['total_liter']); c_val.font = Font(bold=True); c_val.fill = PatternFill("solid", fgColor="F8CBAD"); c_val.border = thin
+                    tulis(L, r, 3, f"TOTAL {item['tanggal'].strftime('%d/%m')}", 'total_harian'); tulis(L, r, 5, item['total_liter'], 'total_harian')
                     r += 1
 
-        ws.cell(r, 3, "TOTAL").font=Font(bold=True); c=ws.cell(r, 5, tk_rpt); c.font=Font(bold=True); c.fill=PatternFill("solid", fgColor="FFFF00"); c.border=thin
+        tulis(L, r, 3, "TOTAL", 'tebal'); tulis(L, r, 5, tk_rpt, 'total_kuning')
         
-        r_r = 5; ws.cell(r_r, 9, "BBM MASUK").font = Font(bold=True)
+        r_r = 5; tulis(L, r_r, 9, "BBM MASUK", 'tebal')
         headers_m = ['NO', 'TGL', 'SUMBER', 'JNS', 'LTR']
-        for i, h in enumerate(headers_m): c=ws.cell(r_r+1, i+9, h); c.border=thin; c.fill=PatternFill("solid", fgColor="D3D3D3"); c.alignment=Alignment(horizontal='center')
+        for i, h in enumerate(headers_m): tulis(L, r_r+1, i+9, h, 'header_abu')
         r_r += 2
         if not df_masuk.empty:
             for i, row in df_masuk.iterrows():
                 vals = [i+1, row['tanggal'].strftime('%d/%m/%Y'), row['sumber'], row['jenis_bbm'], float(row['jumlah_liter'])]
-                for j, v in enumerate(vals): c=ws.cell(r_r, j+9, v); c.border=thin; c.alignment=Alignment(wrap_text=True)
+                for j, v in enumerate(vals): tulis(L, r_r, j+9, v, 'data_wrap')
                 r_r += 1
-        ws.cell(r_r, 11, "TOTAL").font=Font(bold=True); c=ws.cell(r_r, 13, tm); c.font=Font(bold=True); c.fill=PatternFill("solid", fgColor="FFFF00"); c.border=thin
+        tulis(L, r_r, 11, "TOTAL", 'tebal'); tulis(L, r_r, 13, tm, 'total_kuning')
         r_r += 2
         
-        ws.cell(r_r, 9, "RINCIAN PENGGUNAAN BBM").font=Font(bold=True); r_r+=1
+        tulis(L, r_r, 9, "RINCIAN PENGGUNAAN BBM", 'tebal'); r_r+=1
         
-        def write_detail(ws, row, col, title, df, color):
-            ws.merge_cells(start_row=row, start_column=col, end_row=row, end_column=col+3)
-            c=ws.cell(row, col, title); c.fill=color; c.font=Font(bold=True); c.alignment=Alignment(horizontal='center'); c.border=thin
+        seri_chart = []
+        def write_detail(row, col, title, df, warna, judul_chart=None):
+            gabung(L, row, col, row, col+3); tulis(L, row, col, title, f'rinci_{warna}')
             row+=1
             if not df.empty and 'jumlah_liter' in df.columns:
                 grp = df.groupby(['nama_alat', 'no_unit'])['jumlah_liter'].sum().reset_index()
+                if judul_chart and not grp.empty: seri_chart.append((judul_chart, row, row + len(grp) - 1, warna))
                 for _, x in grp.iterrows():
-                    ws.merge_cells(start_row=row, start_column=col, end_row=row, end_column=col+2)
-                    c1=ws.cell(row, col, f"{x['nama_alat']} {x['no_unit']}"); c1.border=thin
-                    c2=ws.cell(row, col+3, float(x['jumlah_liter'])); c2.border=thin
+                    gabung(L, row, col, row, col+2)
+                    tulis(L, row, col, f"{x['nama_alat']} {x['no_unit']}", 'grid'); tulis(L, row, col+3, float(x['jumlah_liter']), 'grid')
                     row+=1
             total_val = float(df['jumlah_liter'].sum()) if not df.empty and 'jumlah_liter' in df.columns else 0
-            ws.merge_cells(start_row=row, start_column=col, end_row=row, end_column=col+2)
-            c_tot=ws.cell(row, col, "TOTAL"); c_tot.fill=PatternFill("solid", fgColor="FFFF00"); c_tot.border=thin; c_tot.font=Font(bold=True)
-            c_val=ws.cell(row, col+3, total_val); c_val.fill=PatternFill("solid", fgColor="FFFF00"); c_val.border=thin; c_val.font=Font(bold=True)
+            gabung(L, row, col, row, col+2)
+            tulis(L, row, col, "TOTAL", 'total_kuning'); tulis(L, row, col+3, total_val, 'total_kuning')
             return row+2
         
-        r_r = write_detail(ws, r_r, 9, "TOTAL PENGGUNAAN ALAT BERAT", df_alat_g, PatternFill("solid", fgColor="F4B084"))
-        r_r = write_detail(ws, r_r, 9, "TOTAL PENGGUNAAN MOBIL & TRUCK", df_truck_g, PatternFill("solid", fgColor="9BC2E6"))
-        if not df_lain_g.empty: r_r = write_detail(ws, r_r, 9, "TOTAL PENGGUNAAN BBM LAINNYA", df_lain_g, PatternFill("solid", fgColor="FFB6C1"))
+        r_r = write_detail(r_r, 9, "TOTAL PENGGUNAAN ALAT BERAT", df_alat_g, "F4B084", "PEMAKAIAN ALAT BERAT")
+        r_r = write_detail(r_r, 9, "TOTAL PENGGUNAAN MOBIL & TRUCK", df_truck_g, "9BC2E6", "PEMAKAIAN MOBIL & TRUCK")
+        if not df_lain_g.empty: r_r = write_detail(r_r, 9, "TOTAL PENGGUNAAN BBM LAINNYA", df_lain_g, "FFB6C1")
             
-        ws.cell(r_r, 9, "RINCIAN SISA STOK BBM").font=Font(bold=True); r_r+=1
+        tulis(L, r_r, 9, "RINCIAN SISA STOK BBM", 'tebal'); r_r+=1
         data_s = [('SISA BULAN LALU', stok_awal), ('MASUK', tm), ('KELUAR (REAL)', tk_real), ('SISA AKHIR', sisa_akhir)]
         for k, v in data_s:
-            ws.merge_cells(start_row=r_r, start_column=9, end_row=r_r, end_column=11)
-            c1=ws.cell(r_r, 9, k); c1.border=thin
-            c2=ws.cell(r_r, 12, v); c2.border=thin
-            if k == 'SISA AKHIR': c1.fill=PatternFill("solid", fgColor="00FF00"); c2.fill=PatternFill("solid", fgColor="00FF00")
+            gabung(L, r_r, 9, r_r, 11)
+            gaya = 'hijau' if k == 'SISA AKHIR' else 'grid'
+            tulis(L, r_r, 9, k, gaya); tulis(L, r_r, 12, v, gaya)
             r_r+=1
         r_r+=1
-        
-        img_buf = generate_chart_for_report(df_alat_chart, df_truck_chart, width_inch=4.5, height_inch=3.0)
-        if img_buf: 
-            img = XLImage(img_buf); img.width = 450; img.height = 450
-            ws.add_image(img, f'I{r_r}')
+        tambah_chart_pemakaian(ws, seri_chart, r_r)
+        tulis_sheet(ws, L, {'A': 5, 'B': 15, 'C': 30, 'D': 15, 'E': 15, 'F': 35, 'I': 5, 'J': 15, 'K': 30, 'L': 15})
 
-    ws2 = wb.create_sheet("Rekap Tahunan"); ws2['A1'] = "LAPORAN BBM PERBULAN"; ws2['A1'].font = Font(bold=True, size=14)
-    ws2.column_dimensions['A'].width = 25; ws2.column_dimensions['B'].width = 20; ws2.column_dimensions['C'].width = 20; ws2.column_dimensions['D'].width = 20; ws2.column_dimensions['E'].width = 20
-    m_data = []
-    stok_run = hitung_stok_awal_periode(conn, lokasi_id, start_date_global)
-    curr = start_date_global.replace(day=1); end_limit = end_date_global.replace(day=1)
-    while curr <= end_limit:
-        m = curr.month; y = curr.year
-        q_in = f"SELECT SUM(jumlah_liter) FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        q_out = f"SELECT SUM(jumlah_liter) FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        cursor = conn.cursor()
-        cursor.execute(q_in); res_in = cursor.fetchone(); mi = float(res_in[0]) if res_in and res_in[0] else 0.0
-        cursor.execute(q_out); res_out = cursor.fetchone(); mo = float(res_out[0]) if res_out and res_out[0] else 0.0
-        prev = stok_run; stok_run = prev + mi - mo
-        m_data.append({'bln': f"{get_bulan_indonesia(curr.month)} {curr.year}", 'awal': prev, 'masuk': mi, 'keluar': mo, 'sisa': stok_run, 'bulan_nama': get_bulan_indonesia(m)[:3]})
-        curr = curr + relativedelta(months=1)
-    df_m = pd.DataFrame(m_data)
-    img_m_buf = generate_monthly_chart(df_m)
-    if img_m_buf: img2 = XLImage(img_m_buf); img2.width=500; img2.height=250; ws2.add_image(img2, 'A3')
-    r2 = 18; headers = ['BULAN', 'SISA BULAN LALU', 'MASUK', 'KELUAR', 'SISA']
-    for i, h in enumerate(headers): c=ws2.cell(r2, i+1, h); c.border=thin; c.fill=PatternFill("solid", fgColor="D3D3D3")
-    r2+=1
-    for r in m_data:
-        vals = [r['bln'], r['awal'], r['masuk'], r['keluar'], r['sisa']]
-        for i, v in enumerate(vals): c=ws2.cell(r2, i+1, v); c.border=thin
-        r2+=1
-    if m_data:
-        t_masuk = sum(x['masuk'] for x in m_data); t_keluar = sum(x['keluar'] for x in m_data); akhir = m_data[-1]['sisa']
-        ws2.cell(r2, 1, "TOTAL").font = Font(bold=True); ws2.cell(r2, 3, t_masuk).font = Font(bold=True); ws2.cell(r2, 4, t_keluar).font = Font(bold=True); ws2.cell(r2, 5, akhir).font = Font(bold=True)
-        for i in range(1, 6): c = ws2.cell(r2, i); c.fill = PatternFill("solid", fgColor="FFD966"); c.border = thin
-    
-    df_keluar_all = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date_global}' AND '{end_date_global}'", conn)
-    if not df_keluar_all.empty:
-        if 'kategori' not in df_keluar_all.columns: df_keluar_all['kategori'] = df_keluar_all['nama_alat'].apply(cek_kategori)
-        df_keluar_rpt = filter_non_consumption(df_keluar_all)
-        df_alat_t, df_truck_t, _ = segregate_data(df_keluar_rpt, excluded_list)
-        img_usage = generate_chart_for_report(df_alat_t, df_truck_t, width_inch=7, height_inch=3.5)
-        if img_usage:
-            img3 = XLImage(img_usage); img3.width=500; img3.height=250
-            ws2.add_image(img3, 'H3')
+    sheet_rekap_excel(wb, model)
 
     wb.save(output); output.seek(0)
     return output
 
-def generate_excel_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list):
-    output = io.BytesIO(); wb = Workbook(); wb.remove(wb.active)
-    thin = Border(left=Side('thin'), right=Side('thin'), top=Side('thin'), bottom=Side('thin'))
-    date_ranges = split_date_range_by_month(start_date_global, end_date_global)
-    
-    for idx, (start_date, end_date) in enumerate(date_ranges):
+def generate_excel_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, model=None, progres=None):
+    if model is None: model = bangun_model_laporan(conn, lokasi_id, start_date_global, end_date_global, excluded_list)
+    output = buffer_export(); wb = workbook_stream()
+
+    for sec in model['bulan']:
+        if progres: progres()
+        start_date = sec['start']
         sheet_name = get_bulan_indonesia(start_date.month)[:3] + f" {start_date.year}"
-        ws = wb.create_sheet(sheet_name)
-        
-        stok_awal = hitung_stok_awal_periode(conn, lokasi_id, start_date)
-        df_masuk = pd.read_sql(f"SELECT * FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
-        df_keluar = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
-        if not df_keluar.empty and 'kategori' not in df_keluar.columns: df_keluar['kategori'] = df_keluar['nama_alat'].apply(cek_kategori)
-        
-        df_keluar_raw = filter_non_consumption(df_keluar)
-        df_keluar_table = process_transfers_for_table(df_keluar_raw)
-        df_alat_g, df_truck_g, df_lain_g = segregate_data(df_keluar_table, excluded_list)
-        df_alat_chart, df_truck_chart, _ = segregate_data(df_keluar_raw, excluded_list)
+        ws = wb.create_sheet(sheet_name); L = lembar_baru()
+
+        stok_awal = sec['stok_awal']; df_masuk = sec['df_masuk']
+        tm, tk_real, tk_rpt, sisa_akhir = sec['tm'], sec['tk_real'], sec['tk_rpt'], sec['sisa_akhir']
 
-        tm = float(df_masuk['jumlah_liter'].sum()) if not df_masuk.empty else 0.0
-        tk_real = float(df_keluar['jumlah_liter'].sum()) if not df_keluar.empty else 0.0
-        tk_rpt = float(df_keluar_table['jumlah_liter'].sum()) if not df_keluar_table.empty else 0.0
-        sisa_akhir = stok_awal + tm - tk_real
-        
         SPLIT_IDX = 145
-        full_data_list = prepare_data_global_subtotals(df_keluar_table)
+        full_data_list = sec['items']
         data_left = full_data_list[:SPLIT_IDX]
         data_right = full_data_list[SPLIT_IDX:]
         
-        ws.merge_cells('A1:N1'); ws['A1'] = "LAPORAN BBM"; ws['A1'].font = Font(bold=True, size=14); ws['A1'].alignment = Alignment(horizontal='center')
-        ws.merge_cells('A2:N2'); ws['A2'] = nama_lokasi; ws['A2'].font = Font(bold=True, size=14); ws['A2'].alignment = Alignment(horizontal='center')
-        ws.merge_cells('A3:N3'); ws['A3'] = f"PERIODE {get_bulan_indonesia(start_date.month)} {start_date.year}"; ws['A3'].font = Font(size=12, bold=True); ws['A3'].alignment = Alignment(horizontal='center')
+        gabung(L, 1, 1, 1, 14); tulis(L, 1, 1, "LAPORAN BBM", 'judul')
+        gabung(L, 2, 1, 2, 14); tulis(L, 2, 1, nama_lokasi, 'judul')
+        gabung(L, 3, 1, 3, 14); tulis(L, 3, 1, f"PERIODE {get_bulan_indonesia(start_date.month)} {start_date.year}", 'periode_tebal')
         
-        ws.merge_cells('A5:F5'); ws['A5'] = "PENGGUNAAN BBM"; ws['A5'].font = Font(bold=True)
-        ws['A6'] = "NO"; ws['B6'] = "TGL"; ws['C6'] = "ALAT"; ws['D6'] = "UNIT"; ws['E6'] = "LTR"; ws['F6'] = "KET"
-        for c in ['A','B','C','D','E','F']: ws[f'{c}6'].fill = PatternFill("solid", fgColor="2F5496"); ws[f'{c}6'].font = Font(color="FFFFFF", bold=True); ws[f'{c}6'].alignment = Alignment(horizontal='center')
-        
-        ws.column_dimensions['A'].width = 5; ws.column_dimensions['B'].width = 12; ws.column_dimensions['C'].width = 25
-        ws.column_dimensions['D'].width = 15; ws.column_dimensions['E'].width = 10; ws.column_dimensions['F'].width = 30
+        gabung(L, 5, 1, 5, 6); tulis(L, 5, 1, "PENGGUNAAN BBM", 'tebal')
+        for c, h in enumerate(["NO", "TGL", "ALAT", "UNIT", "LTR", "KET"]): tulis(L, 6, c+1, h, 'header_biru')
+
+        # Baris data / total harian, dipakai kolom kiri (mulai kolom 1) dan lanjutan kanan (mulai kolom 9)
+        def tulis_item(row, col, item, is_grey):
+            if item['type'] == 'data':
+                vals = [item['no'], item['tanggal'].strftime('%d/%m'), item['nama_alat'], item['no_unit'], item['jumlah_liter'], item['keterangan']]
+                for cx, v in enumerate(vals): tulis(L, row, col+cx, v, 'data_zebra' if is_grey else 'data')
+            elif item['type'] == 'daily_total':
+                for cx in range(6): gaya_sel(L, row, col+cx, 'grid')
+                tulis(L, row, col+2, f"TOTAL {item['tanggal'].strftime('%d/%m')}", 'total_harian'); tulis(L, row, col+4, item['total_liter'], 'total_harian')
+
+        def tulis_total(row, col, n_kolom, nilai):
+            for cx in range(n_kolom): gaya_sel(L, row, col+cx, 'grid')
+            tulis(L, row, col+2, "TOTAL", 'tebal_grid'); tulis(L, row, col+4, nilai, 'total_kuning')
 
         current_left_row = 7
         last_date_l = None; is_grey_l = False
-        
         for item in data_left:
             if item['type'] == 'data':
                 curr_date = item['tanggal']; is_grey_l = not is_grey_l if last_date_l is not None and curr_date != last_date_l else is_grey_l; last_date_l = curr_date
-                ws.cell(current_left_row, 1, item['no']); ws.cell(current_left_row, 2, item['tanggal'].strftime('%d/%m'))
-                ws.cell(current_left_row, 3, item['nama_alat']); ws.cell(current_left_row, 4, item['no_unit'])
-                ws.cell(current_left_row, 5, item['jumlah_liter']); ws.cell(current_left_row, 6, item['keterangan'])
-                fill_color = PatternFill("solid", fgColor="F2F2F2") if is_grey_l else None
-                for cx in range(1,7): cell = ws.cell(current_left_row, cx); cell.border = thin; cell.alignment = Alignment(wrap_text=True, vertical='center'); 
-                if fill_color: 
-                    for cx in range(1,7): ws.cell(current_left_row, cx).fill = fill_color
-            elif item['type'] == 'daily_total':
-                 c_l = ws.cell(current_left_row, 3, f"TOTAL {item['tanggal'].strftime('%d/%m')}"); c_l.font = Font(bold=True)
-                 c_v = ws.cell(current_left_row, 5, item['total_liter']); c_v.font = Font(bold=True)
-                 c_l.fill = PatternFill("solid", fgColor="F8CBAD"); c_v.fill = PatternFill("solid", fgColor="F8CBAD")
-                 for cx in range(1,7): ws.cell(current_left_row, cx).border = thin
+            tulis_item(current_left_row, 1, item, is_grey_l)
             current_left_row += 1
         
-        if not data_right:
-            ws.cell(current_left_row, 3, "TOTAL").font=Font(bold=True); 
-            ws.cell(current_left_row, 5, tk_rpt).font=Font(bold=True); 
-            ws.cell(current_left_row, 5).fill=PatternFill("solid", fgColor="FFFF00")
-            for cx in range(1,7): ws.cell(current_left_row, cx).border = thin
+        if not data_right: tulis_total(current_left_row, 1, 6, tk_rpt)
 
         col_start = 9 
-        ws.column_dimensions['I'].width = 5; ws.column_dimensions['J'].width = 12; ws.column_dimensions['K'].width = 25
-        ws.column_dimensions['L'].width = 15; ws.column_dimensions['M'].width = 10; ws.column_dimensions['N'].width = 30
         current_right_row = 5
         
         if data_right:
-            ws.merge_cells(start_row=current_right_row, start_column=col_start, end_row=current_right_row, end_column=col_start+5)
-            ws.cell(current_right_row, col_start, "PENGGUNAAN BBM LANJUTAN").font = Font(bold=True)
+            gabung(L, current_right_row, col_start, current_right_row, col_start+5)
+            tulis(L, current_right_row, col_start, "PENGGUNAAN BBM LANJUTAN", 'tebal')
             current_right_row += 1
-            headers_r = ["NO", "TGL", "ALAT", "UNIT", "LTR", "KET"]
-            for k, h in enumerate(headers_r):
-                c = ws.cell(current_right_row, col_start+k, h)
-                c.fill = PatternFill("solid", fgColor="2F5496"); c.font = Font(color="FFFFFF", bold=True); c.alignment = Alignment(horizontal='center')
+            for k, h in enumerate(["NO", "TGL", "ALAT", "UNIT", "LTR", "KET"]): tulis(L, current_right_row, col_start+k, h, 'header_biru')
             current_right_row += 1
             
             last_date_r = None; is_grey_r = False
             for item in data_right:
                 if item['type'] == 'data':
                     curr_date = item['tanggal']; is_grey_r = not is_grey_r if last_date_r is not None and curr_date != last_date_r else is_grey_r; last_date_r = curr_date
-                    ws.cell(current_right_row, col_start, item['no'])
-                    ws.cell(current_right_row, col_start+1, item['tanggal'].strftime('%d/%m'))
-                    ws.cell(current_right_row, col_start+2, item['nama_alat'])
-                    ws.cell(current_right_row, col_start+3, item['no_unit'])
-                    ws.cell(current_right_row, col_start+4, item['jumlah_liter'])
-                    ws.cell(current_right_row, col_start+5, item['keterangan'])
-                    fill_color = PatternFill("solid", fgColor="F2F2F2") if is_grey_r else None
-                    for cx in range(6): cell = ws.cell(current_right_row, col_start+cx); cell.border = thin; cell.alignment = Alignment(wrap_text=True, vertical='center'); 
-                    if fill_color: 
-                        for cx in range(6): ws.cell(current_right_row, col_start+cx).fill = fill_color
-                elif item['type'] == 'daily_total':
-                     c_l = ws.cell(current_right_row, col_start+2, f"TOTAL {item['tanggal'].strftime('%d/%m')}"); c_l.font = Font(bold=True)
-                     c_v = ws.cell(current_right_row, col_start+4, item['total_liter']); c_v.font = Font(bold=True)
-                     c_l.fill = PatternFill("solid", fgColor="F8CBAD"); c_v.fill = PatternFill("solid", fgColor="F8CBAD")
-                     for cx in range(6): ws.cell(current_right_row, col_start+cx).border = thin
+                tulis_item(current_right_row, col_start, item, is_grey_r)
                 current_right_row += 1
             
-            ws.cell(current_right_row, col_start+2, "TOTAL").font=Font(bold=True)
-            ws.cell(current_right_row, col_start+4, tk_rpt).font=Font(bold=True)
-            ws.cell(current_right_row, col_start+4).fill=PatternFill("solid", fgColor="FFFF00")
-            for cx in range(6): ws.cell(current_right_row, col_start+cx).border = thin
+            tulis_total(current_right_row, col_start, 6, tk_rpt)
             current_right_row += 2 
             
-        ws.cell(current_right_row, col_start, "BBM MASUK").font = Font(bold=True)
+        tulis(L, current_right_row, col_start, "BBM MASUK", 'tebal')
         current_right_row += 1
-        headers_m = ['NO', 'TGL', 'SUMBER', 'JNS', 'LTR']
-        for k, h in enumerate(headers_m): 
-            c = ws.cell(current_right_row, col_start+k, h)
-            c.fill = PatternFill("solid", fgColor="2F5496"); c.font = Font(color="FFFFFF", bold=True); c.border = thin
+        for k, h in enumerate(['NO', 'TGL', 'SUMBER', 'JNS', 'LTR']): tulis(L, current_right_row, col_start+k, h, 'header_biru_grid')
         current_right_row += 1
         
         if not df_masuk.empty:
             for i, r in df_masuk.iterrows():
-                ws.cell(current_right_row, col_start, i+1); ws.cell(current_right_row, col_start+1, r['tanggal'].strftime('%d/%m'))
-                ws.cell(current_right_row, col_start+2, r['sumber']); ws.cell(current_right_row, col_start+3, r['jenis_bbm']); ws.cell(current_right_row, col_start+4, r['jumlah_liter'])
-                for cx in range(5): cell = ws.cell(current_right_row, col_start+cx); cell.border = thin; cell.alignment = Alignment(wrap_text=True)
+                vals = [i+1, r['tanggal'].strftime('%d/%m'), r['sumber'], r['jenis_bbm'], r['jumlah_liter']]
+                for cx, v in enumerate(vals): tulis(L, current_right_row, col_start+cx, v, 'data_wrap')
                 current_right_row += 1
-        else: ws.cell(current_right_row, col_start+2, "TIDAK ADA DATA"); current_right_row +=1
+        else: tulis(L, current_right_row, col_start+2, "TIDAK ADA DATA"); current_right_row +=1
 
-        ws.cell(current_right_row, col_start+2, "TOTAL").font=Font(bold=True); ws.cell(current_right_row, col_start+4, tm).font=Font(bold=True); ws.cell(current_right_row, col_start+4).fill = PatternFill("solid", fgColor="FFFF00")
-        for cx in range(5): ws.cell(current_right_row, col_start+cx).border = thin
+        tulis_total(current_right_row, col_start, 5, tm)
         current_right_row += 2
         
-        ws.cell(current_right_row, col_start, "RINCIAN PENGGUNAAN BBM").font = Font(bold=True); current_right_row += 1
-        df_alat_g, df_truck_g, df_lain_g = segregate_data(df_keluar_table, excluded_list)
+        tulis(L, current_right_row, col_start, "RINCIAN PENGGUNAAN BBM", 'tebal'); current_right_row += 1
+        df_alat_g, df_truck_g, df_lain_g = sec['alat_g'], sec['truck_g'], sec['lain_g']
         
-        def write_detail_one_sheet(ws, row, col, title, df, color):
-            ws.merge_cells(start_row=row, start_column=col, end_row=row, end_column=col+3)
-            c=ws.cell(row, col, title); c.fill=color; c.font=Font(bold=True); c.alignment=Alignment(horizontal='center'); c.border=thin; row+=1
+        seri_chart = []
+        def write_detail_one_sheet(row, col, title, df, warna, judul_chart=None):
+            gabung(L, row, col, row, col+3); tulis(L, row, col, title, f'rinci_{warna}'); row+=1
             if not df.empty and 'jumlah_liter' in df.columns:
                 grp = df.groupby(['nama_alat', 'no_unit'])['jumlah_liter'].sum().reset_index()
+                if judul_chart and not grp.empty: seri_chart.append((judul_chart, row, row + len(grp) - 1, warna))
                 for _, x in grp.iterrows():
-                    ws.merge_cells(start_row=row, start_column=col, end_row=row, end_column=col+2)
-                    c1=ws.cell(row, col, f"{x['nama_alat']} {x['no_unit']}"); c1.border=thin; c2=ws.cell(row, col+3, float(x['jumlah_liter'])); c2.border=thin; row+=1
+                    gabung(L, row, col, row, col+2)
+                    tulis(L, row, col, f"{x['nama_alat']} {x['no_unit']}", 'grid'); tulis(L, row, col+3, float(x['jumlah_liter']), 'grid'); row+=1
             total_val = float(df['jumlah_liter'].sum()) if not df.empty and 'jumlah_liter' in df.columns else 0
-            ws.merge_cells(start_row=row, start_column=col, end_row=row, end_column=col+2)
-            c_tot=ws.cell(row, col, "TOTAL"); c_tot.fill=PatternFill("solid", fgColor="FFFF00"); c_tot.border=thin; c_tot.font=Font(bold=True)
-            c_val=ws.cell(row, col+3, total_val); c_val.fill=PatternFill("solid", fgColor="FFFF00"); c_val.border=thin; c_val.font=Font(bold=True)
+            gabung(L, row, col, row, col+2)
+            tulis(L, row, col, "TOTAL", 'total_kuning'); tulis(L, row, col+3, total_val, 'total_kuning')
             return row+2
 
-        current_right_row = write_detail_one_sheet(ws, current_right_row, col_start, "TOTAL PENGGUNAAN ALAT BERAT", df_alat_g, PatternFill("solid", fgColor="F4B084"))
-        current_right_row = write_detail_one_sheet(ws, current_right_row, col_start, "TOTAL PENGGUNAAN MOBIL & TRUCK", df_truck_g, PatternFill("solid", fgColor="9BC2E6"))
-        if not df_lain_g.empty: current_right_row = write_detail_one_sheet(ws, current_right_row, col_start, "TOTAL PENGGUNAAN BBM LAINNYA", df_lain_g, PatternFill("solid", fgColor="FFB6C1"))
+        current_right_row = write_detail_one_sheet(current_right_row, col_start, "TOTAL PENGGUNAAN ALAT BERAT", df_alat_g, "F4B084", "PEMAKAIAN ALAT BERAT")
+        current_right_row = write_detail_one_sheet(current_right_row, col_start, "TOTAL PENGGUNAAN MOBIL & TRUCK", df_truck_g, "9BC2E6", "PEMAKAIAN MOBIL & TRUCK")
+        if not df_lain_g.empty: current_right_row = write_detail_one_sheet(current_right_row, col_start, "TOTAL PENGGUNAAN BBM LAINNYA", df_lain_g, "FFB6C1")
         
-        ws.merge_cells(start_row=current_right_row, start_column=col_start, end_row=current_right_row, end_column=col_start+2)
-        ws.cell(current_right_row, col_start, "RINCIAN SISA STOK BBM").font = Font(bold=True); current_right_row += 1
+        gabung(L, current_right_row, col_start, current_right_row, col_start+2)
+        tulis(L, current_right_row, col_start, "RINCIAN SISA STOK BBM", 'tebal'); current_right_row += 1
         
-        def write_rekap_row(title, val, color=None):
+        def write_rekap_row(title, val, gaya='grid'):
             nonlocal current_right_row
-            ws.merge_cells(start_row=current_right_row, start_column=col_start, end_row=current_right_row, end_column=col_start+2)
-            ws.cell(current_right_row, col_start, title).border = thin
-            c = ws.cell(current_right_row, col_start+3, val); c.border = thin
-            if color: c.fill = PatternFill("solid", fgColor=color)
+            gabung(L, current_right_row, col_start, current_right_row, col_start+2)
+            tulis(L, current_right_row, col_start, title, 'grid'); tulis(L, current_right_row, col_start+3, val, gaya)
             current_right_row += 1
 
         write_rekap_row("SISA BULAN LALU", stok_awal)
         write_rekap_row("TOTAL MASUK", tm)
         write_rekap_row("TOTAL KELUAR", tk_real)
-        write_rekap_row("SISA AKHIR", sisa_akhir, "00FF00")
+        write_rekap_row("SISA AKHIR", sisa_akhir, 'hijau')
         
         current_right_row += 1
-        
-        img_buf = generate_chart_for_report(df_alat_chart, df_truck_chart, width_inch=4.5, height_inch=3.0)
-        if img_buf: 
-            img = XLImage(img_buf); img.width = 450; img.height = 450
-            ws.add_image(img, f'I{current_right_row}')
+        tambah_chart_pemakaian(ws, seri_chart, current_right_row)
+        tulis_sheet(ws, L, {'A': 5, 'B': 12, 'C': 25, 'D': 15, 'E': 10, 'F': 30, 'I': 5, 'J': 12, 'K': 25, 'L': 15, 'M': 10, 'N': 30})
 
-    ws2 = wb.create_sheet("Rekap Tahunan"); ws2['A1'] = "LAPORAN BBM PERBULAN"; ws2['A1'].font = Font(bold=True, size=14)
-    ws2.column_dimensions['A'].width = 25; ws2.column_dimensions['B'].width = 20; ws2.column_dimensions['C'].width = 20; ws2.column_dimensions['D'].width = 20; ws2.column_dimensions['E'].width = 20
-    m_data = []
-    stok_run = hitung_stok_awal_periode(conn, lokasi_id, start_date_global)
-    curr = start_date_global.replace(day=1); end_limit = end_date_global.replace(day=1)
-    while curr <= end_limit:
-        m = curr.month; y = curr.year
-        q_in = f"SELECT SUM(jumlah_liter) FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        q_out = f"SELECT SUM(jumlah_liter) FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        cursor = conn.cursor()
-        cursor.execute(q_in); res_in = cursor.fetchone(); mi = float(res_in[0]) if res_in and res_in[0] else 0.0
-        cursor.execute(q_out); res_out = cursor.fetchone(); mo = float(res_out[0]) if res_out and res_out[0] else 0.0
-        prev = stok_run; stok_run = prev + mi - mo
-        m_data.append({'bln': f"{get_bulan_indonesia(curr.month)} {curr.year}", 'awal': prev, 'masuk': mi, 'keluar': mo, 'sisa': stok_run, 'bulan_nama': get_bulan_indonesia(m)[:3]})
-        curr = curr + relativedelta(months=1)
-    df_m = pd.DataFrame(m_data)
-    img_m_buf = generate_monthly_chart(df_m)
-    if img_m_buf: img2 = XLImage(img_m_buf); img2.width=500; img2.height=250; ws2.add_image(img2, 'A3')
-    r2 = 18; headers = ['BULAN', 'SISA BULAN LALU', 'MASUK', 'KELUAR', 'SISA']
-    for i, h in enumerate(headers): c=ws2.cell(r2, i+1, h); c.border=thin; c.fill=PatternFill("solid", fgColor="D3D3D3")
-    r2+=1
-    for r in m_data:
-        vals = [r['bln'], r['awal'], r['masuk'], r['keluar'], r['sisa']]
-        for i, v in enumerate(vals): c=ws2.cell(r2, i+1, v); c.border=thin
-        r2+=1
-    if m_data:
-        t_masuk = sum(x['masuk'] for x in m_data); t_keluar = sum(x['keluar'] for x in m_data); akhir = m_data[-1]['sisa']
-        ws2.cell(r2, 1, "TOTAL").font = Font(bold=True); ws2.cell(r2, 3, t_masuk).font = Font(bold=True); ws2.cell(r2, 4, t_keluar).font = Font(bold=True); ws2.cell(r2, 5, akhir).font = Font(bold=True)
-        for i in range(1, 6): c = ws2.cell(r2, i); c.fill = PatternFill("solid", fgColor="FFD966"); c.border = thin
-    
-    df_keluar_all = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date_global}' AND '{end_date_global}'", conn)
-    if not df_keluar_all.empty:
-        if 'kategori' not in df_keluar_all.columns: df_keluar_all['kategori'] = df_keluar_all['nama_alat'].apply(cek_kategori)
-        df_keluar_rpt = filter_non_consumption(df_keluar_all)
-        df_alat_t, df_truck_t, _ = segregate_data(df_keluar_rpt, excluded_list)
-        img_usage = generate_chart_for_report(df_alat_t, df_truck_t, width_inch=7, height_inch=3.5)
-        if img_usage:
-            img3 = XLImage(img_usage); img3.width=500; img3.height=250
-            ws2.add_image(img3, 'H3')
+    sheet_rekap_excel(wb, model)
 
     wb.save(output); output.seek(0)
     return output
 
-def generate_docx_fixed(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list):
+def generate_docx_fixed(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, model=None, progres=None):
+    if model is None: model = bangun_model_laporan(conn, lokasi_id, start_date_global, end_date_global, excluded_list)
     doc = Document(); 
     for s in doc.sections: s.left_margin=Cm(1); s.right_margin=Cm(1)
-    date_ranges = split_date_range_by_month(start_date_global, end_date_global)
 
-    for idx, (start_date, end_date) in enumerate(date_ranges):
+    for idx, sec in enumerate(model['bulan']):
+        if progres: progres()
+        start_date = sec['start']
         if idx > 0: doc.add_page_break()
         p = doc.add_paragraph("LAPORAN BBM"); p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].bold = True; p.runs[0].font.size = Pt(14); p.paragraph_format.space_after = Pt(0)
         p_loc = doc.add_paragraph(nama_lokasi); p_loc.alignment = WD_ALIGN_PARAGRAPH.CENTER; p_loc.runs[0].bold = True; p_loc.runs[0].font.size = Pt(14); p_loc.paragraph_format.space_after = Pt(0)
@@ -1105,38 +1575,35 @@ def generate_docx_fixed(conn, lokasi_id, nama_lokasi, start_date_global, end_dat
         layout_table.columns[0].width = Cm(10); layout_table.columns[1].width = Cm(9)
         cell_left = layout_table.cell(0, 0); cell_right = layout_table.cell(0, 1)
 
-        stok_awal = hitung_stok_awal_periode(conn, lokasi_id, start_date)
-        df_keluar = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
-        if not df_keluar.empty and 'kategori' not in df_keluar.columns: df_keluar['kategori'] = df_keluar['nama_alat'].apply(cek_kategori)
-        
-        df_keluar_raw = filter_non_consumption(df_keluar)
-        df_keluar_table = process_transfers_for_table(df_keluar_raw)
-        df_alat_g, df_truck_g, df_lain_g = segregate_data(df_keluar_table, excluded_list)
-        df_alat_chart, df_truck_chart, _ = segregate_data(df_keluar_raw, excluded_list)
-        
+        stok_awal = sec['stok_awal']
+        df_alat_g, df_truck_g, df_lain_g = sec['alat_g'], sec['truck_g'], sec['lain_g']
+
         cell_left.add_paragraph("PENGGUNAAN BBM (KELUAR)", style='Heading 3')
         tbl_k = cell_left.add_table(rows=1, cols=4); tbl_k.style = 'Table Grid'
         h_k = tbl_k.rows[0].cells; h_k[0].text="TGL"; h_k[1].text="ALAT"; h_k[2].text="UNIT"; h_k[3].text="LTR"
         
-        processed_data = prepare_data_global_subtotals(df_keluar_table)
+        processed_data = sec['items']
         if processed_data:
+            def gaya_data(row, is_grey):
+                if is_grey:
+                    for c in row: set_cell_bg(c, "F2F2F2")
+                for c in row: c.text = ""; c.paragraphs[0].runs[0].font.size = Pt(8)
+            def gaya_total(row):
+                row[1].text = ""; row[3].text = ""
+                set_cell_bg(row[1], "F8CBAD"); set_cell_bg(row[3], "F8CBAD") # Orange
+                row[1].paragraphs[0].runs[0].font.bold = True; row[3].paragraphs[0].runs[0].font.bold = True
+                row[1].paragraphs[0].runs[0].font.size = Pt(8); row[3].paragraphs[0].runs[0].font.size = Pt(8)
+            t_putih = templat_baris_docx(tbl_k, lambda row: gaya_data(row, False)); t_abu = templat_baris_docx(tbl_k, lambda row: gaya_data(row, True))
+            t_total = templat_baris_docx(tbl_k, gaya_total)
             last_date = None; is_grey = False
             for item in processed_data:
                 if item['type'] == 'data':
                     curr_date = item['tanggal']; is_grey = not is_grey if last_date is not None and curr_date != last_date else is_grey; last_date = curr_date
-                    row = tbl_k.add_row().cells
-                    if is_grey:
-                        for c in row: set_cell_bg(c, "F2F2F2")
-                    row[0].text = item['tanggal'].strftime('%d/%m'); row[1].text = item['nama_alat']; row[2].text = item['no_unit']; row[3].text = f"{item['jumlah_liter']:.0f}"
-                    for c in row: c.paragraphs[0].runs[0].font.size = Pt(8)
+                    tambah_baris_docx(tbl_k, t_abu if is_grey else t_putih, [item['tanggal'].strftime('%d/%m'), item['nama_alat'], item['no_unit'], f"{item['jumlah_liter']:.0f}"])
                 elif item['type'] == 'daily_total':
-                    row = tbl_k.add_row().cells
-                    row[1].text = f"TOTAL {item['tanggal'].strftime('%d/%m')}"; row[3].text = f"{item['total_liter']:.0f}"
-                    set_cell_bg(row[1], "F8CBAD"); set_cell_bg(row[3], "F8CBAD") # Orange
-                    row[1].paragraphs[0].runs[0].font.bold = True; row[3].paragraphs[0].runs[0].font.bold = True
-                    row[1].paragraphs[0].runs[0].font.size = Pt(8); row[3].paragraphs[0].runs[0].font.size = Pt(8)
+                    tambah_baris_docx(tbl_k, t_total, [None, f"TOTAL {item['tanggal'].strftime('%d/%m')}", None, f"{item['total_liter']:.0f}"])
         
-        df_masuk = pd.read_sql(f"SELECT * FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
+        df_masuk = sec['df_masuk']
         cell_right.add_paragraph("BBM MASUK", style='Heading 3')
         tbl_m = cell_right.add_table(rows=1, cols=3); tbl_m.style='Table Grid'
         h_m = tbl_m.rows[0].cells; h_m[0].text="TGL"; h_m[1].text="SUMBER"; h_m[2].text="LTR"
@@ -1163,9 +1630,7 @@ def generate_docx_fixed(conn, lokasi_id, nama_lokasi, start_date_global, end_dat
         add_detailed_docx(cell_right, "TOTAL PENGGUNAAN BBM ALAT BERAT", df_alat_g, "F4B084"); cell_right.add_paragraph(""); add_detailed_docx(cell_right, "TOTAL PENGGUNAAN BBM MOBIL & TRUCK", df_truck_g, "9BC2E6"); cell_right.add_paragraph("")
         if not df_lain_g.empty: add_detailed_docx(cell_right, "TOTAL PENGGUNAAN BBM LAINNYA", df_lain_g, "FFB6C1"); cell_right.add_paragraph("")
 
-        tm = float(df_masuk['jumlah_liter'].sum()) if not df_masuk.empty else 0.0
-        tk_real = float(df_keluar['jumlah_liter'].sum()) if not df_keluar.empty else 0.0
-        sisa = stok_awal + tm - tk_real
+        tm, tk_real, sisa = sec['tm'], sec['tk_real'], sec['sisa_akhir']
         cell_right.add_paragraph("RINCIAN SISA STOK BBM", style='Heading 4')
         tbl_s = cell_right.add_table(rows=4, cols=2); tbl_s.style='Table Grid'
         tbl_s.cell(0,0).text="SISA BULAN LALU"; tbl_s.cell(0,1).text=f"{stok_awal:.0f}"
@@ -1173,29 +1638,16 @@ def generate_docx_fixed(conn, lokasi_id, nama_lokasi, start_date_global, end_dat
         tbl_s.cell(2,0).text="TOTAL KELUAR (REAL)"; tbl_s.cell(2,1).text=f"{tk_real:.0f}"
         tbl_s.cell(3,0).text="SISA AKHIR"; tbl_s.cell(3,1).text=f"{sisa:.0f}"
         
-        img_buf = generate_chart_for_report(df_alat_chart, df_truck_chart, width_inch=3.5, height_inch=2.5)
+        img_buf = grafik_bulan(sec, 3.5, 2.5)
         if img_buf: 
             cell_right.add_paragraph("")
             cell_right.add_paragraph().add_run().add_picture(img_buf, width=Cm(8))
 
     doc.add_page_break(); p_title = doc.add_paragraph("LAPORAN BBM PERBULAN"); p_title.alignment = WD_ALIGN_PARAGRAPH.CENTER; p_title.runs[0].bold=True; p_title.runs[0].font.size=Pt(14)
-    m_data = []; stok_run = hitung_stok_awal_periode(conn, lokasi_id, start_date_global)
-    curr = start_date_global.replace(day=1); end_limit = end_date_global.replace(day=1)
-    while curr <= end_limit:
-        m = curr.month; y = curr.year
-        q_in = f"SELECT SUM(jumlah_liter) FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        q_out = f"SELECT SUM(jumlah_liter) FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        cursor = conn.cursor()
-        cursor.execute(q_in); res_in = cursor.fetchone(); mi = float(res_in[0]) if res_in and res_in[0] else 0.0
-        cursor.execute(q_out); res_out = cursor.fetchone(); mo = float(res_out[0]) if res_out and res_out[0] else 0.0
-        prev = stok_run; stok_run = prev + mi - mo
-        m_data.append({'bln': f"{get_bulan_indonesia(curr.month)} {curr.year}", 'awal': prev, 'masuk': mi, 'keluar': mo, 'sisa': stok_run, 'bulan_nama': get_bulan_indonesia(m)[:3]})
-        curr = curr + relativedelta(months=1)
+    m_data = model['rekap']
 
-    df_m = pd.DataFrame(m_data)
-    if not df_m.empty:
-        img_m_buf = generate_monthly_chart(df_m)
-        if img_m_buf: doc.add_paragraph().add_run().add_picture(img_m_buf, width=Cm(16))
+    img_m_buf = grafik_rekap_bulanan(model)
+    if img_m_buf: doc.add_paragraph().add_run().add_picture(img_m_buf, width=Cm(16))
     doc.add_paragraph("RINCIAN MASUK DAN PENGGUNAAN SOLAR PERBULANNYA", style='Heading 4')
     tbl_month = doc.add_table(rows=1, cols=5); tbl_month.style='Table Grid'
     h_month = tbl_month.rows[0].cells
@@ -1211,19 +1663,15 @@ def generate_docx_fixed(conn, lokasi_id, nama_lokasi, start_date_global, end_dat
             if len(c.paragraphs) > 0 and len(c.paragraphs[0].runs) > 0: c.paragraphs[0].runs[0].font.bold = True
             elif len(c.paragraphs) > 0: c.paragraphs[0].add_run(c.text).font.bold = True
 
-    df_keluar_all = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date_global}' AND '{end_date_global}'", conn)
-    if not df_keluar_all.empty:
-        if 'kategori' not in df_keluar_all.columns: df_keluar_all['kategori'] = df_keluar_all['nama_alat'].apply(cek_kategori)
-        df_keluar_rpt = filter_non_consumption(df_keluar_all)
-        df_alat_t, df_truck_t, _ = segregate_data(df_keluar_rpt, excluded_list)
-        img_usage = generate_chart_for_report(df_alat_t, df_truck_t, width_inch=7, height_inch=3.5)
-        if img_usage:
-            doc.add_paragraph().add_run().add_picture(img_usage, width=Cm(16))
+    img_usage = grafik_pemakaian_total(model, 7, 3.5)
+    if img_usage:
+        doc.add_paragraph().add_run().add_picture(img_usage, width=Cm(16))
 
-    buffer = io.BytesIO(); doc.save(buffer); buffer.seek(0)
+    buffer = buffer_export(); doc.save(buffer); buffer.seek(0)
     return buffer
 
-def generate_docx_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list):
+def generate_docx_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, model=None, progres=None):
+    if model is None: model = bangun_model_laporan(conn, lokasi_id, start_date_global, end_date_global, excluded_list)
     doc = Document()
     section = doc.sections[0]
     section.page_height = Cm(55.88) 
@@ -1231,9 +1679,10 @@ def generate_docx_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end
     section.top_margin = Cm(0.5)
     section.bottom_margin = Cm(0.5)
     
-    date_ranges = split_date_range_by_month(start_date_global, end_date_global)
-    
-    for idx, (start_date, end_date) in enumerate(date_ranges):
+
+    for idx, sec in enumerate(model['bulan']):
+        if progres: progres()
+        start_date = sec['start']
         if idx > 0: doc.add_page_break()
         p = doc.add_paragraph("LAPORAN BBM"); 
         p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].bold=True; p.runs[0].font.size=Pt(14)
@@ -1245,23 +1694,12 @@ def generate_docx_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end
         p2.alignment = WD_ALIGN_PARAGRAPH.CENTER; p2.runs[0].bold=True; p2.runs[0].font.size=Pt(12)
         p2.paragraph_format.space_after = Pt(6) 
         
-        stok_awal = hitung_stok_awal_periode(conn, lokasi_id, start_date)
-        df_keluar = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
-        df_masuk = pd.read_sql(f"SELECT * FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date}' AND '{end_date}' ORDER BY tanggal", conn)
-        if not df_keluar.empty and 'kategori' not in df_keluar.columns: df_keluar['kategori'] = df_keluar['nama_alat'].apply(cek_kategori)
-        
-        df_keluar_raw = filter_non_consumption(df_keluar)
-        df_keluar_table = process_transfers_for_table(df_keluar_raw)
-        df_alat_g, df_truck_g, df_lain_g = segregate_data(df_keluar_table, excluded_list)
-        df_alat_chart, df_truck_chart, _ = segregate_data(df_keluar_raw, excluded_list)
+        stok_awal = sec['stok_awal']; df_masuk = sec['df_masuk']
+        df_alat_g, df_truck_g, df_lain_g = sec['alat_g'], sec['truck_g'], sec['lain_g']
+        tm, tk_real, tk_rpt, sisa_akhir = sec['tm'], sec['tk_real'], sec['tk_rpt'], sec['sisa_akhir']
 
-        tm = float(df_masuk['jumlah_liter'].sum()) if not df_masuk.empty else 0.0
-        tk_real = float(df_keluar['jumlah_liter'].sum()) if not df_keluar.empty else 0.0
-        tk_rpt = float(df_keluar_table['jumlah_liter'].sum()) if not df_keluar_table.empty else 0.0
-        sisa_akhir = stok_awal + tm - tk_real
-        
         SPLIT_IDX = 145
-        full_data_list = prepare_data_global_subtotals(df_keluar_table)
+        full_data_list = sec['items']
         data_left = full_data_list[:SPLIT_IDX]
         data_right = full_data_list[SPLIT_IDX:]
         
@@ -1280,22 +1718,29 @@ def generate_docx_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end
              set_cell_bg(c, "2F5496"); p = c.paragraphs[0]; p.runs[0].font.size = Pt(7)
              p.paragraph_format.space_after = Pt(0); p.paragraph_format.line_spacing = Pt(8)
         
-        last_date_l = None; is_grey_l = False
-        for item in data_left:
-            if item['type'] == 'data':
-                curr_date = item['tanggal']
-                if last_date_l is not None and curr_date != last_date_l: is_grey_l = not is_grey_l
-                last_date_l = curr_date
-                row = t_left.add_row().cells
-                row[0].text = str(item['no']); row[1].text = item['tanggal'].strftime('%d/%m'); row[2].text = item['nama_alat']; row[3].text = item['no_unit']; row[4].text = str(item['jumlah_liter'])
+        # Baris keluar (data / total harian) untuk tabel kiri dan lanjutan kanan
+        def isi_tabel_keluar(tabel, items):
+            def gaya_data(row, is_grey):
                 for c in row: 
-                    p = c.paragraphs[0]; p.runs[0].font.size = Pt(7); p.paragraph_format.space_after = Pt(0); p.paragraph_format.line_spacing = Pt(8)
-                    if is_grey_l: set_cell_bg(c, "F2F2F2")
-            elif item['type'] == 'daily_total':
-                 row = t_left.add_row().cells
-                 row[2].text = f"TOTAL {item['tanggal'].strftime('%d/%m')}"; row[4].text = f"{item['total_liter']:.0f}"
-                 set_cell_bg(row[2], "F8CBAD"); set_cell_bg(row[4], "F8CBAD")
-                 row[2].paragraphs[0].runs[0].font.bold=True; row[4].paragraphs[0].runs[0].font.bold=True
+                    c.text = ""; p = c.paragraphs[0]; p.runs[0].font.size = Pt(7); p.paragraph_format.space_after = Pt(0); p.paragraph_format.line_spacing = Pt(8)
+                    if is_grey: set_cell_bg(c, "F2F2F2")
+            def gaya_total(row):
+                row[2].text = ""; row[4].text = ""
+                set_cell_bg(row[2], "F8CBAD"); set_cell_bg(row[4], "F8CBAD")
+                row[2].paragraphs[0].runs[0].font.bold=True; row[4].paragraphs[0].runs[0].font.bold=True
+            t_putih = templat_baris_docx(tabel, lambda row: gaya_data(row, False)); t_abu = templat_baris_docx(tabel, lambda row: gaya_data(row, True))
+            t_total = templat_baris_docx(tabel, gaya_total)
+            last_date = None; is_grey = False
+            for item in items:
+                if item['type'] == 'data':
+                    curr_date = item['tanggal']
+                    if last_date is not None and curr_date != last_date: is_grey = not is_grey
+                    last_date = curr_date
+                    tambah_baris_docx(tabel, t_abu if is_grey else t_putih, [str(item['no']), item['tanggal'].strftime('%d/%m'), item['nama_alat'], item['no_unit'], str(item['jumlah_liter'])])
+                elif item['type'] == 'daily_total':
+                    tambah_baris_docx(tabel, t_total, [None, None, f"TOTAL {item['tanggal'].strftime('%d/%m')}", None, f"{item['total_liter']:.0f}"])
+
+        isi_tabel_keluar(t_left, data_left)
         
         if not data_right:
              row = t_left.add_row().cells; row[2].text = "TOTAL"; row[4].text = f"{tk_rpt:.0f}"
@@ -1311,22 +1756,7 @@ def generate_docx_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end
                 set_cell_bg(c, "2F5496"); p = c.paragraphs[0]; p.runs[0].font.size = Pt(7)
                 p.paragraph_format.space_after = Pt(0); p.paragraph_format.line_spacing = Pt(8)
             
-            last_date_r = None; is_grey_r = False
-            for item in data_right:
-                if item['type'] == 'data':
-                    curr_date = item['tanggal']
-                    if last_date_r is not None and curr_date != last_date_r: is_grey_r = not is_grey_r
-                    last_date_r = curr_date
-                    row = t_rt.add_row().cells
-                    row[0].text = str(item['no']); row[1].text = item['tanggal'].strftime('%d/%m'); row[2].text = item['nama_alat']; row[3].text = item['no_unit']; row[4].text = str(item['jumlah_liter'])
-                    for c in row: 
-                         p = c.paragraphs[0]; p.runs[0].font.size = Pt(7); p.paragraph_format.space_after = Pt(0); p.paragraph_format.line_spacing = Pt(8)
-                         if is_grey_r: set_cell_bg(c, "F2F2F2")
-                elif item['type'] == 'daily_total':
-                     row = t_rt.add_row().cells
-                     row[2].text = f"TOTAL {item['tanggal'].strftime('%d/%m')}"; row[4].text = f"{item['total_liter']:.0f}"
-                     set_cell_bg(row[2], "F8CBAD"); set_cell_bg(row[4], "F8CBAD")
-                     row[2].paragraphs[0].runs[0].font.bold=True; row[4].paragraphs[0].runs[0].font.bold=True
+            isi_tabel_keluar(t_rt, data_right)
             
             row = t_rt.add_row().cells; row[2].text = "TOTAL"; row[4].text = f"{tk_rpt:.0f}"
             set_cell_bg(row[4], "FFFF00"); row[4].paragraphs[0].paragraph_format.space_after = Pt(0)
@@ -1379,29 +1809,16 @@ def generate_docx_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end
         doc.add_paragraph() 
         doc.add_paragraph()
 
-        img_buf = generate_chart_for_report(df_alat_chart, df_truck_chart, width_inch=3.5, height_inch=2.5)
+        img_buf = grafik_bulan(sec, 3.5, 2.5)
         if img_buf: 
             cell_right.add_paragraph("")
             cell_right.add_paragraph().add_run().add_picture(img_buf, width=Cm(8))
 
     doc.add_page_break(); p_title = doc.add_paragraph("LAPORAN BBM PERBULAN"); p_title.alignment = WD_ALIGN_PARAGRAPH.CENTER; p_title.runs[0].bold=True; p_title.runs[0].font.size=Pt(14)
-    m_data = []; stok_run = hitung_stok_awal_periode(conn, lokasi_id, start_date_global)
-    curr = start_date_global.replace(day=1); end_limit = end_date_global.replace(day=1)
-    while curr <= end_limit:
-        m = curr.month; y = curr.year
-        q_in = f"SELECT SUM(jumlah_liter) FROM bbm_masuk WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        q_out = f"SELECT SUM(jumlah_liter) FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND MONTH(tanggal)={m} AND YEAR(tanggal)={y}"
-        cursor = conn.cursor()
-        cursor.execute(q_in); res_in = cursor.fetchone(); mi = float(res_in[0]) if res_in and res_in[0] else 0.0
-        cursor.execute(q_out); res_out = cursor.fetchone(); mo = float(res_out[0]) if res_out and res_out[0] else 0.0
-        prev = stok_run; stok_run = prev + mi - mo
-        m_data.append({'bln': f"{get_bulan_indonesia(curr.month)} {curr.year}", 'awal': prev, 'masuk': mi, 'keluar': mo, 'sisa': stok_run, 'bulan_nama': get_bulan_indonesia(m)[:3]})
-        curr = curr + relativedelta(months=1)
+    m_data = model['rekap']
 
-    df_m = pd.DataFrame(m_data)
-    if not df_m.empty:
-        img_m_buf = generate_monthly_chart(df_m)
-        if img_m_buf: doc.add_paragraph().add_run().add_picture(img_m_buf, width=Cm(16))
+    img_m_buf = grafik_rekap_bulanan(model)
+    if img_m_buf: doc.add_paragraph().add_run().add_picture(img_m_buf, width=Cm(16))
     doc.add_paragraph("RINCIAN MASUK DAN PENGGUNAAN SOLAR PERBULANNYA", style='Heading 4')
     tbl_month = doc.add_table(rows=1, cols=5); tbl_month.style='Table Grid'
     h_month = tbl_month.rows[0].cells
@@ -1420,35 +1837,509 @@ def generate_docx_one_sheet(conn, lokasi_id, nama_lokasi, start_date_global, end
     doc.add_paragraph() 
     doc.add_paragraph()
 
-    df_keluar_all = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id} AND tanggal BETWEEN '{start_date_global}' AND '{end_date_global}'", conn)
-    if not df_keluar_all.empty:
-        if 'kategori' not in df_keluar_all.columns: df_keluar_all['kategori'] = df_keluar_all['nama_alat'].apply(cek_kategori)
-        df_keluar_rpt = filter_non_consumption(df_keluar_all)
-        df_alat_t, df_truck_t, _ = segregate_data(df_keluar_rpt, excluded_list)
-        img_usage = generate_chart_for_report(df_alat_t, df_truck_t, width_inch=7, height_inch=3.5)
-        if img_usage:
-            doc.add_paragraph().add_run().add_picture(img_usage, width=Cm(16))
+    img_usage = grafik_pemakaian_total(model, 7, 3.5)
+    if img_usage:
+        doc.add_paragraph().add_run().add_picture(img_usage, width=Cm(16))
+
+    buffer = buffer_export(); doc.save(buffer); buffer.seek(0)
+    return buffer
 
-    buffer = io.BytesIO(); doc.save(buffer); buffer.seek(0)
+# Pasangan generator per mode export: (pdf, excel, docx)
+GENERATOR_EXPORT = {
+    False: (generate_pdf_portrait, generate_excel_styled, generate_docx_fixed),
+    True: (generate_pdf_one_sheet, generate_excel_one_sheet, generate_docx_one_sheet),
+}
+
+# Ukuran grafik yang diminta tiap generator (lihat pemanggilan grafik_bulan / grafik_pemakaian_total), untuk pre-render paralel
+UKURAN_GRAFIK_BULAN = {'generate_pdf_portrait': (3.5, 2.5), 'generate_pdf_one_sheet': (3.5, 2.5), 'generate_docx_fixed': (3.5, 2.5), 'generate_docx_one_sheet': (3.5, 2.5)}
+UKURAN_GRAFIK_TOTAL = (7, 3.5)
+
+def generate_semua_format(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, satu_kertas=False, model=None, progres=None):
+    # Satu kali hitung model, tiga renderer; hasil dibungkus ZIP
+    if model is None: model = bangun_model_laporan(conn, lokasi_id, start_date_global, end_date_global, excluded_list)
+    gen_pdf, gen_xl, gen_doc = GENERATOR_EXPORT[satu_kertas]
+    nama_file = f"Laporan_{nama_lokasi}_{start_date_global}_{end_date_global}"
+    buffer = buffer_export()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for gen, ext in [(gen_pdf, 'pdf'), (gen_xl, 'xlsx'), (gen_doc, 'docx')]:
+            # Disalin per potong dari buffer generator, dokumen tidak perlu utuh di memori sebagai bytes
+            info = zipfile.ZipInfo(f"{nama_file}.{ext}", datetime.datetime.now().timetuple()[:6]); info.compress_type = zipfile.ZIP_DEFLATED
+            with gen(conn, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, model=model, progres=progres) as f, zf.open(info, 'w') as z: shutil.copyfileobj(f, z)
+    buffer.seek(0)
+    return buffer
+
+# --- EXPORT DATA MENTAH ---
+# Riwayat bbm_masuk/bbm_keluar apa adanya untuk audit, satu lokasi atau semua lokasi (lokasi_id 0). Baris dibaca per potongan
+# lewat server-side cursor (stream_results -> SSCursor pymysql) dan langsung ditulis ke entri ZIP, memori tetap datar
+# berapa pun panjang riwayatnya.
+BARIS_PER_POTONG = 20000
+KOLOM_MENTAH = {'bbm_masuk': KOLOM_MASUK_LAPORAN, 'bbm_keluar': KOLOM_KELUAR_LAPORAN}
+TIPE_PARQUET = {'id': pa.int64(), 'lokasi_id': pa.int64(), 'tanggal': pa.date32(), 'jumlah_liter': pa.float64()} # kolom lain string
+
+def _potongan_mentah(engine, tabel, lokasi_id):
+    kolom = ", ".join(f"t.{k}" for k in KOLOM_MENTAH[tabel].split(", "))
+    sql = f"SELECT t.lokasi_id, l.nama_tempat AS lokasi, {kolom} FROM {tabel} t JOIN lokasi_proyek l ON l.id = t.lokasi_id"
+    sql += (" WHERE t.lokasi_id = %(lokasi_id)s" if lokasi_id else "") + " ORDER BY t.lokasi_id, t.tanggal, t.id"
+    with engine.connect().execution_options(stream_results=True) as conn:
+        yield from pd.read_sql(sql, conn, params={'lokasi_id': lokasi_id}, chunksize=BARIS_PER_POTONG)
+
+def _tulis_csv_mentah(potongan, f):
+    teks = io.TextIOWrapper(f, encoding='utf-8', newline='')
+    for i, df in enumerate(potongan): df.to_csv(teks, index=False, header=(i == 0))
+    teks.flush(); teks.detach()
+
+def _tulis_parquet_mentah(potongan, f, tabel):
+    # Skema tetap dari daftar kolom: potongan yang kolomnya kosong semua (tipe null) tetap cocok dengan potongan lain
+    skema = pa.schema([(k, TIPE_PARQUET.get(k, pa.string())) for k in ['lokasi_id', 'lokasi'] + KOLOM_MENTAH[tabel].split(", ")])
+    penulis = pq.ParquetWriter(f, skema)
+    try:
+        for df in potongan: penulis.write_table(pa.Table.from_pandas(df, schema=skema, preserve_index=False))
+    finally: penulis.close()
+
+def export_data_mentah(engine, lokasi_id, nama_lokasi, format_file='csv', progres=None):
+    buffer = buffer_export()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for tabel in KOLOM_MENTAH:
+            # Parquet sudah terkompresi sendiri, cukup disimpan apa adanya di ZIP
+            info = zipfile.ZipInfo(f"{tabel}_{nama_lokasi}.{format_file}", datetime.datetime.now().timetuple()[:6]); info.compress_type = zipfile.ZIP_DEFLATED if format_file == 'csv' else zipfile.ZIP_STORED
+            # Ukuran entri tidak diketahui di muka (ditulis per potongan): header ZIP64 sejak awal agar entri > 2 GiB tidak gagal di tengah
+            with zf.open(info, 'w', force_zip64=True) as z:
+                if format_file == 'csv': _tulis_csv_mentah(_potongan_mentah(engine, tabel, lokasi_id), z)
+                else: _tulis_parquet_mentah(_potongan_mentah(engine, tabel, lokasi_id), z, tabel)
+            if progres: progres()
+    buffer.seek(0)
     return buffer
 
+def versi_semua_lokasi(cursor):
+    # Kunci cache export semua lokasi: berubah bila data lokasi mana pun berubah, lokasi ditambah atau dihapus
+    cursor.execute("SELECT id, data_versi FROM lokasi_proyek ORDER BY id")
+    return int(hashlib.sha256(repr(cursor.fetchall()).encode()).hexdigest()[:12], 16)
+
+# --- CACHE EXPORT (DISK) ---
+# Hasil export disimpan di disk, kunci = hash (generator, lokasi, periode, exclude, data_versi). Tulis data apa pun menaikkan
+# data_versi sehingga kunci lama tidak terpakai lagi; file versi lama lokasi tsb dibuang saat versi baru ditulis.
+# File cache sekaligus jadi hasil job: render menulis ke file .tmp di folder ini lalu di-rename, server tidak memegang bytes-nya.
+DIR_CACHE_EXPORT = os.path.join(tempfile.gettempdir(), 'bbm_lembu_export')
+MAKS_CACHE_EXPORT = 512 * 1024 * 1024 # byte
+# Folder cache bertahan lintas restart/deploy: kunci ikut versi render (naikkan manual bila perlu) + hash kode sumber
+# generator & helper-nya, supaya dokumen hasil kode lama tidak terpakai lagi setelah deploy.
+VERSI_RENDER = 1
+with open(os.path.abspath(__file__), 'rb') as _f: SIDIK_RENDER = f"{VERSI_RENDER}-{hashlib.sha256(_f.read()).hexdigest()[:16]}"
+_lock_cache_export = threading.Lock()
+
+def _path_cache_export(nama_gen, lokasi_id, nama_lokasi, start, end, excluded_list, versi_data, opsi):
+    kunci = repr((nama_gen, int(lokasi_id), nama_lokasi, str(start), str(end), sorted(excluded_list), int(versi_data), sorted(opsi.items()), GRAFIK_PDF_VEKTOR, SIDIK_RENDER))
+    return os.path.join(DIR_CACHE_EXPORT, f"{int(lokasi_id)}_{int(versi_data)}_{hashlib.sha256(kunci.encode()).hexdigest()}.bin")
+
+def _rapikan_cache_export(lokasi_id, versi_data):
+    # Buang versi lama lokasi ini, lalu LRU (mtime = akses terakhir) sampai total di bawah batas.
+    # File hasil job yang masih menunggu diunduh tidak ikut dibuang
+    files = []; pin = _file_job_selesai()
+    for nama in os.listdir(DIR_CACHE_EXPORT):
+        p = os.path.join(DIR_CACHE_EXPORT, nama)
+        if p in pin: continue
+        try:
+            # Sisa .tmp dari render yang mati di tengah jalan
+            if nama.endswith('.tmp') and os.stat(p).st_mtime < time.time() - 3600: os.remove(p); continue
+            if not nama.endswith('.bin'): continue
+            lok, versi, _ = nama.split('_', 2)
+            if lok == str(lokasi_id) and versi != str(versi_data): os.remove(p); continue
+            st_f = os.stat(p); files.append((st_f.st_mtime, st_f.st_size, p))
+        except (OSError, ValueError): continue
+    total = sum(f[1] for f in files)
+    for _, ukuran, p in sorted(files):
+        if total <= MAKS_CACHE_EXPORT: break
+        try: os.remove(p); total -= ukuran
+        except OSError: pass
+
+def _sentuh_cache_export(path):
+    # True bila file cache ada; mtime diperbarui sebagai tanda akses terakhir (LRU)
+    try: os.utime(path, None); return True
+    except OSError: return False
+
+def _tmp_cache_export(path):
+    os.makedirs(DIR_CACHE_EXPORT, exist_ok=True)
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+def _simpan_cache_export(path, tmp, lokasi_id, versi_data):
+    with _lock_cache_export:
+        os.replace(tmp, path)
+        _rapikan_cache_export(lokasi_id, versi_data)
+
+def _render_ke_cache(path, lokasi_id, versi_data, render):
+    # render(tmp) menulis dokumen ke file tmp; tmp dibuang bila render/rename gagal
+    tmp = _tmp_cache_export(path)
+    try: render(tmp); _simpan_cache_export(path, tmp, lokasi_id, versi_data)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def baca_hasil_export(job):
+    # Dipanggil Streamlit saat tombol download diklik (deferred), bytes hanya ada selama dikirim.
+    # File hilang/tak terbaca (dihapus di luar aplikasi, disk bermasalah): job ditandai gagal agar bisa diajukan ulang
+    if job.get('data') is not None: return job['data']
+    try:
+        _sentuh_cache_export(job['hasil'])
+        with open(job['hasil'], 'rb') as f: return f.read()
+    except OSError as e:
+        job['error'] = "file hasil tidak bisa dibaca, silakan export ulang"; job['status'] = 'gagal'
+        raise RuntimeError(job['error']) from e
+
+# --- ANTRIAN JOB EXPORT ---
+# Export berjalan di thread pool bersama (maks MAKS_JOB_EXPORT job berat sekaligus per server), sesi tetap bisa dipakai.
+# Registry job ada di memori proses; sesi hanya menyimpan id job miliknya. Id job = kunci cache export, jadi klik ulang tidak menambah antrian.
+# Thread job hanya mengambil data (bangun_model_laporan); render reportlab/docx/openpyxl (CPU, kena GIL) dikirim ke process pool
+# beserta model yang sudah jadi. Progres per bulan dari proses render dikirim lewat satu antrian Manager bersama (isi = id job).
+MAKS_JOB_EXPORT = 2
+MAKS_JOB_SIMPAN = 50
+
+def _buat_pool_render():
+    # spawn, bukan fork: server Streamlit multi-thread. Worker meng-import ulang main.py (guard __main__ mencegah UI jalan)
+    # Jumlah job tetap dibatasi MAKS_JOB_EXPORT; worker render sebanyak core supaya grafik per bulan bisa paralel
+    return ProcessPoolExecutor(max_workers=max(MAKS_JOB_EXPORT, os.cpu_count() or 1), mp_context=multiprocessing.get_context('spawn'))
+
+@st.cache_resource
+def _registry_job_export():
+    reg = {'lock': threading.Lock(), 'pool': ThreadPoolExecutor(max_workers=MAKS_JOB_EXPORT, thread_name_prefix='export'), 'render': None, 'progres': None, 'jobs': OrderedDict()}
+    # Process pool gagal dibuat (mis. __main__ tidak bisa di-import ulang): job dirender di thread-nya sendiri
+    try: manager = multiprocessing.get_context('spawn').Manager(); reg.update(render=_buat_pool_render(), manager=manager, progres=manager.Queue())
+    except (OSError, EOFError, RuntimeError): pass
+    return reg
+
+def _di_proses(fn, *args):
+    # Error render dikembalikan sebagai nilai: exception dari future berarti job gagal dikirim/diterima (pickle, worker mati)
+    try: return True, fn(*args)
+    except OSError: raise # Folder cache penuh / read-only: diteruskan apa adanya, job lalu dirender ke memori
+    except Exception as e: return False, str(e)
+
+def _hasil_proses(hasil):
+    ok, isi = hasil
+    if not ok: raise RuntimeError(isi)
+    return isi
+
+def _render_di_proses(job_id, gen, model, args, opsi, antrian, tujuan):
+    # Hasil ditulis langsung ke file tujuan oleh worker, tidak dikirim balik sebagai bytes lewat pickle
+    lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, _ = args
+    salin_ke_file(gen(None, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, model=model, progres=lambda: antrian.put(job_id), **opsi), tujuan)
+
+def _tunggu_render(reg, fut):
+    # Selama menunggu, kuras antrian progres (boleh milik job lain) dan tambahkan ke job yang bersangkutan
+    while True:
+        try: job_id = reg['progres'].get(timeout=0.3)
+        except queue.Empty:
+            if fut.done(): return fut.result()
+            continue
+        job = reg['jobs'].get(job_id)
+        if job is not None: job['langkah'] += 1
+
+def _png_grafik(buat, *args):
+    buf = buat(*args)
+    return buf.getvalue() if buf else None
+
+def _grafik_paralel(reg, gen, model, opsi):
+    # Bagian bulan saling lepas (stok berjalan sudah dihitung di model): grafik tiap bulan + total + rekap dirender serentak
+    # di process pool dan mengisi memo model, jadi generator tinggal menyusun dokumen
+    gens = GENERATOR_EXPORT[opsi.get('satu_kertas', False)] if gen.__name__ == 'generate_semua_format' else (gen,)
+    gens = [g for g in gens if g.__name__ in UKURAN_GRAFIK_BULAN and not (GRAFIK_PDF_VEKTOR and g.__name__.startswith('generate_pdf'))] # Excel (chart native) & PDF vektor tidak butuh PNG
+    if not gens: return
+    di_proses, png, chart = _fungsi_terkini(_di_proses), _fungsi_terkini(_png_grafik), _fungsi_terkini(generate_chart_for_report)
+    tugas = [(model, UKURAN_GRAFIK_TOTAL, reg['render'].submit(di_proses, png, chart, model['alat_total'], model['truck_total'], *UKURAN_GRAFIK_TOTAL)),
+             (model, 'rekap', reg['render'].submit(di_proses, png, _fungsi_terkini(generate_monthly_chart), pd.DataFrame(model['rekap'])))]
+    for ukuran in {UKURAN_GRAFIK_BULAN[g.__name__] for g in gens}:
+        tugas += [(sec, ukuran, reg['render'].submit(di_proses, png, chart, sec['alat_chart'], sec['truck_chart'], *ukuran)) for sec in model['bulan']]
+    for wadah, kunci, fut in tugas: wadah['grafik'][kunci] = _hasil_proses(fut.result())
+
+def _fungsi_terkini(fn):
+    # Streamlit memasang modul __main__ baru tiap rerun, pickle menolak fungsi yang bukan objek di modul terdaftar saat ini
+    return getattr(sys.modules.get(fn.__module__), fn.__name__, fn)
+
+def _render_job(job, gen, model, args, opsi, tujuan):
+    reg = _registry_job_export()
+    if reg['render'] is not None:
+        try:
+            _grafik_paralel(reg, gen, model, opsi)
+            fut = reg['render'].submit(_fungsi_terkini(_di_proses), _fungsi_terkini(_render_di_proses), job['id'], _fungsi_terkini(gen), model, args, opsi, reg['progres'], tujuan)
+            return _hasil_proses(_tunggu_render(reg, fut))
+        except (BrokenProcessPool, pickle.PicklingError, TypeError, AttributeError) as e:
+            # Worker mati (pool dibuat ulang) / objek tidak bisa dikirim (pickle bisa melempar TypeError/AttributeError):
+            # job ini dirender di thread saja. Error render asli datang lewat _hasil_proses (RuntimeError), tidak tertangkap di sini
+            if isinstance(e, BrokenProcessPool):
+                with reg['lock']: lama, reg['render'] = reg['render'], _buat_pool_render()
+                lama.shutdown(wait=False)
+    lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, _ = args
+    def progres(): job['langkah'] += 1
+    salin_ke_file(gen(None, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, model=model, progres=progres, **opsi), tujuan)
+
+def _jumlah_bulan(start, end): return (end.year - start.year) * 12 + end.month - start.month + 1
+
+def _jalankan_job_export(job, engine, gen, args, opsi):
+    job['status'] = 'jalan'
+    lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, versi_data = args
+    path = _path_cache_export(gen.__name__, *args, opsi)
+    def progres(): job['langkah'] += 1
+    try:
+        if not _sentuh_cache_export(path):
+            if gen is export_data_mentah:
+                # Data mentah: I/O database saja, ditulis langsung di thread job (tanpa model & process pool)
+                buat = lambda: gen(engine, lokasi_id, nama_lokasi, progres=progres, **opsi)
+                render = lambda tmp: salin_ke_file(buat(), tmp)
+            else:
+                conn = engine.raw_connection()
+                try: model = bangun_model_laporan(conn, lokasi_id, start_date_global, end_date_global, excluded_list)
+                finally: conn.close()
+                buat = lambda: gen(None, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, model=model, progres=progres, **opsi)
+                render = lambda tmp: _render_job(job, gen, model, args, opsi, tmp)
+            try: _render_ke_cache(path, lokasi_id, versi_data, render)
+            except OSError:
+                # Folder cache penuh / read-only: gagal tulis cache tidak boleh menggagalkan export, dokumen disimpan di job (memori)
+                job['langkah'] = 0
+                with buat() as buf: job['data'] = buf.read()
+                job['status'] = 'selesai'; return
+        job['hasil'] = path; job['status'] = 'selesai'
+    except Exception as e: job['error'] = str(e); job['status'] = 'gagal'
+
+def ajukan_job_export(gen, lokasi_id, nama_lokasi, start_date_global, end_date_global, excluded_list, versi_data, nama_file, mime, **opsi):
+    args = (lokasi_id, nama_lokasi, start_date_global, end_date_global, list(excluded_list), versi_data)
+    job_id = os.path.basename(_path_cache_export(gen.__name__, *args, opsi))[:-4]
+    reg = _registry_job_export()
+    with reg['lock']:
+        job = reg['jobs'].get(job_id)
+        if job is None or job['status'] == 'gagal':
+            n_gen = 3 if gen is generate_semua_format else 1
+            total, satuan = (len(KOLOM_MENTAH), 'tabel') if gen is export_data_mentah else (n_gen * _jumlah_bulan(start_date_global, end_date_global), 'bulan')
+            job = {'id': job_id, 'status': 'antri', 'langkah': 0, 'total': total, 'satuan': satuan, 'hasil': None, 'data': None, 'error': None, 'nama_file': nama_file, 'mime': mime}
+            reg['jobs'][job_id] = job
+            reg['pool'].submit(_jalankan_job_export, job, init_engine(), gen, args, opsi)
+        reg['jobs'].move_to_end(job_id)
+        lama = [k for k, j in reg['jobs'].items() if j['status'] in ('selesai', 'gagal') and k != job_id]
+        for k in lama[:max(0, len(reg['jobs']) - MAKS_JOB_SIMPAN)]: del reg['jobs'][k]
+    return job_id
+
+def _file_job_selesai():
+    # File hasil job selesai di registry (maks MAKS_JOB_SIMPAN) dipertahankan dari pembersihan cache sampai job-nya tergeser
+    reg = _registry_job_export()
+    with reg['lock']: return {j['hasil'] for j in reg['jobs'].values() if j['status'] == 'selesai' and j['hasil']}
+
+def _job_sesi():
+    reg = _registry_job_export()
+    with reg['lock']: jobs = [reg['jobs'].get(i) for i in st.session_state.get('export_jobs', [])]
+    st.session_state.export_jobs = [j['id'] for j in jobs if j is not None]
+    return [j for j in jobs if j is not None]
+
+def tampilkan_job_export():
+    for job in _job_sesi():
+        with st.container(border=True):
+            c_j1, c_j2 = st.columns([4, 1])
+            # File hasil bisa sudah terbuang oleh pembersihan cache (LRU / data versi baru): job dianggap gagal, bisa diajukan ulang
+            if job['status'] == 'selesai' and job['data'] is None and not os.path.exists(job['hasil']): job['error'] = "file hasil sudah dibersihkan, silakan export ulang"; job['status'] = 'gagal'
+            if job['status'] == 'selesai':
+                c_j1.success(f"✅ {job['nama_file']}")
+                c_j2.download_button("⬇️ Simpan", lambda j=job: baca_hasil_export(j), job['nama_file'], job['mime'], key=f"dl_{job['id']}", on_click="ignore", use_container_width=True)
+            elif job['status'] == 'gagal': c_j1.error(f"❌ {job['nama_file']}: {job['error']}")
+            else: c_j1.progress(min(job['langkah'] / (job['total'] + 1), 1.0), text=f"{'⏳ Antri' if job['status'] == 'antri' else '⚙️ Proses'}: {job['nama_file']} ({min(job['langkah'], job['total'])}/{job['total']} {job['satuan']})")
+            if job['status'] in ('selesai', 'gagal') and c_j2.button("Tutup", key=f"tutup_{job['id']}", use_container_width=True):
+                st.session_state.export_jobs.remove(job['id']); st.rerun()
+
+@st.fragment(run_every=2)
+def panel_job_export():
+    # Polling hanya selama masih ada job aktif; setelah semua selesai kembali ke full rerun sekali agar polling berhenti
+    tampilkan_job_export()
+    if not any(j['status'] in ('antri', 'jalan') for j in _job_sesi()): st.rerun()
+
+def daftar_job_export():
+    # Daftar job export sesi ini; dokumen disusun di background, tombol simpan muncul saat selesai
+    if any(j['status'] in ('antri', 'jalan') for j in _job_sesi()): panel_job_export()
+    else: tampilkan_job_export()
+
+def ajukan_export_mentah(lokasi_id, nama_lokasi, versi_data, format_file):
+    mime = "application/zip"
+    job_id = ajukan_job_export(export_data_mentah, lokasi_id, nama_lokasi, None, None, [], versi_data, f"Data_Mentah_{nama_lokasi}_{datetime.date.today()}.zip", mime, format_file=format_file)
+    if 'export_jobs' not in st.session_state: st.session_state.export_jobs = []
+    if job_id not in st.session_state.export_jobs: st.session_state.export_jobs.append(job_id)
+
+# --- PANEL INPUT & RIWAYAT (FRAGMENT) ---
+# Submit form / edit riwayat hanya menjalankan ulang panel ini, bukan seluruh main() (laporan & grafik tab lain tidak dihitung ulang)
+def _rerun_panel():
+    # scope="fragment" ditolak Streamlit bila panel sedang ikut full run, jatuh ke rerun biasa
+    try: st.rerun(scope="fragment")
+    except st.errors.StreamlitAPIException: st.rerun()
+
+@st.fragment
+def panel_input_riwayat(lokasi_id):
+    conn = init_engine().raw_connection(); cursor = conn.cursor()
+    cursor.execute("SELECT data_versi FROM lokasi_proyek WHERE id=%s", (lokasi_id,)); versi_data = cursor.fetchone()[0]
+
+    st.subheader("Input Transaksi BBM")
+    mode_transaksi = st.radio("Pilih Jenis Transaksi:", ["📥 BBM MASUK", "📤 PENGGUNAAN BBM", "🔄 PINJAM / TRANSFER ANTAR UNIT"], horizontal=True)
+    with st.container(border=True):
+        if mode_transaksi == "📥 BBM MASUK":
+            with st.form("form_masuk"):
+                c1, c2 = st.columns(2)
+                with c1: tg = st.date_input("Tanggal Masuk"); sm = st.text_input("Sumber / Supplier")
+                with c2: jn = st.selectbox("Jenis BBM", ["Dexlite","Solar","Bensin"]); jl = st.number_input("Jumlah Liter", 0.0); kt = st.text_area("Keterangan")
+                if st.form_submit_button("Simpan BBM Masuk"):
+                    cursor.execute("SELECT id FROM bbm_masuk WHERE lokasi_id=%s AND tanggal=%s AND sumber=%s AND jumlah_liter=%s", (lokasi_id, tg, sm, jl))
+                    if cursor.fetchall(): st.warning("⚠️ Data serupa sudah ada!") 
+                    cursor.execute("INSERT INTO bbm_masuk (lokasi_id, tanggal, sumber, jenis_bbm, jumlah_liter, keterangan) VALUES (%s,%s,%s,%s,%s,%s)", (lokasi_id, tg, sm, jn, jl, kt)); tambah_mutasi_stok(cursor, lokasi_id, 'bbm_masuk', tg, jl); naikkan_versi_data(cursor, lokasi_id); conn.commit(); st.success("Data Masuk Tersimpan!"); _rerun_panel()
+        elif mode_transaksi == "📤 PENGGUNAAN BBM":
+            with st.form("form_keluar"):
+                c1, c2 = st.columns(2)
+                with c1: tg_p = st.date_input("Tanggal Pakai"); al = st.text_input("Nama Alat/Kendaraan"); un = st.text_input("Kode Unit (Ex: DT-01)")
+                with c2: jl_p = st.number_input("Liter Digunakan", 0.0); kt_p = st.text_area("Keterangan / Lokasi Kerja")
+                if st.form_submit_button("Simpan Penggunaan"):
+                    cursor.execute("SELECT id FROM bbm_keluar WHERE lokasi_id=%s AND tanggal=%s AND nama_alat=%s AND no_unit=%s AND jumlah_liter=%s", (lokasi_id, tg_p, al, un, jl_p))
+                    if cursor.fetchall(): st.warning("⚠️ Data serupa sudah ada!") 
+                    cursor.execute("INSERT INTO bbm_keluar (lokasi_id, tanggal, nama_alat, no_unit, jumlah_liter, keterangan) VALUES (%s,%s,%s,%s,%s,%s)", (lokasi_id, tg_p, al, un, jl_p, kt_p)); tambah_mutasi_stok(cursor, lokasi_id, 'bbm_keluar', tg_p, jl_p); naikkan_versi_data(cursor, lokasi_id); conn.commit(); st.success("Data Penggunaan Tersimpan!"); _rerun_panel()
+        elif mode_transaksi == "🔄 PINJAM / TRANSFER ANTAR UNIT":
+            st.info("ℹ️ Mode ini memindahkan liter dari satu unit ke unit lain.")
+            with st.form("form_transfer"):
+                c1, c2 = st.columns(2)
+                with c1: tgl_tf = st.date_input("Tanggal Transfer"); donor_alat = st.text_input("DARI ALAT (Pemberi/Donor)"); donor_unit = st.text_input("No Unit Donor")
+                with c2: liter_tf = st.number_input("Jumlah Liter Dipinjam", min_value=0.0); recv_alat = st.text_input("KE ALAT (Penerima)"); recv_unit = st.text_input("No Unit Penerima"); ket_tf = st.text_area("Keterangan Tambahan")
+                if st.form_submit_button("Proses Transfer"):
+                    if liter_tf > 0 and donor_alat and recv_alat:
+                        ket_donor = f"Transfer ke {recv_alat} {recv_unit}. {ket_tf}"; cursor.execute("INSERT INTO bbm_keluar (lokasi_id, tanggal, nama_alat, no_unit, jumlah_liter, keterangan) VALUES (%s,%s,%s,%s,%s,%s)", (lokasi_id, tgl_tf, donor_alat, donor_unit, -liter_tf, ket_donor))
+                        # Pasangan donor (-) dan penerima (+) saling meniadakan, snapshot stok_bulanan tidak berubah
+                        ket_recv = f"Pinjam dari {donor_alat} {donor_unit}. {ket_tf}"; cursor.execute("INSERT INTO bbm_keluar (lokasi_id, tanggal, nama_alat, no_unit, jumlah_liter, keterangan) VALUES (%s,%s,%s,%s,%s,%s)", (lokasi_id, tgl_tf, recv_alat, recv_unit, liter_tf, ket_recv)); naikkan_versi_data(cursor, lokasi_id); conn.commit(); st.success(f"Berhasil transfer {liter_tf}L"); _rerun_panel()
+                    else: st.error("Mohon lengkapi nama alat dan jumlah liter!")
+    st.divider()
+    with st.expander("⏳ RIWAYAT INPUT & UNDO", expanded=True):
+        
+        # --- BLOK FITUR EDIT FORM ---
+        if st.session_state.edit_id:
+            st.markdown(f"### ✏️ Edit Data {st.session_state.edit_tipe}")
+            if st.session_state.edit_tipe == 'MASUK':
+                cursor.execute("SELECT tanggal, sumber, jenis_bbm, jumlah_liter, keterangan FROM bbm_masuk WHERE id=%s", (st.session_state.edit_id,))
+                res = cursor.fetchone()
+                if res:
+                    with st.form("edit_masuk_form"):
+                        c1, c2 = st.columns(2)
+                        with c1: e_tg = st.date_input("Tanggal", value=res[0]); e_sm = st.text_input("Sumber", value=res[1])
+                        with c2: 
+                            idx_jenis = ["Dexlite", "Solar", "Bensin"].index(res[2]) if res[2] in ["Dexlite", "Solar", "Bensin"] else 0
+                            e_jn = st.selectbox("Jenis BBM", ["Dexlite", "Solar", "Bensin"], index=idx_jenis)
+                            e_jl = st.number_input("Jumlah Liter", value=float(res[3]))
+                            e_kt = st.text_area("Keterangan", value=str(res[4]))
+                        ce1, ce2 = st.columns(2)
+                        if ce1.form_submit_button("Simpan Perubahan", type="primary"):
+                            batalkan_mutasi_stok(cursor, 'bbm_masuk', st.session_state.edit_id)
+                            cursor.execute("UPDATE bbm_masuk SET tanggal=%s, sumber=%s, jenis_bbm=%s, jumlah_liter=%s, keterangan=%s WHERE id=%s", (e_tg, e_sm, e_jn, e_jl, e_kt, st.session_state.edit_id))
+                            tambah_mutasi_stok(cursor, lokasi_id, 'bbm_masuk', e_tg, e_jl)
+                            naikkan_versi_data(cursor, lokasi_id, [('bbm_masuk', st.session_state.edit_id)]); conn.commit()
+                            st.session_state.edit_id = None; st.session_state.edit_tipe = None
+                            st.success("Data berhasil diubah!"); _rerun_panel()
+                        if ce2.form_submit_button("Batal"):
+                            st.session_state.edit_id = None; st.session_state.edit_tipe = None; _rerun_panel()
+            elif st.session_state.edit_tipe == 'KELUAR':
+                cursor.execute("SELECT tanggal, nama_alat, no_unit, jumlah_liter, keterangan FROM bbm_keluar WHERE id=%s", (st.session_state.edit_id,))
+                res = cursor.fetchone()
+                if res:
+                    is_transfer = "Transfer ke" in str(res[4]) or "Pinjam dari" in str(res[4])
+                    with st.form("edit_keluar_form"):
+                        c1, c2 = st.columns(2)
+                        with c1: 
+                            e_tg = st.date_input("Tanggal", value=res[0])
+                            e_al = st.text_input("Nama Alat", value=res[1], disabled=is_transfer)
+                            e_un = st.text_input("No Unit", value=res[2], disabled=is_transfer)
+                        with c2: 
+                            e_jl = st.number_input("Jumlah Liter", value=float(res[3]), disabled=is_transfer)
+                            e_kt = st.text_area("Keterangan", value=str(res[4]))
+                        
+                        if is_transfer:
+                            st.info("💡 Mode Edit Transfer: Anda hanya dapat mengubah Tanggal & Keterangan. Jika salah input Jumlah Liter atau Unit, silakan Hapus/Batalkan transaksi ini secara keseluruhan dan buat ulang agar sinkronisasi saldo kedua alat (Pemberi & Penerima) tetap seimbang.")
+
+                        ce1, ce2 = st.columns(2)
+                        if ce1.form_submit_button("Simpan Perubahan", type="primary"):
+                            batalkan_mutasi_stok(cursor, 'bbm_keluar', st.session_state.edit_id)
+                            cursor.execute("UPDATE bbm_keluar SET tanggal=%s, nama_alat=%s, no_unit=%s, jumlah_liter=%s, keterangan=%s WHERE id=%s", (e_tg, e_al, e_un, e_jl, e_kt, st.session_state.edit_id))
+                            tambah_mutasi_stok(cursor, lokasi_id, 'bbm_keluar', e_tg, e_jl)
+                            naikkan_versi_data(cursor, lokasi_id, [('bbm_keluar', st.session_state.edit_id)]); conn.commit()
+                            st.session_state.edit_id = None; st.session_state.edit_tipe = None
+                            st.success("Data berhasil diubah!"); _rerun_panel()
+                        if ce2.form_submit_button("Batal"):
+                            st.session_state.edit_id = None; st.session_state.edit_tipe = None; _rerun_panel()
+            st.divider()
+        # ---------------------------
+
+        # --- BLOK FILTER STATE ---
+        if "my_filter_tipe" not in st.session_state:
+            st.session_state.my_filter_tipe = ["MASUK", "PAKAI", "TRANSFER", "KOREKSI"]
+        if "my_filter_sort" not in st.session_state:
+            st.session_state.my_filter_sort = "Waktu Input Terbaru (ID)"
+        if "my_use_date" not in st.session_state:
+            st.session_state.my_use_date = False
+
+        c_f1, c_f2, c_f3 = st.columns(3)
+        filter_tipe = c_f1.multiselect("Filter Jenis:", ["MASUK", "PAKAI", "TRANSFER", "KOREKSI"], default=st.session_state.my_filter_tipe)
+        st.session_state.my_filter_tipe = filter_tipe
+
+        filter_sort = c_f2.selectbox("Urutkan:", ["Waktu Input Terbaru (ID)", "Waktu Input Terlama (ID)", "Tanggal Laporan Terbaru", "Tanggal Laporan Terlama"], index=["Waktu Input Terbaru (ID)", "Waktu Input Terlama (ID)", "Tanggal Laporan Terbaru", "Tanggal Laporan Terlama"].index(st.session_state.my_filter_sort))
+        st.session_state.my_filter_sort = filter_sort
+
+        use_date_filter = c_f3.checkbox("Filter Tanggal Tertentu", value=st.session_state.my_use_date)
+        st.session_state.my_use_date = use_date_filter
+
+        date_val = c_f3.date_input("Pilih Tanggal", value=datetime.date.today(), disabled=not use_date_filter)
+        # ---------------------------
+
+        limit_view = st.selectbox("Jumlah Data per Halaman:", [10, 50, 100])
+        # Reset ke halaman pertama setiap kali filter/urutan berubah
+        tanggal_filter = date_val if use_date_filter else None
+        sig_filter = (tuple(filter_tipe), filter_sort, tanggal_filter, limit_view)
+        if st.session_state.get("hist_sig") != sig_filter:
+            st.session_state.hist_sig = sig_filter; st.session_state.hist_cursors = [None]
+        hist_cursors = st.session_state.hist_cursors
+
+        df_view, kunci_berikutnya = ambil_halaman_history(conn, lokasi_id, filter_tipe, tanggal_filter, filter_sort, hist_cursors[-1], limit_view)
+        if df_view.empty and len(hist_cursors) > 1: hist_cursors.pop(); _rerun_panel()
+
+        if not df_view.empty:
+            df_view['Label_History'] = kolom_label_history(df_view)
+
+            st.write(f"Halaman **{len(hist_cursors)}** · Menampilkan **{len(df_view)}** data."); st.info("💡 **Catatan Undo Transfer:** Jika membatalkan transfer, pastikan Anda menghapus **KEDUA** baris (Baris 'Donor' dan Baris 'Terima') agar stok kembali seimbang.")
+            
+            df_grid = df_view[['id', 'Tipe', 'Label_History', 'tanggal', 'Detail', 'jumlah_liter', 'keterangan', 'affected_ids_val']].copy()
+            df_grid.insert(0, 'Hapus', False); df_grid['tanggal'] = df_grid['tanggal'].dt.date
+            df_edit = st.data_editor(
+                df_grid, key=f"hist_grid_{versi_data}_{abs(hash(sig_filter))}_{len(hist_cursors)}", hide_index=True, use_container_width=True,
+                disabled=['id', 'Tipe', 'Label_History', 'Detail'],
+                column_order=['Hapus', 'Label_History', 'tanggal', 'Detail', 'jumlah_liter', 'keterangan'],
+                column_config={
+                    'Hapus': st.column_config.CheckboxColumn("Hapus / Undo", width="small"),
+                    'Label_History': st.column_config.TextColumn("Jenis"),
+                    'tanggal': st.column_config.DateColumn("Tanggal", format="DD/MM/YYYY"),
+                    'jumlah_liter': st.column_config.NumberColumn("Liter", format="%.0f"),
+                    'keterangan': st.column_config.TextColumn("Keterangan"),
+                })
+            st.caption("Baris ADMIN/KOREKSI hanya bisa di-Undo (centang Hapus / Undo). Liter baris transfer tidak bisa diubah dari tabel.")
+
+            c_apply, c_pilih, c_edit = st.columns([1.5, 3, 1])
+            if c_apply.button("💾 Terapkan Perubahan", type="primary", use_container_width=True):
+                try:
+                    n_upd, n_del, n_undo, n_tolak = simpan_perubahan_history(conn, lokasi_id, df_grid, df_edit)
+                    if n_tolak: st.warning(f"{n_tolak} perubahan diabaikan (liter transfer / baris ADMIN/KOREKSI).")
+                    if n_upd + n_del + n_undo == 0:
+                        if not n_tolak: st.info("Tidak ada perubahan.")
+                    else:
+                        st.success(f"Tersimpan: {n_upd} diubah, {n_del} dihapus, {n_undo} di-undo."); _rerun_panel()
+                except Exception as e: st.error(f"Gagal menyimpan: {e}")
+            # Form edit lengkap tetap tersedia untuk Sumber/Jenis BBM/Nama Alat/No Unit
+            opsi_edit = df_view[df_view['Tipe'] != 'LOG']
+            if not opsi_edit.empty:
+                pilih_edit = c_pilih.selectbox("Edit lengkap:", opsi_edit.index, format_func=lambda i: f"{opsi_edit.at[i, 'tanggal'].strftime('%d/%m/%Y')} · {opsi_edit.at[i, 'Detail']} · {opsi_edit.at[i, 'jumlah_liter']:,.0f} L", label_visibility="collapsed")
+                if c_edit.button("✏️ Edit", use_container_width=True):
+                    st.session_state.edit_id = int(opsi_edit.at[pilih_edit, 'id']); st.session_state.edit_tipe = opsi_edit.at[pilih_edit, 'Tipe']; _rerun_panel()
+            nav_prev, _, nav_next = st.columns([1, 3, 1])
+            if nav_prev.button("⬅️ Sebelumnya", disabled=len(hist_cursors) == 1, use_container_width=True): hist_cursors.pop(); _rerun_panel()
+            if nav_next.button("Berikutnya ➡️", disabled=kunci_berikutnya is None, use_container_width=True): hist_cursors.append(kunci_berikutnya); _rerun_panel()
+        else: st.write("Belum ada riwayat input.")
+
 def main():
     if "edit_id" not in st.session_state: st.session_state.edit_id = None
     if "edit_tipe" not in st.session_state: st.session_state.edit_tipe = None
     if "is_super_admin" not in st.session_state: st.session_state.is_super_admin = False
 
     try: 
-        engine = init_engine(); conn = engine.raw_connection(); cursor = conn.cursor() 
-        try: cursor.execute("SELECT stok_awal FROM lokasi_proyek LIMIT 1"); cursor.fetchall()
-        except: cursor.execute("ALTER TABLE lokasi_proyek ADD COLUMN stok_awal FLOAT DEFAULT 0"); conn.commit()
-        try: cursor.execute("SELECT kunci_lokasi FROM lokasi_proyek LIMIT 1"); cursor.fetchall()
-        except: cursor.execute("ALTER TABLE lokasi_proyek ADD COLUMN kunci_lokasi VARCHAR(255) DEFAULT '123'"); conn.commit()
-        cursor.execute("""CREATE TABLE IF NOT EXISTS log_aktivitas (id INT AUTO_INCREMENT PRIMARY KEY, lokasi_id INT, tanggal DATETIME DEFAULT CURRENT_TIMESTAMP, kategori VARCHAR(50), deskripsi TEXT, affected_ids TEXT)""")
-        try: cursor.execute("SELECT affected_ids FROM log_aktivitas LIMIT 1"); cursor.fetchall()
-        except: 
-             try: cursor.execute("ALTER TABLE log_aktivitas ADD COLUMN affected_ids TEXT"); conn.commit()
-             except: pass
-        cursor.execute("""CREATE TABLE IF NOT EXISTS rekap_exclude (id INT AUTO_INCREMENT PRIMARY KEY, lokasi_id INT, nama_unit_full VARCHAR(255))"""); conn.commit()
+        engine = init_engine(); conn = engine.raw_connection(); cursor = conn.cursor()
     except Exception as e: st.error(f"Database Error: {e}"); st.stop()
 
     if "active_project_id" not in st.session_state: st.session_state.active_project_id = None
@@ -1506,6 +2397,8 @@ def main():
                                 cursor.execute("DELETE FROM bbm_keluar WHERE lokasi_id=%s", (lok_id_del,))
                                 cursor.execute("DELETE FROM log_aktivitas WHERE lokasi_id=%s", (lok_id_del,))
                                 cursor.execute("DELETE FROM rekap_exclude WHERE lokasi_id=%s", (lok_id_del,))
+                                cursor.execute("DELETE FROM stok_bulanan WHERE lokasi_id=%s", (lok_id_del,))
+                                cursor.execute("DELETE FROM log_perubahan WHERE lokasi_id=%s", (lok_id_del,))
                                 cursor.execute("DELETE FROM lokasi_proyek WHERE id=%s", (lok_id_del,))
                                 conn.commit()
                                 st.success(f"Berhasil! Lokasi '{lok_to_del}' beserta semua history datanya telah dihapus.")
@@ -1517,6 +2410,24 @@ def main():
                             st.error("Gagal! Teks konfirmasi tidak sesuai. Harap ketik KONFIRMASI dengan benar.")
             else:
                 st.info("Belum ada data lokasi.")
+
+            with st.container(border=True):
+                st.subheader("Export Data Mentah Semua Lokasi")
+                st.caption("Seluruh riwayat BBM Masuk & Keluar semua lokasi untuk audit, dibaca bertahap dari database.")
+                format_mentah_adm = st.radio("Format File:", ['csv', 'parquet'], horizontal=True, key="format_mentah_admin")
+                if st.button("🗃️ Export Data Mentah (ZIP)", use_container_width=True): ajukan_export_mentah(0, "SEMUA_LOKASI", versi_semua_lokasi(cursor), format_mentah_adm)
+                daftar_job_export()
+
+            with st.container(border=True):
+                st.subheader("Snapshot Stok Bulanan")
+                st.caption("Saldo per bulan yang dipakai untuk menghitung Sisa Bulan Lalu. Verifikasi membandingkan snapshot dengan tabel BBM Masuk & Keluar.")
+                c_v1, c_v2 = st.columns(2)
+                if c_v1.button("Verifikasi Snapshot", use_container_width=True):
+                    df_selisih = verifikasi_stok_bulanan(conn)
+                    if df_selisih.empty: st.success("Snapshot sesuai dengan data transaksi.")
+                    else: st.error(f"Ditemukan {len(df_selisih)} bulan yang tidak sesuai."); st.dataframe(df_selisih, hide_index=True)
+                if c_v2.button("Rebuild Snapshot", use_container_width=True):
+                    jml = rebuild_stok_bulanan(conn); st.success(f"Snapshot dibangun ulang ({jml} bulan).")
                 
             st.stop() # Menghentikan script di sini agar menu utama tidak ikut ter-render
 
@@ -1554,210 +2465,19 @@ def main():
         st.stop() 
 
     lokasi_id = st.session_state.active_project_id; nama_proyek = st.session_state.active_project_name
-    cursor.execute("SELECT stok_awal FROM lokasi_proyek WHERE id=%s", (lokasi_id,)); stok_awal_modal = cursor.fetchone()[0]
+    cursor.execute("SELECT stok_awal, data_versi FROM lokasi_proyek WHERE id=%s", (lokasi_id,)); stok_awal_modal, versi_data = cursor.fetchone()
     
     with st.sidebar:
         st.header(f"📍 {nama_proyek}")
         if st.button("⬅️ Kembali ke Menu Utama", use_container_width=True): st.session_state.active_project_id = None; st.session_state.active_project_name = None; st.rerun()
 
-    df_masuk_all = pd.read_sql(f"SELECT * FROM bbm_masuk WHERE lokasi_id={lokasi_id}", conn)
-    df_keluar_all = pd.read_sql(f"SELECT * FROM bbm_keluar WHERE lokasi_id={lokasi_id}", conn)
-    df_log = pd.read_sql(f"SELECT * FROM log_aktivitas WHERE lokasi_id={lokasi_id}", conn)
-    df_ex = pd.read_sql(f"SELECT nama_unit_full FROM rekap_exclude WHERE lokasi_id={lokasi_id}", conn)
-    excluded_list = df_ex['nama_unit_full'].tolist() if not df_ex.empty else []
-
-    # OPTIMASI
-    if not df_masuk_all.empty: 
-        df_masuk_all['tanggal'] = pd.to_datetime(df_masuk_all['tanggal'])
-        df_masuk_all['HARI'] = df_masuk_all['tanggal'].apply(get_hari_indonesia)
-    if not df_keluar_all.empty: 
-        df_keluar_all['tanggal'] = pd.to_datetime(df_keluar_all['tanggal'])
-        df_keluar_all['HARI'] = df_keluar_all['tanggal'].apply(get_hari_indonesia)
+    df_masuk_all, df_keluar_all, df_log, excluded_list = load_data_lokasi(conn, lokasi_id, versi_data)
 
     st.title(f"Dashboard: {nama_proyek}")
     t1, t2, t3 = st.tabs(["📝 Input & History", "📊 Laporan & Grafik", "🖨️ Export Dokumen"])
     
     with t1:
-        st.subheader("Input Transaksi BBM")
-        mode_transaksi = st.radio("Pilih Jenis Transaksi:", ["📥 BBM MASUK", "📤 PENGGUNAAN BBM", "🔄 PINJAM / TRANSFER ANTAR UNIT"], horizontal=True)
-        with st.container(border=True):
-            if mode_transaksi == "📥 BBM MASUK":
-                with st.form("form_masuk"):
-                    c1, c2 = st.columns(2)
-                    with c1: tg = st.date_input("Tanggal Masuk"); sm = st.text_input("Sumber / Supplier")
-                    with c2: jn = st.selectbox("Jenis BBM", ["Dexlite","Solar","Bensin"]); jl = st.number_input("Jumlah Liter", 0.0); kt = st.text_area("Keterangan")
-                    if st.form_submit_button("Simpan BBM Masuk"):
-                        cursor.execute("SELECT id FROM bbm_masuk WHERE lokasi_id=%s AND tanggal=%s AND sumber=%s AND jumlah_liter=%s", (lokasi_id, tg, sm, jl))
-                        if cursor.fetchall(): st.warning("⚠️ Data serupa sudah ada!") 
-                        cursor.execute("INSERT INTO bbm_masuk (lokasi_id, tanggal, sumber, jenis_bbm, jumlah_liter, keterangan) VALUES (%s,%s,%s,%s,%s,%s)", (lokasi_id, tg, sm, jn, jl, kt)); conn.commit(); st.success("Data Masuk Tersimpan!"); st.rerun()
-            elif mode_transaksi == "📤 PENGGUNAAN BBM":
-                with st.form("form_keluar"):
-                    c1, c2 = st.columns(2)
-                    with c1: tg_p = st.date_input("Tanggal Pakai"); al = st.text_input("Nama Alat/Kendaraan"); un = st.text_input("Kode Unit (Ex: DT-01)")
-                    with c2: jl_p = st.number_input("Liter Digunakan", 0.0); kt_p = st.text_area("Keterangan / Lokasi Kerja")
-                    if st.form_submit_button("Simpan Penggunaan"):
-                        cursor.execute("SELECT id FROM bbm_keluar WHERE lokasi_id=%s AND tanggal=%s AND nama_alat=%s AND no_unit=%s AND jumlah_liter=%s", (lokasi_id, tg_p, al, un, jl_p))
-                        if cursor.fetchall(): st.warning("⚠️ Data serupa sudah ada!") 
-                        cursor.execute("INSERT INTO bbm_keluar (lokasi_id, tanggal, nama_alat, no_unit, jumlah_liter, keterangan) VALUES (%s,%s,%s,%s,%s,%s)", (lokasi_id, tg_p, al, un, jl_p, kt_p)); conn.commit(); st.success("Data Penggunaan Tersimpan!"); st.rerun()
-            elif mode_transaksi == "🔄 PINJAM / TRANSFER ANTAR UNIT":
-                st.info("ℹ️ Mode ini memindahkan liter dari satu unit ke unit lain.")
-                with st.form("form_transfer"):
-                    c1, c2 = st.columns(2)
-                    with c1: tgl_tf = st.date_input("Tanggal Transfer"); donor_alat = st.text_input("DARI ALAT (Pemberi/Donor)"); donor_unit = st.text_input("No Unit Donor")
-                    with c2: liter_tf = st.number_input("Jumlah Liter Dipinjam", min_value=0.0); recv_alat = st.text_input("KE ALAT (Penerima)"); recv_unit = st.text_input("No Unit Penerima"); ket_tf = st.text_area("Keterangan Tambahan")
-                    if st.form_submit_button("Proses Transfer"):
-                        if liter_tf > 0 and donor_alat and recv_alat:
-                            ket_donor = f"Transfer ke {recv_alat} {recv_unit}. {ket_tf}"; cursor.execute("INSERT INTO bbm_keluar (lokasi_id, tanggal, nama_alat, no_unit, jumlah_liter, keterangan) VALUES (%s,%s,%s,%s,%s,%s)", (lokasi_id, tgl_tf, donor_alat, donor_unit, -liter_tf, ket_donor))
-                            ket_recv = f"Pinjam dari {donor_alat} {donor_unit}. {ket_tf}"; cursor.execute("INSERT INTO bbm_keluar (lokasi_id, tanggal, nama_alat, no_unit, jumlah_liter, keterangan) VALUES (%s,%s,%s,%s,%s,%s)", (lokasi_id, tgl_tf, recv_alat, recv_unit, liter_tf, ket_recv)); conn.commit(); st.success(f"Berhasil transfer {liter_tf}L"); st.rerun()
-                        else: st.error("Mohon lengkapi nama alat dan jumlah liter!")
-        st.divider()
-        with st.expander("⏳ RIWAYAT INPUT & UNDO", expanded=True):
-            
-            # --- BLOK FITUR EDIT FORM ---
-            if st.session_state.edit_id:
-                st.markdown(f"### ✏️ Edit Data {st.session_state.edit_tipe}")
-                if st.session_state.edit_tipe == 'MASUK':
-                    cursor.execute("SELECT tanggal, sumber, jenis_bbm, jumlah_liter, keterangan FROM bbm_masuk WHERE id=%s", (st.session_state.edit_id,))
-                    res = cursor.fetchone()
-                    if res:
-                        with st.form("edit_masuk_form"):
-                            c1, c2 = st.columns(2)
-                            with c1: e_tg = st.date_input("Tanggal", value=res[0]); e_sm = st.text_input("Sumber", value=res[1])
-                            with c2: 
-                                idx_jenis = ["Dexlite", "Solar", "Bensin"].index(res[2]) if res[2] in ["Dexlite", "Solar", "Bensin"] else 0
-                                e_jn = st.selectbox("Jenis BBM", ["Dexlite", "Solar", "Bensin"], index=idx_jenis)
-                                e_jl = st.number_input("Jumlah Liter", value=float(res[3]))
-                                e_kt = st.text_area("Keterangan", value=str(res[4]))
-                            ce1, ce2 = st.columns(2)
-                            if ce1.form_submit_button("Simpan Perubahan", type="primary"):
-                                cursor.execute("UPDATE bbm_masuk SET tanggal=%s, sumber=%s, jenis_bbm=%s, jumlah_liter=%s, keterangan=%s WHERE id=%s", (e_tg, e_sm, e_jn, e_jl, e_kt, st.session_state.edit_id))
-                                conn.commit()
-                                st.session_state.edit_id = None; st.session_state.edit_tipe = None
-                                st.success("Data berhasil diubah!"); st.rerun()
-                            if ce2.form_submit_button("Batal"):
-                                st.session_state.edit_id = None; st.session_state.edit_tipe = None; st.rerun()
-                elif st.session_state.edit_tipe == 'KELUAR':
-                    cursor.execute("SELECT tanggal, nama_alat, no_unit, jumlah_liter, keterangan FROM bbm_keluar WHERE id=%s", (st.session_state.edit_id,))
-                    res = cursor.fetchone()
-                    if res:
-                        is_transfer = "Transfer ke" in str(res[4]) or "Pinjam dari" in str(res[4])
-                        with st.form("edit_keluar_form"):
-                            c1, c2 = st.columns(2)
-                            with c1: 
-                                e_tg = st.date_input("Tanggal", value=res[0])
-                                e_al = st.text_input("Nama Alat", value=res[1], disabled=is_transfer)
-                                e_un = st.text_input("No Unit", value=res[2], disabled=is_transfer)
-                            with c2: 
-                                e_jl = st.number_input("Jumlah Liter", value=float(res[3]), disabled=is_transfer)
-                                e_kt = st.text_area("Keterangan", value=str(res[4]))
-                            
-                            if is_transfer:
-                                st.info("💡 Mode Edit Transfer: Anda hanya dapat mengubah Tanggal & Keterangan. Jika salah input Jumlah Liter atau Unit, silakan Hapus/Batalkan transaksi ini secara keseluruhan dan buat ulang agar sinkronisasi saldo kedua alat (Pemberi & Penerima) tetap seimbang.")
-
-                            ce1, ce2 = st.columns(2)
-                            if ce1.form_submit_button("Simpan Perubahan", type="primary"):
-                                cursor.execute("UPDATE bbm_keluar SET tanggal=%s, nama_alat=%s, no_unit=%s, jumlah_liter=%s, keterangan=%s WHERE id=%s", (e_tg, e_al, e_un, e_jl, e_kt, st.session_state.edit_id))
-                                conn.commit()
-                                st.session_state.edit_id = None; st.session_state.edit_tipe = None
-                                st.success("Data berhasil diubah!"); st.rerun()
-                            if ce2.form_submit_button("Batal"):
-                                st.session_state.edit_id = None; st.session_state.edit_tipe = None; st.rerun()
-                st.divider()
-            # ---------------------------
-
-            # --- BLOK FILTER STATE ---
-            if "my_filter_tipe" not in st.session_state:
-                st.session_state.my_filter_tipe = ["MASUK", "PAKAI", "TRANSFER", "KOREKSI"]
-            if "my_filter_sort" not in st.session_state:
-                st.session_state.my_filter_sort = "Waktu Input Terbaru (ID)"
-            if "my_use_date" not in st.session_state:
-                st.session_state.my_use_date = False
-
-            c_f1, c_f2, c_f3 = st.columns(3)
-            filter_tipe = c_f1.multiselect("Filter Jenis:", ["MASUK", "PAKAI", "TRANSFER", "KOREKSI"], default=st.session_state.my_filter_tipe)
-            st.session_state.my_filter_tipe = filter_tipe
-
-            filter_sort = c_f2.selectbox("Urutkan:", ["Waktu Input Terbaru (ID)", "Waktu Input Terlama (ID)", "Tanggal Laporan Terbaru", "Tanggal Laporan Terlama"], index=["Waktu Input Terbaru (ID)", "Waktu Input Terlama (ID)", "Tanggal Laporan Terbaru", "Tanggal Laporan Terlama"].index(st.session_state.my_filter_sort))
-            st.session_state.my_filter_sort = filter_sort
-
-            use_date_filter = c_f3.checkbox("Filter Tanggal Tertentu", value=st.session_state.my_use_date)
-            st.session_state.my_use_date = use_date_filter
-
-            date_val = c_f3.date_input("Pilih Tanggal", value=datetime.date.today(), disabled=not use_date_filter)
-            # ---------------------------
-
-            history_data = []
-            if not df_masuk_all.empty:
-                temp_m = df_masuk_all.copy(); temp_m['Tipe'] = 'MASUK'; temp_m['Kategori_Filter'] = 'MASUK'; temp_m['Detail'] = temp_m['sumber'] + " (" + temp_m['jenis_bbm'] + ")"; temp_m['Label_History'] = "📥 BBM MASUK (Beli)"
-                history_data.append(temp_m[['id', 'tanggal', 'Tipe', 'Detail', 'jumlah_liter', 'Label_History', 'keterangan', 'Kategori_Filter']])
-            if not df_keluar_all.empty:
-                temp_k = df_keluar_all.copy(); temp_k['Tipe'] = 'KELUAR'; temp_k['Detail'] = temp_k['nama_alat'] + " " + temp_k['no_unit']
-                def tentukan_label(row):
-                    liter = row['jumlah_liter']; ket = str(row['keterangan']).lower()
-                    if liter < 0: return ("🔄 TRANSFER KELUAR (Donor)", "TRANSFER")
-                    elif "pinjam" in ket or "transfer" in ket: return ("🔄 TRANSFER MASUK (Terima)", "TRANSFER")
-                    else: return ("📤 PENGGUNAAN (Pakai)", "PAKAI")
-                applied = temp_k.apply(tentukan_label, axis=1)
-                temp_k['Label_History'] = [x[0] for x in applied]; temp_k['Kategori_Filter'] = [x[1] for x in applied]
-                history_data.append(temp_k[['id', 'tanggal', 'Tipe', 'Detail', 'jumlah_liter', 'Label_History', 'keterangan', 'Kategori_Filter']])
-            if not df_log.empty:
-                temp_l = df_log.copy(); temp_l['Tipe'] = 'LOG'; temp_l['Kategori_Filter'] = 'KOREKSI'; temp_l['Detail'] = temp_l['kategori']; temp_l['jumlah_liter'] = 0; temp_l['Label_History'] = "🛠️ ADMIN/KOREKSI"; temp_l['keterangan'] = temp_l['deskripsi']
-                temp_l['affected_ids_val'] = temp_l['affected_ids'] if 'affected_ids' in temp_l.columns else None
-                history_data.append(temp_l[['id', 'tanggal', 'Tipe', 'Detail', 'jumlah_liter', 'Label_History', 'keterangan', 'Kategori_Filter', 'affected_ids_val']])
-            
-            if history_data:
-                df_history = pd.concat(history_data)
-                df_history['tanggal'] = pd.to_datetime(df_history['tanggal'])
-                if filter_tipe: df_history = df_history[df_history['Kategori_Filter'].isin(filter_tipe)]
-                if use_date_filter: df_history = df_history[df_history['tanggal'].dt.date == date_val]
-                
-                if "Waktu Input Terbaru" in filter_sort: df_history.sort_values(by='id', ascending=False, inplace=True)
-                elif "Waktu Input Terlama" in filter_sort: df_history.sort_values(by='id', ascending=True, inplace=True)
-                elif "Tanggal Laporan Terbaru" in filter_sort: df_history.sort_values(by='tanggal', ascending=False, inplace=True)
-                elif "Tanggal Laporan Terlama" in filter_sort: df_history.sort_values(by='tanggal', ascending=True, inplace=True)
-                
-                limit_view = st.selectbox("Jumlah Data Ditampilkan:", ["10", "50", "100", "SEMUA"])
-                df_view = df_history.head(int(limit_view)) if limit_view != "SEMUA" else df_history
-                
-                st.write(f"Menampilkan **{len(df_view)}** data."); st.info("💡 **Catatan Undo Transfer:** Jika membatalkan transfer, pastikan Anda menghapus **KEDUA** baris (Baris 'Donor' dan Baris 'Terima') agar stok kembali seimbang.")
-                
-                for index, row in df_view.iterrows():
-                    col_a, col_b, col_c, col_d, col_e = st.columns([2, 2, 3, 1, 1.5])
-                    with col_a: 
-                        lbl = row['Label_History']
-                        if "MASUK" in lbl and "TRANSFER" not in lbl: st.success(lbl)
-                        elif "PENGGUNAAN" in lbl: st.warning(lbl)
-                        elif "TRANSFER" in lbl: st.info(lbl)
-                        elif "ADMIN" in lbl: st.error(lbl)
-                        else: st.write(lbl)
-                    with col_b: st.write(f"📅 {row['tanggal'].strftime('%d/%m/%Y')}")
-                    with col_c: st.write(f"**{row['Detail']}**"); st.caption(f"ket: {row['keterangan']}")
-                    with col_d: st.write(f"{row['jumlah_liter']:,.0f} L") if row['Tipe'] != 'LOG' else st.write("-")
-                    with col_e:
-                        if row['Tipe'] != 'LOG':
-                            btn_c1, btn_c2 = st.columns(2)
-                            with btn_c1:
-                                if st.button("✏️", key=f"hist_edit_{row['Tipe']}_{row['id']}", help="Edit Data Ini"):
-                                    st.session_state.edit_id = row['id']
-                                    st.session_state.edit_tipe = row['Tipe']
-                                    st.rerun()
-                            with btn_c2:
-                                if st.button("❌", key=f"hist_del_{row['Tipe']}_{row['id']}", help="Hapus Data Ini"):
-                                    table_del = "bbm_masuk" if row['Tipe'] == 'MASUK' else "bbm_keluar"
-                                    cursor.execute(f"DELETE FROM {table_del} WHERE id=%s", (row['id'],)); conn.commit(); st.success("Data berhasil dihapus!"); st.rerun()
-                        else:
-                            if st.button("↩️ Undo", key=f"hist_undo_{row['id']}"):
-                                try:
-                                    matches = re.findall(r"'(.*?)'", row['keterangan'])
-                                    if len(matches) >= 2:
-                                        old_val = matches[0]; affected_ids = row.get('affected_ids_val')
-                                        if affected_ids:
-                                            field = "nama_alat" if "NAMA ALAT" in row['Detail'] else "no_unit"
-                                            cursor.execute(f"UPDATE bbm_keluar SET {field}='{old_val}' WHERE id IN ({affected_ids})")
-                                    cursor.execute("DELETE FROM log_aktivitas WHERE id=%s", (row['id'],)); conn.commit(); st.success(f"Berhasil Undo."); st.rerun()
-                                except Exception as e: st.error(f"Error Undo: {e}")
-                    st.markdown("---")
-            else: st.write("Belum ada riwayat input.")
+        panel_input_riwayat(lokasi_id)
 
     with t2:
         st.markdown("### 🗓️ Filter Periode Laporan")
@@ -1785,7 +2505,7 @@ def main():
                 if st.button("Simpan Pengaturan Rekap"):
                     cursor.execute(f"DELETE FROM rekap_exclude WHERE lokasi_id={lokasi_id}")
                     for item in selected_excludes: cursor.execute("INSERT INTO rekap_exclude (lokasi_id, nama_unit_full) VALUES (%s, %s)", (lokasi_id, item))
-                    conn.commit(); st.success("Pengaturan Disimpan!"); st.rerun()
+                    naikkan_versi_data(cursor, lokasi_id); conn.commit(); st.success("Pengaturan Disimpan!"); st.rerun()
             else: st.info("Belum ada data unit keluar.")
         
         with st.expander("🛠️ MENU ADMIN", expanded=False):
@@ -1798,7 +2518,7 @@ def main():
                         pilih_lama = st.selectbox("Alat Salah:", list_alat, key="ot"); input_baru = st.text_input("Nama Benar:", key="nt")
                         if st.button("Ganti Nama Alat"): 
                             cursor.execute(f"SELECT id FROM bbm_keluar WHERE nama_alat='{pilih_lama}' AND lokasi_id={lokasi_id}"); ids = [str(r[0]) for r in cursor.fetchall()]; ids_str = ",".join(ids)
-                            if ids: cursor.execute("UPDATE bbm_keluar SET nama_alat=%s WHERE nama_alat=%s AND lokasi_id={lokasi_id}", (input_baru, pilih_lama, lokasi_id)); cursor.execute("INSERT INTO log_aktivitas (lokasi_id, kategori, deskripsi, affected_ids) VALUES (%s, %s, %s, %s)", (lokasi_id, "GANTI NAMA ALAT", f"Mengubah '{pilih_lama}' menjadi '{input_baru}'", ids_str)); conn.commit(); st.success("Nama Diganti & Dicatat!"); st.rerun()
+                            if ids: cursor.execute("UPDATE bbm_keluar SET nama_alat=%s WHERE nama_alat=%s AND lokasi_id={lokasi_id}", (input_baru, pilih_lama, lokasi_id)); cursor.execute("INSERT INTO log_aktivitas (lokasi_id, kategori, deskripsi, affected_ids) VALUES (%s, %s, %s, %s)", (lokasi_id, "GANTI NAMA ALAT", f"Mengubah '{pilih_lama}' menjadi '{input_baru}'", ids_str)); naikkan_versi_data(cursor, lokasi_id, [('bbm_keluar', i) for i in ids]); conn.commit(); st.success("Nama Diganti & Dicatat!"); st.rerun()
                 
                 with c2:
                     list_alat_for_unit = sorted(df_keluar_all['nama_alat'].unique().tolist()) if not df_keluar_all.empty else []
@@ -1811,7 +2531,7 @@ def main():
                             ids = [str(r[0]) for r in cursor.fetchall()]; ids_str = ",".join(ids)
                             if ids: 
                                 cursor.execute("UPDATE bbm_keluar SET no_unit=%s WHERE no_unit=%s AND nama_alat=%s AND lokasi_id=%s", (ib_u, pl_u, pilih_alat_u, lokasi_id))
-                                cursor.execute("INSERT INTO log_aktivitas (lokasi_id, kategori, deskripsi, affected_ids) VALUES (%s, %s, %s, %s)", (lokasi_id, "GANTI NO UNIT", f"Mengubah '{pl_u}' menjadi '{ib_u}' pada alat '{pilih_alat_u}'", ids_str)); conn.commit(); st.success("Unit Diganti & Dicatat!"); st.rerun()
+                                cursor.execute("INSERT INTO log_aktivitas (lokasi_id, kategori, deskripsi, affected_ids) VALUES (%s, %s, %s, %s)", (lokasi_id, "GANTI NO UNIT", f"Mengubah '{pl_u}' menjadi '{ib_u}' pada alat '{pilih_alat_u}'", ids_str)); naikkan_versi_data(cursor, lokasi_id, [('bbm_keluar', i) for i in ids]); conn.commit(); st.success("Unit Diganti & Dicatat!"); st.rerun()
                             else: st.warning("Data tidak ditemukan untuk kombinasi Alat dan Unit tersebut.")
 
             with t_hap:
@@ -1819,11 +2539,11 @@ def main():
                 with c1:
                     if not df_masuk_all.empty:
                         m_sel = st.selectbox("Hapus Masuk:", df_masuk_all.apply(lambda x: f"{x['id']}|{x['tanggal']}|{x['sumber']}", axis=1))
-                        if st.button("Hapus Masuk"): cursor.execute(f"DELETE FROM bbm_masuk WHERE id={m_sel.split('|')[0]}"); conn.commit(); st.rerun()
+                        if st.button("Hapus Masuk"): batalkan_mutasi_stok(cursor, 'bbm_masuk', m_sel.split('|')[0]); cursor.execute(f"DELETE FROM bbm_masuk WHERE id={m_sel.split('|')[0]}"); naikkan_versi_data(cursor, lokasi_id, [('bbm_masuk', m_sel.split('|')[0])]); conn.commit(); st.rerun()
                 with c2:
                     if not df_keluar_all.empty:
                         k_sel = st.selectbox("Hapus Keluar:", df_keluar_all.apply(lambda x: f"{x['id']}|{x['tanggal']}|{x['nama_alat']}", axis=1))
-                        if st.button("Hapus Keluar"): cursor.execute(f"DELETE FROM bbm_keluar WHERE id={k_sel.split('|')[0]}"); conn.commit(); st.rerun()
+                        if st.button("Hapus Keluar"): batalkan_mutasi_stok(cursor, 'bbm_keluar', k_sel.split('|')[0]); cursor.execute(f"DELETE FROM bbm_keluar WHERE id={k_sel.split('|')[0]}"); naikkan_versi_data(cursor, lokasi_id, [('bbm_keluar', k_sel.split('|')[0])]); conn.commit(); st.rerun()
 
             with t_proy:
                 new_project_name = st.text_input("Ganti Nama Proyek / Lokasi:", value=nama_proyek)
@@ -1921,28 +2641,30 @@ def main():
 
         c1, c2, c3 = st.columns(3)
         if start_date_exp <= end_date_exp:
+            satu_kertas = "1 Bulan 1 Kertas" in export_mode
+            gen_pdf, gen_xl, gen_doc = GENERATOR_EXPORT[satu_kertas]
+            args_exp = (lokasi_id, nama_proyek, start_date_exp, end_date_exp, excluded_list, versi_data)
+            nama_file = f"Laporan_{nama_proyek}_{start_date_exp}_{end_date_exp}"
+            if 'export_jobs' not in st.session_state: st.session_state.export_jobs = []
+            def _ajukan(gen, ext, mime, **opsi):
+                job_id = ajukan_job_export(gen, *args_exp, f"{nama_file}.{ext}", mime, **opsi)
+                if job_id not in st.session_state.export_jobs: st.session_state.export_jobs.append(job_id)
             with c1: 
-                if st.button("📕 Download PDF", use_container_width=True): 
-                    if "1 Bulan 1 Kertas" in export_mode:
-                        pdf = generate_pdf_one_sheet(conn, lokasi_id, nama_proyek, start_date_exp, end_date_exp, excluded_list)
-                    else:
-                        pdf = generate_pdf_portrait(conn, lokasi_id, nama_proyek, start_date_exp, end_date_exp, excluded_list)
-                    st.download_button("⬇️ Simpan PDF", pdf, f"Laporan_{nama_proyek}_{start_date_exp}_{end_date_exp}.pdf", "application/pdf")
+                if st.button("📕 Download PDF", use_container_width=True): _ajukan(gen_pdf, 'pdf', "application/pdf")
             with c2: 
-                if st.button("📗 Download Excel", use_container_width=True): 
-                    if "1 Bulan 1 Kertas" in export_mode:
-                        xl = generate_excel_one_sheet(conn, lokasi_id, nama_proyek, start_date_exp, end_date_exp, excluded_list)
-                    else:
-                        xl = generate_excel_styled(conn, lokasi_id, nama_proyek, start_date_exp, end_date_exp, excluded_list)
-                    st.download_button("⬇️ Simpan Excel", xl, f"Laporan_{nama_proyek}_{start_date_exp}_{end_date_exp}.xlsx")
+                if st.button("📗 Download Excel", use_container_width=True): _ajukan(gen_xl, 'xlsx', "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
             with c3: 
-                if st.button("📘 Download Word", use_container_width=True): 
-                    if "1 Bulan 1 Kertas" in export_mode:
-                        doc = generate_docx_one_sheet(conn, lokasi_id, nama_proyek, start_date_exp, end_date_exp, excluded_list)
-                    else:
-                        doc = generate_docx_fixed(conn, lokasi_id, nama_proyek, start_date_exp, end_date_exp, excluded_list)
-                    st.download_button("⬇️ Simpan Word", doc, f"Laporan_{nama_proyek}_{start_date_exp}_{end_date_exp}.docx")
+                if st.button("📘 Download Word", use_container_width=True): _ajukan(gen_doc, 'docx', "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+            if st.button("📦 Download Semua Format (ZIP)", use_container_width=True): _ajukan(generate_semua_format, 'zip', "application/zip", satu_kertas=satu_kertas)
         else: st.error("Tanggal Akhir harus lebih besar dari Tanggal Awal")
 
+        with st.expander("🗃️ Export Data Mentah (Audit)"):
+            st.caption("Seluruh riwayat BBM Masuk & Keluar lokasi ini apa adanya, tanpa filter periode/exclude.")
+            c_m1, c_m2 = st.columns(2)
+            with c_m1: format_mentah = st.radio("Format File:", ['csv', 'parquet'], horizontal=True, key="format_mentah")
+            with c_m2:
+                if st.button("🗃️ Export Data Mentah (ZIP)", use_container_width=True): ajukan_export_mentah(lokasi_id, nama_proyek, versi_data, format_mentah)
+        daftar_job_export()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
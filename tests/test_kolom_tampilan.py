@@ -0,0 +1,82 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kolom_tampilan import kolom_hari_indonesia, kolom_label_history
+
+
+# Implementasi lama (apply per baris) sebagai acuan
+def get_hari_indonesia(tanggal):
+    try:
+        if pd.isnull(tanggal): return "-"
+        kamus = {'Monday': 'Senin', 'Tuesday': 'Selasa', 'Wednesday': 'Rabu',
+                 'Thursday': 'Kamis', 'Friday': 'Jumat', 'Saturday': 'Sabtu', 'Sunday': 'Minggu'}
+        return kamus[tanggal.strftime('%A')]
+    except: return "-"
+
+def kategori_filter(row):
+    # Padanan KATEGORI_KELUAR_SQL (LOWER(NULL) LIKE .. -> bukan TRANSFER)
+    if row['Tipe'] == 'MASUK': return 'MASUK'
+    if row['Tipe'] == 'LOG': return 'KOREKSI'
+    ket = row['keterangan'].lower() if isinstance(row['keterangan'], str) else ''
+    return 'TRANSFER' if row['jumlah_liter'] < 0 or 'pinjam' in ket or 'transfer' in ket else 'PAKAI'
+
+def tentukan_label(row):
+    if row['Tipe'] == 'MASUK': return "📥 BBM MASUK (Beli)"
+    if row['Tipe'] == 'LOG': return "🛠️ ADMIN/KOREKSI"
+    if row['jumlah_liter'] < 0: return "🔄 TRANSFER KELUAR (Donor)"
+    return "🔄 TRANSFER MASUK (Terima)" if row['Kategori_Filter'] == 'TRANSFER' else "📤 PENGGUNAAN (Pakai)"
+
+
+def test_hari_sama_dengan_apply_lama():
+    tanggal = pd.Series(pd.date_range('2024-12-28', periods=14, freq='D').tolist() + [pd.NaT, None])
+    tanggal = pd.to_datetime(tanggal)
+    assert kolom_hari_indonesia(tanggal).tolist() == tanggal.apply(get_hari_indonesia).tolist()
+
+def test_hari_nat_jadi_strip():
+    tanggal = pd.Series([pd.NaT, pd.Timestamp('2025-01-06'), pd.NaT], index=[5, 7, 9])
+    hasil = kolom_hari_indonesia(tanggal)
+    assert hasil.tolist() == ['-', 'Senin', '-']
+    assert hasil.index.tolist() == [5, 7, 9]
+
+def test_hari_frame_kosong():
+    assert kolom_hari_indonesia(pd.Series([], dtype='datetime64[ns]')).tolist() == []
+
+def _frame_history():
+    rows = [
+        ('MASUK', 100.0, 'beli spbu'),
+        ('MASUK', -5.0, 'transfer'),            # MASUK menang atas liter negatif / kata transfer
+        ('LOG', 0.0, 'hapus transfer'),         # LOG menang atas kata transfer
+        ('LOG', -3.0, None),                    # LOG menang atas liter negatif
+        ('KELUAR', -20.0, 'Transfer ke DT 01'), # negatif -> donor
+        ('KELUAR', -20.0, 'kerja'),             # negatif tanpa kata kunci tetap donor
+        ('KELUAR', 20.0, 'Pinjam dari EX 02'),  # kata pinjam -> terima
+        ('KELUAR', 20.0, 'TRANSFER masuk'),     # huruf besar
+        ('KELUAR', 15.0, 'kerja harian'),
+        ('KELUAR', 15.0, None),
+        ('KELUAR', 15.0, np.nan),
+    ]
+    df = pd.DataFrame(rows, columns=['Tipe', 'jumlah_liter', 'keterangan'], index=range(10, 10 + len(rows)))
+    df['Kategori_Filter'] = df.apply(kategori_filter, axis=1)
+    return df
+
+def test_label_sama_dengan_apply_lama():
+    df = _frame_history()
+    assert kolom_label_history(df).tolist() == df.apply(tentukan_label, axis=1).tolist()
+
+def test_label_prioritas():
+    hasil = kolom_label_history(_frame_history()).tolist()
+    assert hasil[:6] == ["📥 BBM MASUK (Beli)", "📥 BBM MASUK (Beli)", "🛠️ ADMIN/KOREKSI", "🛠️ ADMIN/KOREKSI",
+                         "🔄 TRANSFER KELUAR (Donor)", "🔄 TRANSFER KELUAR (Donor)"]
+    assert hasil[6:] == ["🔄 TRANSFER MASUK (Terima)"] * 2 + ["📤 PENGGUNAAN (Pakai)"] * 3
+
+def test_label_index_tetap():
+    df = _frame_history()
+    assert kolom_label_history(df).index.tolist() == df.index.tolist()
+
+def test_label_frame_kosong():
+    df = pd.DataFrame({'Tipe': pd.Series([], dtype=object), 'jumlah_liter': pd.Series([], dtype=float), 'keterangan': pd.Series([], dtype=object)})
+    assert kolom_label_history(df).tolist() == []